@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from bisect import bisect_left
+from fcntl import LOCK_EX, LOCK_UN, flock
+from hashlib import sha1
+from marshal import dumps, loads as unmarshal
+from os import fsync, makedirs, remove, replace, stat
+from os.path import exists
+from struct import pack as pack_struct, unpack_from
+from zlib import compress, decompress
+from vdf import loads
+
+APPINFO_DIR = "./appinfo/"
+PACK_FILE = "./appinfo.pack"
+# longest chain of deltas a read has to follow before reaching a full copy
+MAX_DELTA_DEPTH = 16
+# starts every delta record, ahead of its copy and insert ops
+DELTA_MAGIC = b"APD1"
+DELTA_COPY = 0 # followed by <II: first base line, number of lines
+DELTA_INSERT = 1 # followed by <I: length, then that many bytes of new text
+
+if __name__ == "__main__": # exit before we import our shit if the args are wrong
+    parser = ArgumentParser(description='Move the appinfo folder into a packed, deduplicated store (%s) or back. Once the pack exists, new appinfo is written to it instead of the folder; reading works the same either way.' % PACK_FILE)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--pack', help="move every vdf in %s into the pack" % APPINFO_DIR, action="store_true")
+    group.add_argument('--unpack', help="write every appinfo in the pack back out to %s" % APPINFO_DIR, action="store_true")
+    parser.add_argument('--no-delta', help="with --pack, store every revision compressed on its own instead of as a delta against the app's previous revision", dest="delta", action="store_false")
+    parser.add_argument('--keep', help="don't delete the vdf files after packing them", action="store_true")
+    args = parser.parse_args()
+
+from catalog import Catalog
+
+# the parts of appinfo the archiving scripts use
+BRANCH_KEYS = ("buildid", "timeupdated", "pwdrequired", "description")
+DEPOT_KEYS = ("name", "manifests")
+
+def make_delta(base, data):
+    """Encodes data as runs of lines copied from base and runs of new lines,
+    in one pass over each: a line that doesn't carry on the last copy is
+    looked up among base's lines, preferring the first match after where the
+    last copy left off. Not a minimal diff, but appinfo revisions mostly keep
+    their lines in order, and it takes linear time however big they are."""
+    base_lines = base.splitlines(keepends=True)
+    positions = {}
+    for index, line in enumerate(base_lines):
+        positions.setdefault(line, []).append(index)
+    ops = [] # [first base line, number of lines] copies, [lines] inserts
+    copied_to = 0 # the base line after the last one copied
+    # copied_to plus the lines inserted since, which usually replace as many
+    replaced_to = 0
+    for line in data.splitlines(keepends=True):
+        if ops and type(ops[-1][0]) == int and copied_to < len(base_lines) and base_lines[copied_to] == line:
+            ops[-1][1] += 1
+            copied_to = replaced_to = copied_to + 1
+            continue
+        candidates = positions.get(line)
+        if candidates:
+            if replaced_to < len(base_lines) and base_lines[replaced_to] == line:
+                start = replaced_to
+            else:
+                after = bisect_left(candidates, copied_to)
+                start = candidates[after] if after < len(candidates) else candidates[0]
+            ops.append([start, 1])
+            copied_to = replaced_to = start + 1
+            continue
+        if ops and type(ops[-1][0]) == bytes:
+            ops[-1].append(line)
+        else:
+            ops.append([line])
+        replaced_to += 1
+    delta = [DELTA_MAGIC]
+    for op in ops:
+        if type(op[0]) == int:
+            delta.append(pack_struct("<BII", DELTA_COPY, *op))
+        else:
+            text = b"".join(op)
+            delta.append(pack_struct("<BI", DELTA_INSERT, len(text)))
+            delta.append(text)
+    return b"".join(delta)
+
+def apply_delta(base, delta):
+    base_lines = base.splitlines(keepends=True)
+    if not delta.startswith(DELTA_MAGIC):
+        # written before deltas had their own format: a marshalled list of
+        # (start, end) base line ranges and inserted bytes
+        return b"".join(b"".join(base_lines[op[0]:op[1]]) if type(op) == tuple else op for op in unmarshal(delta))
+    data = []
+    position = len(DELTA_MAGIC)
+    while position < len(delta):
+        if delta[position] == DELTA_COPY:
+            start, count = unpack_from("<II", delta, position + 1)
+            data.extend(base_lines[start:start + count])
+            position += 9
+        elif delta[position] == DELTA_INSERT:
+            length, = unpack_from("<I", delta, position + 1)
+            data.append(delta[position + 5:position + 5 + length])
+            position += 5 + length
+        else:
+            raise ValueError("unknown appinfo delta op %s" % delta[position])
+    return b"".join(data)
+
+class AppinfoPack():
+    """Append-only file of appinfo vdf text, indexed in the catalog.
+
+    Every distinct text is stored once, keyed by its sha1, either zlib
+    compressed on its own or as a zlib compressed line delta against the same
+    app's previous revision (see make_delta and DELTA_MAGIC). Records are only
+    ever appended; the index rows for a record are committed after it has
+    been written. Writers hold an
+    exclusive lock on the pack from finding the end of it until the index rows
+    are written, so two processes adding at once can't record the same
+    offset."""
+    def __init__(self, catalog, filename=PACK_FILE):
+        self.catalog = catalog
+        self.filename = filename
+        self.file = open(filename, "a+b")
+        self.last = None # (sha, data) of the last blob read or added
+    def __repr__(self):
+        return f"Appinfo pack {self.filename} ({len(self.catalog.packed_apps())} revisions)"
+    def __contains__(self, key):
+        return self.catalog.packed_appinfo(*key) is not None
+    def read(self, appid, changenumber):
+        sha = self.catalog.packed_appinfo(appid, changenumber)
+        if not sha:
+            raise KeyError((appid, changenumber))
+        return self.read_blob(sha)
+    def read_blob(self, sha):
+        if self.last and self.last[0] == sha:
+            return self.last[1]
+        offset, length, base, depth = self.catalog.appinfo_blob(sha)
+        self.file.seek(offset)
+        data = decompress(self.file.read(length))
+        if base:
+            data = apply_delta(self.read_blob(base), data)
+        if sha1(data).digest() != sha:
+            raise ValueError("appinfo pack record %s is corrupt" % sha.hex())
+        self.last = (sha, data)
+        return data
+    def has_blob(self, sha):
+        """Whether a blob is in the pack and reads back intact (the pack may
+        not have been synced before a crash)."""
+        if not self.catalog.appinfo_blob(sha):
+            return False
+        try:
+            self.read_blob(sha)
+            return True
+        except Exception:
+            return False
+    def add(self, appid, changenumber, data, delta=True, sync=True, commit=True):
+        """Adds an app's appinfo. With commit=False the index rows are left
+        for the caller to commit (after syncing the pack, if sync=False)."""
+        sha = sha1(data).digest()
+        flock(self.file.fileno(), LOCK_EX)
+        try:
+            if not self.has_blob(sha):
+                record, base, depth = compress(data, 9), None, 0
+                predecessor = self.catalog.packed_predecessor(appid, changenumber) if delta else None
+                if predecessor and predecessor != sha:
+                    base_depth = self.catalog.appinfo_blob(predecessor)[3]
+                    if base_depth < MAX_DELTA_DEPTH and self.has_blob(predecessor):
+                        delta_record = compress(make_delta(self.read_blob(predecessor), data), 9)
+                        if len(delta_record) < len(record):
+                            record, base, depth = delta_record, predecessor, base_depth + 1
+                self.file.seek(0, 2)
+                offset = self.file.tell()
+                self.file.write(record)
+                self.file.flush()
+                if sync:
+                    fsync(self.file.fileno())
+                self.catalog.add_appinfo_blob(sha, offset, len(record), base, depth)
+                self.last = (sha, data)
+            self.catalog.pack_appinfo(appid, changenumber, sha, commit)
+        finally:
+            flock(self.file.fileno(), LOCK_UN)
+        return sha
+    def sync(self):
+        self.file.flush()
+        fsync(self.file.fileno())
+    def close(self):
+        self.file.close()
+
+def appinfo_path(appid, changenumber):
+    return APPINFO_DIR + "%s_%s.vdf" % (appid, changenumber)
+
+def has_appinfo(appid, changenumber, catalog):
+    return exists(appinfo_path(appid, changenumber)) or catalog.packed_appinfo(appid, changenumber) is not None
+
+def save_appinfo(appid, changenumber, data, catalog):
+    """Writes the vdf text of an app's appinfo and adds it to the catalog's
+    appinfo index. If the appinfo pack exists it's added to the pack,
+    otherwise it's written to a temporary file first, so readers never see a
+    partial file under its real name."""
+    target = appinfo_path(appid, changenumber)
+    if exists(PACK_FILE):
+        pack = AppinfoPack(catalog)
+        pack.add(appid, changenumber, data)
+        pack.close()
+        if exists(target):
+            remove(target) # would hide the new copy
+        return PACK_FILE
+    makedirs(APPINFO_DIR, exist_ok=True)
+    with open(target + ".tmp", "wb") as f:
+        f.write(data)
+    replace(target + ".tmp", target)
+    catalog.uncache_appinfo(appid, changenumber)
+    catalog.add_appinfo(appid, changenumber)
+    return target
+
+def read_appinfo(appid, changenumber, catalog):
+    """Returns the vdf text of an app's appinfo, from the appinfo folder or
+    the pack. Raises FileNotFoundError if it's in neither."""
+    path = appinfo_path(appid, changenumber)
+    if exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    if exists(PACK_FILE) and catalog.packed_appinfo(appid, changenumber):
+        pack = AppinfoPack(catalog)
+        try:
+            return pack.read(appid, changenumber)
+        finally:
+            pack.close()
+    raise FileNotFoundError(path)
+
+def parse_appinfo(data):
+    """Parses appinfo vdf text, returning the contents of its "appinfo" key."""
+    try:
+        return loads(data.decode("utf-8"))["appinfo"]
+    except UnicodeDecodeError:
+        return loads(data.decode("latin1"))["appinfo"]
+
+def summarize_appinfo(appinfo):
+    """Returns the subset of parsed appinfo the archiving scripts use (common
+    name, depot names and manifests, branches), in the same layout."""
+    summary = {}
+    if "public_only" in appinfo:
+        summary["public_only"] = appinfo["public_only"]
+    if "common" in appinfo:
+        summary["common"] = {key: value for key, value in appinfo["common"].items() if key == "name"}
+    if "depots" in appinfo:
+        depots = {}
+        for depot, depotinfo in appinfo["depots"].items():
+            if depot == "branches":
+                depots[depot] = {branch: {key: value for key, value in branchinfo.items() if key in BRANCH_KEYS} for branch, branchinfo in depotinfo.items()}
+            elif depot.isdigit() and isinstance(depotinfo, dict):
+                depots[depot] = {key: value for key, value in depotinfo.items() if key in DEPOT_KEYS}
+        summary["depots"] = depots
+    return summary
+
+def load_appinfo(appid, changenumber, catalog):
+    """Returns the summarized appinfo for an app's changenumber, from the
+    catalog's cache if the appinfo hasn't changed since it was cached,
+    otherwise by parsing the vdf and caching the result."""
+    path = appinfo_path(appid, changenumber)
+    if exists(path):
+        st = stat(path)
+        size, mtime_ns = st.st_size, st.st_mtime_ns
+    else:
+        size, mtime_ns = -1, 0 # packed appinfo is uncached whenever it's replaced
+    cached = catalog.cached_appinfo(appid, changenumber)
+    if cached and cached[0] == size and cached[1] == mtime_ns:
+        return unmarshal(decompress(cached[2]))
+    summary = summarize_appinfo(parse_appinfo(read_appinfo(appid, changenumber, catalog)))
+    catalog.cache_appinfo(appid, changenumber, size, mtime_ns, compress(dumps(summary)))
+    return summary
+
+if __name__ == "__main__":
+    catalog = Catalog()
+    if args.pack:
+        catalog.scan_appinfo()
+        pack = AppinfoPack(catalog)
+        packed = []
+        for index, appid in enumerate(catalog.appids()):
+            for changenumber in catalog.changenumbers(appid):
+                path = appinfo_path(appid, changenumber)
+                if not exists(path):
+                    continue
+                with open(path, "rb") as f:
+                    pack.add(appid, changenumber, f.read(), args.delta, sync=False, commit=False)
+                packed.append(path)
+            if index % 100 == 0:
+                # the index rows of a batch are committed once its records
+                # are on disk
+                pack.sync()
+                catalog.db.commit()
+                print("Packed", len(packed), "vdf files", end="\r")
+        # the vdf files are only removed once everything they were packed into
+        # is on disk
+        pack.sync()
+        catalog.db.commit()
+        print("Packed", len(packed), "vdf files into", PACK_FILE, "(%s bytes)" % stat(PACK_FILE).st_size)
+        if not args.keep:
+            for path in packed:
+                remove(path)
+            print("Removed", len(packed), "vdf files")
+        pack.close()
+    else:
+        if not exists(PACK_FILE):
+            print("no appinfo pack at", PACK_FILE)
+            exit(1)
+        pack = AppinfoPack(catalog)
+        makedirs(APPINFO_DIR, exist_ok=True)
+        count = 0
+        for appid, changenumber in catalog.packed_apps():
+            path = appinfo_path(appid, changenumber)
+            if not exists(path):
+                with open(path + ".tmp", "wb") as f:
+                    f.write(pack.read(appid, changenumber))
+                replace(path + ".tmp", path)
+                count += 1
+        pack.close()
+        remove(PACK_FILE)
+        catalog.forget_appinfo_pack()
+        print("Wrote", count, "vdf files to", APPINFO_DIR, "and removed", PACK_FILE)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from time import time
+import sqlite3
+
+QUEUE_FILE = "./archive_queue.sqlite3"
+
+class ArchiveRules():
+    """Which apps get their new manifests archived automatically, and in what
+    order.
+
+    A rules file has one "<appid> [priority] [branch,branch...]" line per app,
+    where "*" as the appid matches every app without a line of its own.
+    Manifests with a higher priority (default 0) are archived first, and only
+    the listed branches are archived (default public). A priority of "skip"
+    excludes the app. Blank lines and lines starting with # are ignored."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.rules = {} # appid or "*" -> (priority, branches), or None to skip
+        with open(filename, "r", encoding="utf-8") as f:
+            for line in f.read().split("\n"):
+                line = line.split("#")[0].split()
+                if not line:
+                    continue
+                key = "*" if line[0] == "*" else int(line[0])
+                if len(line) > 1 and line[1] == "skip":
+                    self.rules[key] = None
+                    continue
+                priority = int(line[1]) if len(line) > 1 else 0
+                branches = tuple(line[2].split(",")) if len(line) > 2 else ("public",)
+                self.rules[key] = (priority, branches)
+    def __repr__(self):
+        return f"Archive rules {self.filename} ({len(self.rules)} rules)"
+    def match(self, appid):
+        """Returns (priority, branches) for an app, or None if it isn't
+        archived."""
+        if appid in self.rules:
+            return self.rules[appid]
+        return self.rules.get("*")
+
+def manifest_changes(old, new, branches=("public",)):
+    """Compares two summarized appinfos of an app (see appinfo.load_appinfo;
+    old is {} if there's no previous one) and returns (depot, manifest, name)
+    for every manifest of the given branches that's in new but not in old."""
+    def manifests(appinfo):
+        found = {}
+        for depot, depotinfo in appinfo.get("depots", {}).items():
+            if not depot.isdigit() or not isinstance(depotinfo, dict):
+                continue
+            for branch in branches:
+                manifest = depotinfo.get("manifests", {}).get(branch)
+                if manifest:
+                    gid = int(manifest["gid"]) if isinstance(manifest, dict) else int(manifest)
+                    found[(int(depot), gid)] = depotinfo.get("name", "unknown")
+        return found
+    before = manifests(old)
+    return [(depot, manifest, name) for (depot, manifest), name in manifests(new).items() if (depot, manifest) not in before]
+
+class ArchiveQueue():
+    """SQLite queue of manifests waiting to be archived, so queued work
+    survives the process that queued it.
+
+    A manifest is pending until a worker claims it, then active until it's
+    archived (removed from the queue) or fails. Failed manifests go back to
+    pending until they've failed max_attempts times. Manifests that were
+    active when a previous process stopped are pending again on open."""
+    def __init__(self, filename=QUEUE_FILE, max_attempts=3):
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS queue (depot INTEGER, manifest INTEGER, appid INTEGER, name TEXT, priority INTEGER, state TEXT, attempts INTEGER, added REAL, error TEXT, PRIMARY KEY (depot, manifest))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS queue_by_priority ON queue (state, priority DESC, added)")
+        self.db.execute("UPDATE queue SET state = 'pending' WHERE state = 'active'")
+        self.db.commit()
+    def __repr__(self):
+        counts = self.counts()
+        return f"Archive queue {self.filename} ({', '.join('%s %s' % (count, state) for state, count in counts.items()) or 'empty'})"
+    def add(self, appid, depot, manifest, name="unknown", priority=0):
+        """Queues a manifest. Returns False if it was already queued (its
+        priority is raised if the new one is higher)."""
+        cursor = self.db.execute("INSERT OR IGNORE INTO queue VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, NULL)", (depot, manifest, appid, name, priority, time()))
+        if not cursor.rowcount:
+            self.db.execute("UPDATE queue SET priority = MAX(priority, ?) WHERE depot = ? AND manifest = ?", (priority, depot, manifest))
+        self.db.commit()
+        return bool(cursor.rowcount)
+    def claim(self):
+        """Marks the most urgent pending manifest active and returns (appid,
+        depot, manifest, name), or None if nothing is pending."""
+        row = self.db.execute("SELECT appid, depot, manifest, name FROM queue WHERE state = 'pending' ORDER BY priority DESC, added LIMIT 1").fetchone()
+        if row:
+            self.db.execute("UPDATE queue SET state = 'active' WHERE depot = ? AND manifest = ?", (row[1], row[2]))
+            self.db.commit()
+        return row
+    def done(self, depot, manifest):
+        self.db.execute("DELETE FROM queue WHERE depot = ? AND manifest = ?", (depot, manifest))
+        self.db.commit()
+    def failed(self, depot, manifest, error):
+        """Records a failed attempt. Returns True if the manifest will be
+        retried."""
+        self.db.execute("UPDATE queue SET attempts = attempts + 1, error = ?, state = CASE WHEN attempts + 1 < ? THEN 'pending' ELSE 'failed' END WHERE depot = ? AND manifest = ?", (str(error), self.max_attempts, depot, manifest))
+        self.db.commit()
+        return self.db.execute("SELECT state FROM queue WHERE depot = ? AND manifest = ?", (depot, manifest)).fetchone()[0] == "pending"
+    def retry_failed(self):
+        cursor = self.db.execute("UPDATE queue SET state = 'pending', attempts = 0 WHERE state = 'failed'")
+        self.db.commit()
+        return cursor.rowcount
+    def counts(self):
+        return dict(self.db.execute("SELECT state, COUNT(*) FROM queue GROUP BY state ORDER BY state"))
+    def pending(self):
+        return self.counts().get("pending", 0)
+    def close(self):
+        self.db.close()
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Show the queue of manifests waiting to be archived by update_appinfo.py --archive.')
+    parser.add_argument('--queue', help="path to the archive queue (default %s)" % QUEUE_FILE, default=QUEUE_FILE)
+    parser.add_argument('--retry-failed', help="queue manifests that failed every attempt again", action="store_true")
+    args = parser.parse_args()
+    queue = ArchiveQueue(args.queue)
+    if args.retry_failed:
+        print("Queued", queue.retry_failed(), "failed manifests again")
+    print(queue)
+    for depot, manifest, appid, name, priority, state, attempts, error in queue.db.execute("SELECT depot, manifest, appid, name, priority, state, attempts, error FROM queue ORDER BY state, priority DESC, added"):
+        print("%s\tapp %s depot %s (%s) gid %s, priority %s%s" % (state, appid, depot, name, manifest, priority, ", %s failed attempts: %s" % (attempts, error) if attempts else ""))
+    queue.close()
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from base64 import b64decode, b64encode
+from json import dumps, loads
+from os import chmod, makedirs, remove, umask
+from os.path import dirname, exists
+from socket import AF_UNIX, SOCK_STREAM, socket
+from threading import Lock
+from time import sleep as time_sleep, time
+from types import SimpleNamespace
+
+BROKER_SOCKET = "./auth/broker.sock"
+
+if __name__ == "__main__": # exit before we import our shit if the args are wrong
+    parser = ArgumentParser(description='Keep one logged in Steam session open and share it with the other scripts over a Unix socket (%s), so they don\'t each have to connect and log in. Scripts use the broker whenever it\'s running.' % BROKER_SOCKET)
+    parser.add_argument("-i", help="Log into a Steam account interactively.", dest="interactive", action="store_true")
+    parser.add_argument("-u", type=str, help="Username for non-interactive login", dest="username", nargs="?")
+    parser.add_argument("-p", type=str, help="Password for non-interactive login", dest="password", nargs="?")
+    parser.add_argument("-w", type=int, help="Maximum number of PICS or depot key requests to have in flight at once (default 16)", dest="window", default=16)
+    parser.add_argument("--socket", type=str, help="Path of the socket to listen on (default %s)" % BROKER_SOCKET, default=BROKER_SOCKET)
+    parser.add_argument("--fake", help="Don't connect to Steam: answer from the local appinfo and depot keys instead, for testing scripts offline", action="store_true")
+    args = parser.parse_args()
+
+from gevent import sleep, spawn
+from gevent.pool import Pool
+from gevent.event import AsyncResult, Event
+from gevent.lock import Semaphore
+from steam.core.msg.unified import get_um
+from steam.enums import EResult, EType
+from steam.exceptions import SteamError
+from pics import ProductInfoFetcher, app_groups, changes_since
+
+# how long answers stay cached by the broker, in seconds. depot keys never
+# change; manifest request codes are good for a few minutes
+DEPOT_KEY_TTL = 7 * 24 * 3600
+REQUEST_CODE_TTL = 120
+TOKEN_TTL = 600
+SESSION_TTL = 60
+# how long the broker waits for more product info requests to add to a batch
+COALESCE_DELAY = 0.05
+# the most apps the broker asks PICS for in one batch
+MAX_BATCH = 3000
+# what clients may call
+METHODS = ("session", "send_um", "access_tokens", "product_info", "request_free_license", "depot_key", "depot_keys", "pics_changes", "pics_product_info")
+
+class SteamBackend():
+    """Answers broker requests with a logged in SteamClient. Reconnects and
+    logs in again whenever the connection drops."""
+    def __init__(self, steam_client, window=16):
+        self.steam_client = steam_client
+        self.anonymous = steam_client.steam_id.type == EType.AnonUser
+        self.fetcher = ProductInfoFetcher(steam_client, window=min(4, window), max_window=window)
+        steam_client.on(steam_client.EVENT_DISCONNECTED, self.reconnect)
+    def __repr__(self):
+        return f"Steam backend ({'anonymous' if self.anonymous else self.steam_client.username}, {self.fetcher})"
+    def reconnect(self):
+        print("\033[31mDisconnected from Steam, reconnecting...\033[0m")
+        if not self.steam_client.reconnect(maxdelay=30):
+            return
+        if self.steam_client.relogin_available:
+            self.steam_client.relogin()
+        elif self.anonymous:
+            self.steam_client.anonymous_login()
+        print("Reconnected to Steam")
+    def session(self):
+        return {"cell_id": self.steam_client.cell_id,
+                "steam_id_type": int(self.steam_client.steam_id.type),
+                "username": "anonymous" if self.anonymous else self.steam_client.username,
+                "licenses": [[license.package_id, license.access_token] for license in self.steam_client.licenses.values()]}
+    def send_um(self, name, params, timeout):
+        response = self.steam_client.send_um_and_wait(name, params, timeout=timeout)
+        if response is None:
+            return None
+        return [response.header.eresult, response.header.error_message, b64encode(response.body.SerializeToString()).decode()]
+    def access_tokens(self, app_ids, package_ids):
+        response = self.steam_client.get_access_tokens(app_ids=app_ids, package_ids=package_ids)
+        if not response:
+            return None
+        return {"apps": list(response["apps"].items()), "packages": list(response["packages"].items())}
+    def product_info(self, apps, packages):
+        return self.steam_client.get_product_info(apps=apps, packages=packages)
+    def request_free_license(self, app_ids):
+        result, apps, packages = self.steam_client.request_free_license(app_ids)
+        return [int(result), list(apps), list(packages)]
+    def depot_key(self, app_id, depot_id):
+        msg = self.steam_client.get_depot_key(app_id, depot_id)
+        if msg is None:
+            return None
+        return [msg.eresult, msg.depot_encryption_key.hex()]
+    def pics_changes(self, since, app_changes):
+        response = changes_since(self.steam_client, since, app_changes)
+        if response is None:
+            return None
+        return {"current_change_number": response.current_change_number,
+                "force_full_app_update": response.force_full_app_update,
+                "app_changes": [[change.appid, change.change_number, change.needs_token] for change in response.app_changes]}
+    def pics_product_info(self, appids, tokens):
+        """Returns ({appid: [change_number, buffer, missing_token]} for the
+        apps PICS answered for, the appids in groups that failed every
+        retry)."""
+        found = {}
+        def on_apps(apps):
+            for app in apps:
+                found[app.appid] = [app.change_number, b64encode(app.buffer).decode(), app.missing_token]
+        self.fetcher.tokens = tokens
+        failed = self.fetcher.fetch(app_groups(appids), on_apps)
+        return found, [appid for group in failed for appid in group]
+
+class FakeBackend():
+    """Answers broker requests from what's already archived: appinfo from the
+    catalog and depot keys from the key store. Every app is at the last
+    changenumber we have for it, there are no licenses and manifest request
+    codes are 0."""
+    def __init__(self, catalog, keystore):
+        self.catalog = catalog
+        self.keystore = keystore
+    def __repr__(self):
+        return f"Fake backend ({len(self.catalog.latest_changenumbers())} apps, {len(self.keystore)} depot keys)"
+    def session(self):
+        return {"cell_id": 0, "steam_id_type": int(EType.AnonUser), "username": "anonymous", "licenses": []}
+    def send_um(self, name, params, timeout):
+        if name == "ContentServerDirectory.GetManifestRequestCode#1":
+            body = get_um(name, response=True)(manifest_request_code=0)
+            return [EResult.OK, "", b64encode(body.SerializeToString()).decode()]
+        return [EResult.Fail, "not supported by the fake broker", ""]
+    def access_tokens(self, app_ids, package_ids):
+        return {"apps": [], "packages": []}
+    def product_info(self, apps, packages):
+        from appinfo import parse_appinfo, read_appinfo
+        latest = self.catalog.latest_changenumbers()
+        found = {}
+        for appid in apps:
+            appid = appid["appid"] if isinstance(appid, dict) else appid
+            if appid in latest:
+                found[appid] = parse_appinfo(read_appinfo(appid, latest[appid], self.catalog))
+        return {"apps": found, "packages": {}}
+    def request_free_license(self, app_ids):
+        return [int(EResult.Fail), [], []]
+    def depot_key(self, app_id, depot_id):
+        self.keystore.refresh()
+        key = self.keystore.get(depot_id)
+        return [EResult.OK, key.hex()] if key else [EResult.AccessDenied, ""]
+    def pics_changes(self, since, app_changes):
+        latest = self.catalog.latest_changenumbers()
+        return {"current_change_number": max(latest.values(), default=0),
+                "force_full_app_update": False,
+                "app_changes": [[appid, change, False] for appid, change in latest.items() if change > since] if app_changes else []}
+    def pics_product_info(self, appids, tokens):
+        from appinfo import read_appinfo
+        latest = self.catalog.latest_changenumbers()
+        return {appid: [latest[appid], b64encode(read_appinfo(appid, latest[appid], self.catalog) + b"\0").decode(), False]
+                for appid in appids if appid in latest}, []
+
+class Broker():
+    """Serves a backend's answers to newline separated JSON requests
+    ({"id", "method", "params"}, answered with {"id", "result"} or {"id",
+    "error"}) on a Unix socket.
+
+    Identical requests that arrive while one is in flight share its answer,
+    and depot keys, manifest request codes and access tokens are cached.
+    Product info requests are coalesced per app: apps asked for within
+    COALESCE_DELAY of each other go to PICS in one batch, and an app that's
+    already being fetched isn't asked for again. Batches of depot keys are
+    asked for up to window at a time."""
+    def __init__(self, backend, path=BROKER_SOCKET, window=16):
+        self.backend = backend
+        self.path = path
+        self.window = window
+        self.inflight = {} # request key -> AsyncResult
+        self.cache = {} # request key -> (expiry, result)
+        self.apps = {} # appid -> AsyncResult of an app being fetched
+        self.app_queue = [] # appids waiting for the next batch
+        self.app_tokens = {}
+        self.app_queued = Event()
+        self.requests = 0
+        self.deduplicated = 0
+        self.cached = 0
+        self.batches = 0
+    def __repr__(self):
+        return f"Steam broker on {self.path} ({self.requests} requests, {self.deduplicated} deduplicated, {self.cached} cached, {self.batches} product info batches)"
+    def cache_ttl(self, method, params, result):
+        if result is None:
+            return None
+        if method == "depot_key" and result[0] == EResult.OK:
+            return DEPOT_KEY_TTL
+        if method == "send_um" and params["name"] == "ContentServerDirectory.GetManifestRequestCode#1" and result[0] == EResult.OK:
+            return REQUEST_CODE_TTL
+        if method == "access_tokens":
+            return TOKEN_TTL
+        if method == "session":
+            return SESSION_TTL
+        return None
+    def call(self, method, params):
+        self.requests += 1
+        if method not in METHODS:
+            raise ValueError("unknown method " + repr(method))
+        if method == "pics_product_info":
+            return self.product_info(**params)
+        if method == "depot_keys":
+            return self.depot_keys(**params)
+        key = dumps([method, params], sort_keys=True)
+        cached = self.cache.get(key)
+        if cached and cached[0] > time():
+            self.cached += 1
+            return cached[1]
+        if key in self.inflight:
+            self.deduplicated += 1
+            return self.inflight[key].get()
+        self.inflight[key] = result = AsyncResult()
+        try:
+            value = getattr(self.backend, method)(**params)
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        finally:
+            del self.inflight[key]
+        ttl = self.cache_ttl(method, params, value)
+        if ttl:
+            self.cache[key] = (time() + ttl, value)
+        result.set(value)
+        return value
+    def product_info(self, appids, tokens):
+        self.app_tokens.update({int(appid): token for appid, token in tokens.items()})
+        waiting = {}
+        for appid in appids:
+            if appid in self.apps:
+                self.deduplicated += 1
+            else:
+                self.apps[appid] = AsyncResult()
+                self.app_queue.append(appid)
+            waiting[appid] = self.apps[appid]
+        self.app_queued.set()
+        found, failed = {}, []
+        for appid, result in waiting.items():
+            try:
+                app = result.get()
+            except SteamError:
+                failed.append(appid)
+                continue
+            if app:
+                found[appid] = app
+        return {"apps": found, "failed": failed}
+    def depot_keys(self, requests):
+        """Returns the answer to depot_key for each [app_id, depot_id], or None
+        for the ones that failed. Each key goes through call(), so it's cached
+        and shared with single depot_key requests."""
+        def depot_key(request):
+            try:
+                return self.call("depot_key", {"app_id": request[0], "depot_id": request[1]})
+            except Exception:
+                return None
+        return Pool(self.window).map(depot_key, requests)
+    def fetch_batches(self):
+        """Sends the queued product info requests to the backend, one batch at
+        a time, forever."""
+        while True:
+            self.app_queued.wait()
+            sleep(COALESCE_DELAY)
+            batch, self.app_queue = self.app_queue[:MAX_BATCH], self.app_queue[MAX_BATCH:]
+            if not self.app_queue:
+                self.app_queued.clear()
+            if not batch:
+                continue
+            self.batches += 1
+            try:
+                found, failed = self.backend.pics_product_info(batch, {appid: self.app_tokens[appid] for appid in batch if appid in self.app_tokens})
+            except Exception as e:
+                print("\033[31mError getting product info for %s apps:\033[0m %r" % (len(batch), e))
+                found, failed = {}, batch
+            failed = set(failed)
+            for appid in batch:
+                if appid in failed:
+                    self.apps.pop(appid).set_exception(SteamError("no product info for app %s" % appid, EResult.Timeout))
+                else:
+                    # apps PICS answered without info for (unknown apps) come
+                    # back empty
+                    self.apps.pop(appid).set(found.get(appid))
+    def handle(self, connection, address):
+        lock = Semaphore()
+        lines = connection.makefile("rb")
+        def answer(request):
+            try:
+                response = {"id": request["id"], "result": self.call(request["method"], request.get("params", {}))}
+            except Exception as e:
+                response = {"id": request["id"], "error": "%s: %s" % (type(e).__name__, e)}
+            with lock:
+                connection.sendall(dumps(response).encode() + b"\n")
+        for line in lines:
+            try:
+                request = loads(line)
+            except ValueError:
+                continue
+            spawn(answer, request)
+        lines.close()
+    def serve(self):
+        from gevent.server import StreamServer
+        from gevent.socket import socket as gevent_socket
+        makedirs(dirname(self.path) or ".", exist_ok=True)
+        if exists(self.path):
+            remove(self.path) # left behind by a broker that didn't exit cleanly
+        listener = gevent_socket(AF_UNIX, SOCK_STREAM)
+        # anyone who can connect can use the logged in account, so only we
+        # can, from the moment the socket exists
+        old_umask = umask(0o177)
+        try:
+            listener.bind(self.path)
+        finally:
+            umask(old_umask)
+        chmod(self.path, 0o600)
+        listener.listen(64)
+        spawn(self.fetch_batches)
+        server = StreamServer(listener, self.handle)
+        try:
+            server.serve_forever()
+        finally:
+            server.close()
+            if exists(self.path):
+                remove(self.path)
+
+class BrokerClient():
+    """Talks to a running broker. Has the parts of SteamClient's interface the
+    scripts and CDNClient use, so it can be used in place of one; scripts that
+    talk to PICS directly check for `brokered` and go through
+    pics.changes_since and ProductInfoFetcher instead."""
+    brokered = True
+    logged_on = True
+    def __init__(self, path=BROKER_SOCKET, timeout=600):
+        self.path = path
+        self.lock = Lock()
+        self.last_id = 0
+        self.connection = socket(AF_UNIX, SOCK_STREAM)
+        self.connection.settimeout(timeout)
+        self.connection.connect(path)
+        self.lines = self.connection.makefile("rb")
+        session = self.call("session")
+        self.cell_id = session["cell_id"]
+        self.steam_id = SimpleNamespace(type=EType(session["steam_id_type"]))
+        self.username = session["username"]
+        self.licenses = {package_id: SimpleNamespace(package_id=package_id, access_token=token) for package_id, token in session["licenses"]}
+    def __repr__(self):
+        return f"Steam broker client on {self.path} ({self.username})"
+    def call(self, method, **params):
+        with self.lock:
+            self.last_id += 1
+            self.connection.sendall(dumps({"id": self.last_id, "method": method, "params": params}).encode() + b"\n")
+            while True:
+                line = self.lines.readline()
+                if not line:
+                    raise ConnectionError("the Steam broker closed the connection")
+                response = loads(line)
+                if response["id"] == self.last_id:
+                    break
+        if "error" in response:
+            raise SteamError("Steam broker: " + response["error"])
+        return response["result"]
+    def sleep(self, seconds):
+        time_sleep(seconds)
+    def disconnect(self):
+        self.lines.close()
+        self.connection.close()
+    def logout(self):
+        self.disconnect()
+    def send_um_and_wait(self, method_name, params=None, timeout=10, raises=False):
+        response = self.call("send_um", name=method_name, params=params or {}, timeout=timeout)
+        if response is None:
+            if raises:
+                raise SteamError("%s timed out" % method_name, EResult.Timeout)
+            return None
+        eresult, error_message, body = response
+        if raises and eresult != EResult.OK:
+            raise SteamError(error_message or "%s failed" % method_name, EResult(eresult))
+        message = get_um(method_name, response=True)()
+        message.ParseFromString(b64decode(body))
+        return SimpleNamespace(header=SimpleNamespace(eresult=eresult, error_message=error_message), body=message)
+    def get_access_tokens(self, app_ids=[], package_ids=[]):
+        response = self.call("access_tokens", app_ids=list(app_ids), package_ids=list(package_ids))
+        if response is None:
+            return None
+        return {"apps": dict(response["apps"]), "packages": dict(response["packages"])}
+    def get_product_info(self, apps=[], packages=[], meta_data_only=False, raw=False, auto_access_tokens=True, timeout=15):
+        response = self.call("product_info", apps=list(apps), packages=list(packages))
+        # json turned the ids into strings
+        return {kind: {int(key): value for key, value in response[kind].items()} for kind in ("apps", "packages")}
+    def request_free_license(self, app_ids):
+        result, apps, packages = self.call("request_free_license", app_ids=list(app_ids))
+        return EResult(result), apps, packages
+    def get_depot_key(self, app_id, depot_id):
+        response = self.call("depot_key", app_id=app_id, depot_id=depot_id)
+        if response is None:
+            return None
+        return SimpleNamespace(eresult=response[0], depot_encryption_key=bytes.fromhex(response[1]))
+    def get_depot_keys(self, requests):
+        """Returns what get_depot_key would for each (app_id, depot_id), asked
+        for in one round trip."""
+        return [None if response is None else SimpleNamespace(eresult=response[0], depot_encryption_key=bytes.fromhex(response[1]))
+                for response in self.call("depot_keys", requests=[list(request[:2]) for request in requests])]
+    def pics_changes(self, since, app_changes=True):
+        response = self.call("pics_changes", since=since, app_changes=app_changes)
+        if response is None:
+            return None
+        response["app_changes"] = [SimpleNamespace(appid=appid, change_number=change_number, needs_token=needs_token)
+                for appid, change_number, needs_token in response["app_changes"]]
+        return SimpleNamespace(**response)
+    def pics_product_info(self, appids, tokens={}):
+        """Returns (product info for every app the broker got it for, shaped
+        like the apps of a ClientPICSProductInfoResponse, the appids it
+        couldn't get an answer from PICS for)."""
+        response = self.call("pics_product_info", appids=list(appids), tokens={str(appid): token for appid, token in tokens.items() if appid in appids})
+        return [SimpleNamespace(appid=int(appid), change_number=change_number, buffer=b64decode(buffer), missing_token=missing_token)
+                for appid, (change_number, buffer, missing_token) in response["apps"].items()], response["failed"]
+
+def connect_broker(path=BROKER_SOCKET):
+    """Returns a BrokerClient if a broker is running on path, otherwise
+    None."""
+    if not exists(path):
+        return None
+    try:
+        return BrokerClient(path)
+    except OSError: # a socket left behind by a broker that's gone
+        return None
+
+if __name__ == "__main__":
+    if connect_broker(args.socket):
+        print("\033[31mA broker is already running on %s\033[0m" % args.socket)
+        exit(1)
+    if args.fake:
+        from catalog import Catalog
+        from keystore import KeyStore, INDEX_FILE
+        backend = FakeBackend(Catalog(), KeyStore(index=INDEX_FILE))
+    else:
+        from steam.client import SteamClient
+        from login import auto_login
+        steam_client = SteamClient()
+        print("Connecting to the Steam network...")
+        steam_client.connect()
+        print("Logging in...")
+        if args.interactive:
+            auto_login(steam_client, fallback_anonymous=False, relogin=False)
+        elif args.username:
+            auto_login(steam_client, args.username, args.password)
+        else:
+            auto_login(steam_client)
+        backend = SteamBackend(steam_client, args.window)
+    print(backend)
+    broker = Broker(backend, args.socket, args.window)
+    print("Listening on", args.socket)
+    try:
+        broker.serve()
+    except KeyboardInterrupt:
+        pass
+    print(broker)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from binascii import unhexlify
+from glob import glob
+from os import scandir
+from os.path import exists
+from time import time
+import sqlite3
+
+CATALOG_FILE = "./catalog.sqlite3"
+# how long to wait for another process's write to the catalog, in seconds
+CATALOG_TIMEOUT = 60
+# how many new manifests a depot scan records per transaction
+SCAN_COMMIT_MANIFESTS = 16
+
+if __name__ == "__main__": # exit before we import our shit if the args are wrong
+    parser = ArgumentParser(description='Print a summary of the archive catalog, or rebuild it from the files on disk.')
+    parser.add_argument('--catalog', help="path to the catalog (default %s)" % CATALOG_FILE, default=CATALOG_FILE)
+    parser.add_argument('--rebuild', help="rescan ./appinfo, every depot in ./depots, and the chunkstores given with -c", action="store_true")
+    parser.add_argument('-c', dest="chunkstores", help="with --rebuild, directory to scan for .csd/.csm chunkstores (can be used multiple times)", action="append", default=[])
+    args = parser.parse_args()
+
+from steam.core.manifest import DepotManifest
+
+class Catalog():
+    """SQLite catalog of what's in the archive: appinfo changenumbers, the
+    chunks each downloaded manifest needs, and where each chunk is stored.
+
+    Chunk locations are the loose chunk path (offset NULL), or a .csd path
+    with the chunk's offset and length. The scripts that write to the archive
+    keep the catalog up to date as they go; a depot's loose files and
+    manifests are scanned the first time the depot is looked up, so the
+    catalog can be started on an existing archive.
+
+    Several scripts (and archive workers) use the catalog at once, so it's
+    kept in WAL mode, where readers don't wait for writers, and writers wait
+    up to CATALOG_TIMEOUT for each other."""
+    def __init__(self, filename=CATALOG_FILE):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=CATALOG_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS appinfo (appid INTEGER, changenumber INTEGER, PRIMARY KEY (appid, changenumber))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS appinfo_by_changenumber ON appinfo (changenumber)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS scans (name TEXT PRIMARY KEY, scanned REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS packed_appinfo (appid INTEGER, changenumber INTEGER, sha BLOB, PRIMARY KEY (appid, changenumber))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS appinfo_blobs (sha BLOB PRIMARY KEY, offset INTEGER, length INTEGER, base BLOB, depth INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS parsed_appinfo (appid INTEGER, changenumber INTEGER, size INTEGER, mtime_ns INTEGER, data BLOB, PRIMARY KEY (appid, changenumber))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS depots (depot INTEGER PRIMARY KEY, scanned REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS manifests (depot INTEGER, manifest INTEGER, creation_time INTEGER, PRIMARY KEY (depot, manifest))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS manifest_chunks (depot INTEGER, manifest INTEGER, sha BLOB, PRIMARY KEY (depot, manifest, sha)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks (depot INTEGER, sha BLOB, location TEXT, offset INTEGER, length INTEGER, PRIMARY KEY (depot, sha, location))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_by_location ON chunks (location)")
+        self.db.commit()
+    def __repr__(self):
+        counts = [self.db.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0] for table in ("appinfo", "manifests", "chunks")]
+        return f"Catalog {self.filename} ({counts[0]} appinfo changes, {counts[1]} manifests, {counts[2]} chunk locations)"
+
+    def add_appinfo(self, appid, changenumber):
+        self.db.execute("INSERT OR IGNORE INTO appinfo VALUES (?, ?)", (appid, changenumber))
+        self.db.commit()
+    def ensure_appinfo(self):
+        if not self.db.execute("SELECT 1 FROM scans WHERE name = 'appinfo'").fetchone():
+            self.scan_appinfo()
+    def changenumbers(self, appid):
+        """Returns the changenumbers downloaded for an app, oldest first."""
+        self.ensure_appinfo()
+        return [change for change, in self.db.execute("SELECT changenumber FROM appinfo WHERE appid = ? ORDER BY changenumber", (appid,))]
+    def latest_changenumber(self, appid):
+        """Returns the highest changenumber downloaded for an app, or None."""
+        self.ensure_appinfo()
+        return self.db.execute("SELECT MAX(changenumber) FROM appinfo WHERE appid = ?", (appid,)).fetchone()[0]
+    def latest_changenumbers(self):
+        """Returns {appid: highest changenumber downloaded} for every app."""
+        self.ensure_appinfo()
+        return dict(self.db.execute("SELECT appid, MAX(changenumber) FROM appinfo GROUP BY appid"))
+    def max_changenumber(self):
+        """Returns the highest changenumber downloaded for any app, or 0."""
+        self.ensure_appinfo()
+        return self.db.execute("SELECT MAX(changenumber) FROM appinfo").fetchone()[0] or 0
+    def appids(self):
+        self.ensure_appinfo()
+        return [appid for appid, in self.db.execute("SELECT DISTINCT appid FROM appinfo ORDER BY appid")]
+    def packed_appinfo(self, appid, changenumber):
+        """Returns the sha of an app's appinfo in the appinfo pack, or None."""
+        row = self.db.execute("SELECT sha FROM packed_appinfo WHERE appid = ? AND changenumber = ?", (appid, changenumber)).fetchone()
+        return bytes(row[0]) if row else None
+    def packed_predecessor(self, appid, changenumber):
+        """Returns the sha of the newest packed appinfo of an app older than
+        changenumber, or None."""
+        row = self.db.execute("SELECT sha FROM packed_appinfo WHERE appid = ? AND changenumber < ? ORDER BY changenumber DESC LIMIT 1", (appid, changenumber)).fetchone()
+        return bytes(row[0]) if row else None
+    def appinfo_blob(self, sha):
+        """Returns (offset, length, base sha, delta depth) of a blob in the
+        appinfo pack, or None."""
+        row = self.db.execute("SELECT offset, length, base, depth FROM appinfo_blobs WHERE sha = ?", (sha,)).fetchone()
+        return (row[0], row[1], bytes(row[2]) if row[2] else None, row[3]) if row else None
+    def add_appinfo_blob(self, sha, offset, length, base, depth):
+        self.db.execute("INSERT OR REPLACE INTO appinfo_blobs VALUES (?, ?, ?, ?, ?)", (sha, offset, length, base, depth))
+    def pack_appinfo(self, appid, changenumber, sha, commit=True):
+        self.db.execute("INSERT OR REPLACE INTO packed_appinfo VALUES (?, ?, ?)", (appid, changenumber, sha))
+        self.db.execute("INSERT OR IGNORE INTO appinfo VALUES (?, ?)", (appid, changenumber))
+        self.db.execute("DELETE FROM parsed_appinfo WHERE appid = ? AND changenumber = ?", (appid, changenumber))
+        if commit:
+            self.db.commit()
+    def packed_apps(self):
+        return [row for row in self.db.execute("SELECT appid, changenumber FROM packed_appinfo ORDER BY appid, changenumber")]
+    def forget_appinfo_pack(self):
+        with self.db:
+            self.db.execute("DELETE FROM packed_appinfo")
+            self.db.execute("DELETE FROM appinfo_blobs")
+            self.db.execute("DELETE FROM parsed_appinfo")
+    def cached_appinfo(self, appid, changenumber):
+        """Returns (size, mtime_ns, data) of a cached parsed appinfo, or
+        None."""
+        row = self.db.execute("SELECT size, mtime_ns, data FROM parsed_appinfo WHERE appid = ? AND changenumber = ?", (appid, changenumber)).fetchone()
+        return (row[0], row[1], bytes(row[2])) if row else None
+    def cache_appinfo(self, appid, changenumber, size, mtime_ns, data):
+        self.db.execute("INSERT OR REPLACE INTO parsed_appinfo VALUES (?, ?, ?, ?, ?)", (appid, changenumber, size, mtime_ns, data))
+        self.db.commit()
+    def uncache_appinfo(self, appid, changenumber):
+        self.db.execute("DELETE FROM parsed_appinfo WHERE appid = ? AND changenumber = ?", (appid, changenumber))
+        self.db.commit()
+    def scan_appinfo(self, path="./appinfo"):
+        """Rebuilds the appinfo index in one pass over the appinfo folder."""
+        rows = []
+        if exists(path):
+            for entry in scandir(path):
+                if not entry.name.endswith(".vdf"):
+                    continue
+                name = entry.name[:-4].split("_")
+                try:
+                    rows.append((int(name[0]), int(name[1])))
+                except (ValueError, IndexError):
+                    pass
+        with self.db:
+            self.db.execute("DELETE FROM appinfo")
+            self.db.executemany("INSERT OR IGNORE INTO appinfo VALUES (?, ?)", rows)
+            self.db.execute("INSERT OR IGNORE INTO appinfo SELECT appid, changenumber FROM packed_appinfo")
+            self.db.execute("INSERT OR REPLACE INTO scans VALUES ('appinfo', ?)", (time(),))
+
+    def add_manifest(self, manifest, commit=True):
+        """Records which chunks a DepotManifest needs."""
+        self.db.execute("DELETE FROM manifest_chunks WHERE depot = ? AND manifest = ?", (manifest.depot_id, manifest.gid))
+        self.db.execute("INSERT OR REPLACE INTO manifests VALUES (?, ?, ?)", (manifest.depot_id, manifest.gid, manifest.creation_time))
+        self.db.executemany("INSERT OR IGNORE INTO manifest_chunks VALUES (?, ?, ?)", ((manifest.depot_id, manifest.gid, chunk.sha) for file in manifest.payload.mappings for chunk in file.chunks))
+        if commit:
+            self.db.commit()
+    def manifest(self, depot, manifest):
+        """Returns (creation time, chunks needed, chunks stored) for a
+        manifest, or None if it isn't downloaded."""
+        self.ensure_depot(depot)
+        row = self.db.execute("SELECT creation_time FROM manifests WHERE depot = ? AND manifest = ?", (depot, manifest)).fetchone()
+        if not row:
+            return None
+        total, stored = self.db.execute("SELECT COUNT(*), COUNT(stored.sha) FROM manifest_chunks AS needed LEFT JOIN (SELECT DISTINCT sha FROM chunks WHERE depot = ?) AS stored ON stored.sha = needed.sha WHERE needed.depot = ? AND needed.manifest = ?", (depot, depot, manifest)).fetchone()
+        return row[0], total, stored
+    def manifests(self, depot):
+        self.ensure_depot(depot)
+        return [manifest for manifest, in self.db.execute("SELECT manifest FROM manifests WHERE depot = ? ORDER BY creation_time", (depot,))]
+    def missing_chunks(self, depot, manifest):
+        """Returns the chunks a manifest needs that aren't stored anywhere."""
+        self.ensure_depot(depot)
+        return [bytes(sha) for sha, in self.db.execute("SELECT sha FROM manifest_chunks AS needed WHERE depot = ? AND manifest = ? AND NOT EXISTS (SELECT 1 FROM chunks WHERE chunks.depot = needed.depot AND chunks.sha = needed.sha)", (depot, manifest))]
+
+    def add_chunks(self, depot, chunks):
+        """Records chunk locations, an iterable of (sha, location, offset,
+        length) with offset and length None for loose chunks."""
+        self.db.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)", ((depot, sha, location, offset, length) for sha, location, offset, length in chunks))
+        self.db.commit()
+    def remove_chunks(self, depot, shas, location=None):
+        """Forgets chunks, either everywhere or only in one location (a loose
+        chunk path or a csd)."""
+        if location is None:
+            self.db.executemany("DELETE FROM chunks WHERE depot = ? AND sha = ?", ((depot, sha) for sha in shas))
+        else:
+            self.db.executemany("DELETE FROM chunks WHERE depot = ? AND sha = ? AND location = ?", ((depot, sha, location) for sha in shas))
+        self.db.commit()
+    def add_chunkstore(self, chunkstore):
+        """Records every chunk in an unpacked Chunkstore, replacing what was
+        recorded for its csd before."""
+        self.db.execute("DELETE FROM chunks WHERE location = ?", (chunkstore.csdname,))
+        self.add_chunks(chunkstore.depot, ((sha, chunkstore.csdname, offset, length) for sha, (offset, length) in chunkstore.chunks.items()))
+    def chunk_locations(self, depot, sha):
+        return [(location, offset, length) for location, offset, length in self.db.execute("SELECT location, offset, length FROM chunks WHERE depot = ? AND sha = ?", (depot, sha))]
+
+    def ensure_depot(self, depot):
+        if not self.db.execute("SELECT 1 FROM depots WHERE depot = ?", (depot,)).fetchone():
+            self.scan_depot(depot)
+    def scan_depot(self, depot):
+        """Rescans a depot's folder: loose chunks are replaced with what's on
+        disk, new manifests are read and deleted ones are dropped. New
+        manifests are committed SCAN_COMMIT_MANIFESTS at a time, so a big
+        depot doesn't keep the catalog locked for the whole scan; the depot
+        only counts as scanned once everything is in."""
+        path = "./depots/%s/" % depot
+        loose = []
+        manifest_files = set()
+        if exists(path):
+            for entry in scandir(path):
+                if entry.name.endswith(".zip"):
+                    try:
+                        manifest_files.add(int(entry.name[:-4]))
+                    except ValueError:
+                        pass
+                    continue
+                name = entry.name.replace("_decrypted", "")
+                if len(name) != 40:
+                    continue
+                try:
+                    loose.append((unhexlify(name), path + entry.name, None, None))
+                except ValueError:
+                    pass
+        known = set(self.manifests_in_db(depot))
+        for count, manifest in enumerate(sorted(manifest_files - known), 1):
+            with open(path + "%s.zip" % manifest, "rb") as f:
+                self.add_manifest(DepotManifest(f.read()), commit=count % SCAN_COMMIT_MANIFESTS == 0)
+        for manifest in known - manifest_files:
+            self.db.execute("DELETE FROM manifests WHERE depot = ? AND manifest = ?", (depot, manifest))
+            self.db.execute("DELETE FROM manifest_chunks WHERE depot = ? AND manifest = ?", (depot, manifest))
+        self.db.execute("DELETE FROM chunks WHERE depot = ? AND offset IS NULL", (depot,))
+        self.db.execute("INSERT OR REPLACE INTO depots VALUES (?, ?)", (depot, time()))
+        self.add_chunks(depot, loose)
+    def manifests_in_db(self, depot):
+        return [manifest for manifest, in self.db.execute("SELECT manifest FROM manifests WHERE depot = ?", (depot,))]
+    def close(self):
+        self.db.close()
+
+if __name__ == "__main__":
+    catalog = Catalog(args.catalog)
+    if args.rebuild:
+        from chunkstore import Chunkstore
+        if exists("./appinfo"):
+            print("Scanning appinfo...")
+            catalog.scan_appinfo()
+        if exists("./depots"):
+            for entry in sorted(scandir("./depots"), key = lambda entry: entry.name):
+                if entry.is_dir() and entry.name.isdigit():
+                    print("Scanning depot", entry.name)
+                    catalog.scan_depot(int(entry.name))
+        for directory in args.chunkstores:
+            for csm in sorted(glob(directory.rstrip("/") + "/*.csm")):
+                print("Scanning chunkstore", csm)
+                chunkstore = Chunkstore(csm)
+                chunkstore.unpack()
+                catalog.add_chunkstore(chunkstore)
+    print(catalog)
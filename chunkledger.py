@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from binascii import hexlify
+from time import time
+import sqlite3
+
+LEDGER_FILE = "./validation.sqlite3"
+
+class ChunkLedger():
+    """SQLite record of chunks that have been validated, so unchanged chunks
+    don't need to be decoded again on every run.
+
+    A chunk is identified by depot, sha and location (the loose chunk path, or
+    "<csd>:<offset>:<length>" for chunks in a backup). size, mtime_ns and inode
+    describe the file the chunk was read from when it was validated; if any of
+    them changed, the chunk has to be validated again."""
+    def __init__(self, filename=LEDGER_FILE):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks (depot INTEGER, sha BLOB, location TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, validated REAL, ok INTEGER, PRIMARY KEY (depot, sha, location))")
+        self.db.commit()
+    def __repr__(self):
+        count, = self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()
+        return f"Validation ledger {self.filename} ({count} chunks)"
+    def load(self, depot):
+        """Returns {(sha, location): (size, mtime_ns, inode, validated, ok)} for
+        every chunk of a depot in the ledger."""
+        entries = {}
+        for sha, location, size, mtime_ns, inode, validated, ok in self.db.execute("SELECT sha, location, size, mtime_ns, inode, validated, ok FROM chunks WHERE depot = ?", (depot,)):
+            entries[(bytes(sha), location)] = (size, mtime_ns, inode, validated, ok)
+        return entries
+    @staticmethod
+    def is_fresh(entry, size, mtime_ns, inode, max_age):
+        """Whether a ledger entry proves a chunk good without reading it: it was
+        good, validated less than max_age seconds ago, and its file hasn't
+        changed since."""
+        if not entry:
+            return False
+        entry_size, entry_mtime_ns, entry_inode, validated, ok = entry
+        return bool(ok) and entry_size == size and entry_mtime_ns == mtime_ns and entry_inode == inode and time() - validated < max_age
+    def record(self, depot, results):
+        """Records validation results, an iterable of (sha, location, size,
+        mtime_ns, inode, ok)."""
+        now = time()
+        self.db.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", ((depot, sha, location, size, mtime_ns, inode, now, int(ok)) for sha, location, size, mtime_ns, inode, ok in results))
+        self.db.commit()
+    def forget(self, depot, sha=None):
+        if sha is None:
+            self.db.execute("DELETE FROM chunks WHERE depot = ?", (depot,))
+        else:
+            self.db.execute("DELETE FROM chunks WHERE depot = ? AND sha = ?", (depot, sha))
+        self.db.commit()
+    def close(self):
+        self.db.close()
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Print what the validation ledger knows about a depot.')
+    parser.add_argument('depotid', type=int)
+    parser.add_argument('--ledger', help="path to the validation ledger (default %s)" % LEDGER_FILE, default=LEDGER_FILE)
+    parser.add_argument('--forget', help="remove the depot from the ledger so every chunk is validated again", action="store_true")
+    args = parser.parse_args()
+    ledger = ChunkLedger(args.ledger)
+    if args.forget:
+        ledger.forget(args.depotid)
+        print("Forgot validation results for depot", args.depotid)
+        exit(0)
+    entries = ledger.load(args.depotid)
+    bad = [(sha, location) for (sha, location), entry in entries.items() if not entry[4]]
+    oldest = min((entry[3] for entry in entries.values()), default=None)
+    print(f"Depot {args.depotid}: {len(entries)} chunks in ledger, {len(bad)} bad" + (f", oldest validation {round((time() - oldest) / 86400, 1)} days ago" if oldest else ""))
+    for sha, location in bad:
+        print("bad chunk", hexlify(sha).decode(), location)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+from binascii import hexlify
+from collections import OrderedDict
+from glob import glob
+from hashlib import sha1
+from io import BytesIO
+from os.path import exists
+from struct import unpack
+from zipfile import ZipFile
+import lzma
+
+from Cryptodome.Cipher import AES
+from steam.core.crypto import symmetric_decrypt
+from chunkstore import Chunkstore
+
+def archive_type(decrypted):
+    if decrypted[:2] == b'VZ':
+        return "LZMA"
+    elif decrypted[:2] == b'PK':
+        return "Zip"
+    return None
+
+def decompress_chunk(decrypted, cb_original=None):
+    # VZ chunks are a 12 byte header (magic, timestamp, lzma properties), the
+    # raw lzma stream, then a 10 byte footer (crc, decompressed size, magic)
+    if decrypted[:2] == b'VZ':
+        size = unpack('<I', decrypted[-6:-2])[0] if cb_original is None else cb_original
+        return lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[lzma._decode_filter_properties(lzma.FILTER_LZMA1, decrypted[7:12])]).decompress(decrypted[12:-10])[:size]
+    elif decrypted[:2] == b'PK':
+        zipfile = ZipFile(BytesIO(decrypted))
+        return zipfile.read(zipfile.filelist[0])
+    raise ValueError("unknown archive type " + repr(decrypted[:2]))
+
+def verify_chunk(data, is_encrypted, depotkey, sha):
+    """Fully decodes a chunk as stored on disk and checks it against its SHA-1.
+    Returns None if the chunk is good, or a short description of the problem."""
+    if is_encrypted:
+        if not depotkey:
+            return "encrypted, but no depot key"
+        try:
+            data = symmetric_decrypt(data, depotkey)
+        except ValueError as e:
+            return "decryption failed: %s" % e
+    if not archive_type(data):
+        return "unknown archive type %s" % repr(data[:2])
+    try:
+        decompressed = decompress_chunk(data)
+    except Exception as e:
+        return "decompression failed: %s" % e
+    if sha1(decompressed).digest() != sha:
+        return "sha1 mismatch"
+    return None
+
+def encrypted_size(size):
+    # symmetric_encrypt writes an encrypted IV block, then the PKCS#7 padded
+    # CBC ciphertext
+    return 16 + (size // 16 + 1) * 16
+
+def quick_check_chunk(head, tail, length, is_encrypted, depotkey, cb_compressed, cb_original):
+    """Cheap structural check of a chunk as stored on disk, given its first and
+    last 48 bytes and its length. The length has to match the manifest's
+    cb_compressed, and only the first and last cipher blocks are decrypted to
+    check the archive magic and the declared uncompressed size against
+    cb_original. Returns None if the chunk looks good, or the problem."""
+    if is_encrypted:
+        if length != cb_compressed and length != encrypted_size(cb_compressed):
+            return "length %s doesn't match manifest (%s)" % (length, cb_compressed)
+        if length < 32 or length % 16:
+            return "length %s isn't a whole number of AES blocks" % length
+        if not depotkey:
+            return "encrypted, but no depot key"
+        iv = AES.new(depotkey, AES.MODE_ECB).decrypt(head[:16])
+        first = AES.new(depotkey, AES.MODE_CBC, iv).decrypt(head[16:16 + min(32, length - 16)])
+        blocks = min(2, (length - 16) // 16)
+        previous = iv if length - 16 * blocks == 16 else tail[len(tail) - 16 * blocks - 16:len(tail) - 16 * blocks]
+        last = AES.new(depotkey, AES.MODE_CBC, previous).decrypt(tail[len(tail) - 16 * blocks:])
+        if not 1 <= last[-1] <= 16:
+            return "bad padding"
+        last = last[:-last[-1]]
+    else:
+        if length != cb_compressed and encrypted_size(length) != cb_compressed:
+            return "length %s doesn't match manifest (%s)" % (length, cb_compressed)
+        first, last = head[:32], tail[-32:]
+    kind = archive_type(first)
+    if kind == "LZMA":
+        if last[-2:] != b"zv":
+            return "missing VZ footer"
+        size = unpack('<I', last[-6:-2])[0]
+    elif kind == "Zip":
+        size = unpack('<I', first[22:26])[0] or cb_original # 0 if sizes are in a data descriptor
+    else:
+        return "unknown archive type %s" % repr(first[:2])
+    if size != cb_original:
+        return "declared size %s doesn't match manifest (%s)" % (size, cb_original)
+    return None
+
+class ChunkReader():
+    """Reads chunks for a depot, either from the loose chunk files in
+    ./depots/<depotid>/ or from a .csd/.csm backup."""
+    def __init__(self, depotid, depotkey=None, backup=None):
+        self.depot = depotid
+        self.depotkey = depotkey
+        self.path = "./depots/%s/" % depotid
+        self.chunkstores = {}
+        self.chunks_by_store = {}
+        if backup:
+            for csm in glob(backup.replace("_1.csm","").replace("_1.csd","") + "_*.csm"):
+                chunkstore = Chunkstore(csm)
+                chunkstore.unpack()
+                for chunk in chunkstore.chunks.keys():
+                    self.chunks_by_store[chunk] = csm
+                self.chunkstores[csm] = chunkstore
+        self.backup = bool(backup)
+    def __repr__(self):
+        if self.backup:
+            return f"Depot {self.depot} chunks from {len(self.chunkstores)} chunkstores"
+        return f"Depot {self.depot} chunks from {self.path}"
+    def read(self, sha):
+        """Returns (data, is_encrypted) for a chunk, or raises KeyError if the
+        chunk isn't available."""
+        if self.backup:
+            chunkstore = self.chunkstores[self.chunks_by_store[sha]]
+            return chunkstore.get_chunk(sha), chunkstore.is_encrypted
+        chunkhex = hexlify(sha).decode()
+        if exists(self.path + chunkhex):
+            with open(self.path + chunkhex, "rb") as chunkfile:
+                return chunkfile.read(), True
+        elif exists(self.path + chunkhex + "_decrypted"):
+            with open(self.path + chunkhex + "_decrypted", "rb") as chunkfile:
+                return chunkfile.read(), False
+        raise KeyError(chunkhex)
+    def decrypt(self, sha):
+        data, is_encrypted = self.read(sha)
+        if not is_encrypted:
+            return data
+        if not self.depotkey:
+            raise ValueError("chunk %s is encrypted, but no depot key was specified" % hexlify(sha).decode())
+        return symmetric_decrypt(data, self.depotkey)
+    def decode(self, sha, cb_original=None):
+        return decompress_chunk(self.decrypt(sha), cb_original)
+
+class ChunkCache():
+    """Byte-budgeted LRU cache of decoded chunks keyed by SHA.
+
+    If refcounts (sha -> number of times the chunk will be requested) is given,
+    only chunks that will be requested again are kept, and a chunk is dropped
+    as soon as its last reference has been served."""
+    def __init__(self, max_bytes, refcounts=None):
+        self.max_bytes = max_bytes
+        self.refcounts = refcounts
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    @classmethod
+    def for_chunks(cls, chunks, max_bytes):
+        """Creates a cache for decoding the given manifest chunks in order. The
+        budget is the decoded size of every chunk referenced more than once,
+        capped at max_bytes."""
+        refcounts = {}
+        sizes = {}
+        for chunk in chunks:
+            refcounts[chunk.sha] = refcounts.get(chunk.sha, 0) + 1
+            sizes[chunk.sha] = chunk.cb_original
+        shared = sum(sizes[sha] for sha, count in refcounts.items() if count > 1)
+        return cls(min(max_bytes, shared), refcounts)
+    @classmethod
+    def for_files(cls, files, max_bytes):
+        return cls.for_chunks((chunk for file in files for chunk in file.chunks), max_bytes)
+    def __repr__(self):
+        lookups = self.hits + self.misses
+        rate = round(self.hits / lookups * 100, 2) if lookups else 0
+        return f"chunk cache: {self.hits} hits, {self.misses} misses ({rate}% hit rate), {self.evictions} evictions, peak {round(self.peak_bytes / 1000000, 2)}MB of {round(self.max_bytes / 1000000, 2)}MB"
+    def __contains__(self, sha):
+        return sha in self.entries
+    def get(self, sha, loader):
+        """Returns the decoded chunk for sha, calling loader() to decode it on
+        a cache miss."""
+        remaining = None
+        if self.refcounts is not None and sha in self.refcounts:
+            self.refcounts[sha] -= 1
+            remaining = self.refcounts[sha]
+        if sha in self.entries:
+            self.hits += 1
+            data = self.entries[sha]
+            if remaining == 0:
+                self.discard(sha)
+            else:
+                self.entries.move_to_end(sha)
+            return data
+        self.misses += 1
+        data = loader()
+        if remaining != 0:
+            self.put(sha, data)
+        return data
+    def put(self, sha, data):
+        if len(data) > self.max_bytes or sha in self.entries:
+            return
+        while self.bytes + len(data) > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+        self.entries[sha] = data
+        self.bytes += len(data)
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+    def discard(self, sha):
+        if sha in self.entries:
+            self.bytes -= len(self.entries.pop(sha))
@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
-from asyncio import run, gather, sleep
-from binascii import hexlify
+from asyncio import create_task, run, gather, sleep
+from binascii import hexlify, unhexlify
 from datetime import datetime
 from math import ceil
-from os import makedirs, path, listdir, remove
+from os import makedirs, path, remove, replace
 from sys import argv
 
 if __name__ == "__main__": # exit before we import our shit if the args are wrong
-    parser = ArgumentParser(description='Download Steam content depots for archival. Downloading apps: Specify an app to download all the depots for that app, or an app and depot ID to download the latest version of that depot (or a specific version if the manifest ID is specified.) Downloading workshop items: Use the -w flag to specify the ID of the workshop file to download. Exit code is 0 if all downloads succeeded, or the number of failures if at least one failed.')
+    parser = ArgumentParser(description='Download Steam content depots for archival. Downloading apps: Specify an app to download all the depots for that app, or an app and depot ID to download the latest version of that depot (or a specific version if the manifest ID is specified.) Downloading workshop items: Use the -w flag to specify the IDs of the workshop files or collections to download, or -f to read them from a file. Exit code is 0 if all downloads succeeded, or the number of failures if at least one failed.')
     dl_group = parser.add_mutually_exclusive_group()
     dl_group.add_argument("-a", type=int, dest="downloads", metavar=("appid","depotid"), action="append", nargs='+', help="App, depot, and manifest ID to download. If the manifest ID is omitted, the lastest manifest specified by the public branch will be downloaded.\nIf the depot ID is omitted, all depots specified by the public branch will be downloaded.")
-    dl_group.add_argument("-w", type=int, nargs='?', help="Workshop file ID to download.", dest="workshop_id")
+    dl_group.add_argument("-w", type=int, nargs='+', help="Workshop file IDs to download. Collections are downloaded as the files in them.", dest="workshop_ids")
+    dl_group.add_argument("-r", type=str, help="Repair the bad chunks listed in a file written by depot_validator.py or scrubber.py: bad chunks are moved aside (or superseded in their chunkstore), downloaded again and validated. Chunks that are still bad are written back to the file.", dest="repair")
+    parser.add_argument("-f", type=str, help="Also download the workshop files and collections listed in a file, one ID per line", dest="workshop_file")
     parser.add_argument("-b", help="Download into a Steam backup file instead of storing the chunks individually", dest="backup", action="store_true")
     parser.add_argument("-d", help="Dry run: download manifest (file metadata) without actually downloading files", dest="dry_run", action="store_true")
     parser.add_argument("-l", help="Use latest local appinfo instead of trying to download", dest="local_appinfo", action="store_true")
@@ -25,47 +27,38 @@ if __name__ == "__main__": # exit before we import our shit if the args are wron
         print("connection limit must be at least 1")
         parser.print_help()
         exit(1)
-    if not args.downloads and not args.workshop_id:
-        print("must specify at least one appid or workshop file id")
+    if not args.downloads and not args.workshop_ids and not args.workshop_file and not args.repair:
+        print("must specify at least one appid or workshop file id, or a list of chunks to repair")
         parser.print_help()
         exit(1)
-    if args.downloads and args.workshop_id:
+    if (args.downloads or args.repair) and args.workshop_file:
         print("must specify only app or workshop item, not both")
         parser.print_help()
         exit(1)
 
 from steam.client import SteamClient
 from steam.client.cdn import CDNClient, CDNDepotManifest
-from steam.core.msg import MsgProto
-from steam.enums import EResult
-from steam.enums.emsg import EMsg
+from steam.enums import EResult, EWorkshopFileType
 from steam.exceptions import SteamError
 from steam.protobufs.content_manifest_pb2 import ContentManifestPayload
-from vdf import loads
 from aiohttp import ClientSession
 from login import auto_login
+from broker import BROKER_SOCKET, connect_broker
 from chunkstore import Chunkstore
+from chunkreader import verify_chunk
+from keystore import find_depot_key
+from appinfo import appinfo_path, has_appinfo, load_appinfo, save_appinfo
+from catalog import Catalog
+from pics import ProductInfoFetcher, get_app_tokens
 
-def archive_manifest(manifest, c, name="unknown", dry_run=False, server_override=None, backup=False):
-    if not manifest:
-        return False
-    print("Archiving", manifest.depot_id, "(%s)" % (name), "gid", manifest.gid, "from", datetime.fromtimestamp(manifest.creation_time))
-    dest = "./depots/" + str(manifest.depot_id) + "/"
-    makedirs(dest, exist_ok=True)
-    if dry_run:
-        print("Not downloading chunks (dry run)")
-        return True
-    if backup:
-        chunkstore = Chunkstore(str(manifest.depot_id) + "_depotcache_1.csm", depot=manifest.depot_id, is_encrypted=True)
-        if path.exists(chunkstore.csdname): chunkstore.unpack()
-        csdfile = open(chunkstore.csdname, "ab")
-    else:
-        chunkstore, csdfile = None, None
-    known_chunks = []
-    for file in manifest.payload.mappings:
-        for chunk in file.chunks:
-            known_chunks.append(chunk.sha)
-    print("Beginning to download", len(known_chunks), "encrypted", "chunk" if len(known_chunks) == 1 else "chunks")
+# workshop files to ask PublishedFile.GetDetails about in one message
+WORKSHOP_BATCH_SIZE = 100
+
+def download_chunks(depot_id, chunks_to_download, c, server_override=None, chunkstore=None, csdfile=None, connection_limit=10):
+    """Downloads a list of chunk SHAs for a depot from the CDN, either into
+    ./depots/<depot_id>/ or appended to a chunkstore's open csdfile. Chunks
+    that already exist are skipped."""
+    dest = "./depots/" + str(depot_id) + "/"
     class download_state():
         def __init__(self):
             self.chunks_dled = 0
@@ -76,12 +69,12 @@ def archive_manifest(manifest, c, name="unknown", dry_run=False, server_override
         server = servers[0]
         async with ClientSession() as session:
             for index, chunk in enumerate(chunks):
-                if path.exists(dest + hexlify(chunk).decode()) or (chunkstore and (chunk in chunkstore.chunks.keys())):
+                if (chunk in chunkstore.chunks.keys()) if chunkstore else path.exists(dest + hexlify(chunk).decode()):
                     download_state.chunks_skipped += 1
                     del chunks[index]
             for chunk in chunks:
                 chunk_str = hexlify(chunk).decode()
-                if path.exists(dest + chunk_str) or (chunkstore and (chunk in chunkstore.chunks.keys())):
+                if (chunk in chunkstore.chunks.keys()) if chunkstore else path.exists(dest + chunk_str):
                     download_state.chunks_skipped += 1
                     continue
                 if not csdfile: f = open(dest + chunk_str, "wb")
@@ -89,13 +82,13 @@ def archive_manifest(manifest, c, name="unknown", dry_run=False, server_override
                 while True:
                     try:
                         if server_override:
-                            request_url = "%s/depot/%s/chunk/%s" % (server_override, manifest.depot_id, chunk_str)
+                            request_url = "%s/depot/%s/chunk/%s" % (server_override, depot_id, chunk_str)
                             host = server_override
                         else:
                             request_url = "%s://%s:%s/depot/%s/chunk/%s" % ("https" if server.https else "http",
                                 server.host,
                                 server.port,
-                                manifest.depot_id,
+                                depot_id,
                                 chunk_str)
                             host = ("https" if server.https else "http") + "://" + server.host
                         async with session.get(request_url) as response:
@@ -121,7 +114,7 @@ def archive_manifest(manifest, c, name="unknown", dry_run=False, server_override
     async def summary_printer(download_state):
         averages = []
         last_msg_length = 0
-        while download_state.chunks_dled + download_state.chunks_skipped != len(known_chunks):
+        while download_state.chunks_dled + download_state.chunks_skipped != len(chunks_to_download):
             averages.append(download_state.bytes)
             download_state.bytes = 0
             if len(averages) == 6:
@@ -130,7 +123,7 @@ def archive_manifest(manifest, c, name="unknown", dry_run=False, server_override
             for average in averages:
                 speed += average
             speed = round(speed / len(averages) / 1000000, 2)
-            msg = f"\rDownloading at {speed}MB/s ({download_state.chunks_dled + download_state.chunks_skipped}/{len(known_chunks)})"
+            msg = f"\rDownloading at {speed}MB/s ({download_state.chunks_dled + download_state.chunks_skipped}/{len(chunks_to_download)})"
             if last_msg_length > len(msg):
                 whitespace = " " * (last_msg_length - len(msg))
             else:
@@ -140,21 +133,154 @@ def archive_manifest(manifest, c, name="unknown", dry_run=False, server_override
             await sleep(1)
 
     async def run_workers(download_state):
-        workers = [summary_printer(download_state)]
-        chunk_size = int(ceil(len(known_chunks)/args.connection_limit))
-        for i in range(args.connection_limit):
-            workers.append(dl_worker(known_chunks[i * chunk_size:i * chunk_size + chunk_size], download_state, c.servers.copy(), chunkstore, csdfile))
+        # the printer would wait forever for chunks a failed worker gave up on
+        printer = create_task(summary_printer(download_state))
+        workers = []
+        chunk_size = int(ceil(len(chunks_to_download)/connection_limit))
+        for i in range(connection_limit):
+            workers.append(dl_worker(chunks_to_download[i * chunk_size:i * chunk_size + chunk_size], download_state, c.servers.copy(), chunkstore, csdfile))
         await gather(*workers)
+        printer.cancel()
 
     run(run_workers(download_state))
+    return download_state
+
+def archive_manifest(manifest, c, name="unknown", dry_run=False, server_override=None, backup=False, connection_limit=10):
+    return archive_manifests([(manifest, name)], c, dry_run, server_override, backup, connection_limit)
+
+def archive_manifests(manifests, c, dry_run=False, server_override=None, backup=False, connection_limit=10):
+    """Archives a list of (manifest, name) of the same depot, downloading the
+    chunks they need in one run. Manifests that couldn't be loaded (None or
+    False) are left out; returns False if that leaves nothing to archive."""
+    manifests = [(manifest, name) for manifest, name in manifests if manifest]
+    if not manifests:
+        return False
+    depot_id = manifests[0][0].depot_id
+    dest = "./depots/" + str(depot_id) + "/"
+    makedirs(dest, exist_ok=True)
+    catalog = Catalog()
+    for manifest, name in manifests:
+        print("Archiving", manifest.depot_id, "(%s)" % (name), "gid", manifest.gid, "from", datetime.fromtimestamp(manifest.creation_time))
+        catalog.add_manifest(manifest)
+    if dry_run:
+        print("Not downloading chunks (dry run)")
+        return True
+    if backup:
+        chunkstore = Chunkstore(str(depot_id) + "_depotcache_1.csm", depot=depot_id, is_encrypted=True)
+        if path.exists(chunkstore.csdname): chunkstore.unpack()
+        csdfile = open(chunkstore.csdname, "ab")
+    else:
+        chunkstore, csdfile = None, None
+    known_chunks = {} # in manifest order, without the chunks manifests share
+    for manifest, name in manifests:
+        for file in manifest.payload.mappings:
+            for chunk in file.chunks:
+                known_chunks[chunk.sha] = None
+    known_chunks = list(known_chunks)
+    print("Beginning to download", len(known_chunks), "encrypted", "chunk" if len(known_chunks) == 1 else "chunks")
+    download_state = download_chunks(depot_id, known_chunks, c, server_override, chunkstore, csdfile, connection_limit)
     if chunkstore:
         chunkstore.write_csm()
         csdfile.close()
-    print("\nFinished downloading", manifest.depot_id, "(%s)" % (name), "gid", manifest.gid, "from", datetime.fromtimestamp(manifest.creation_time))
+        catalog.add_chunkstore(chunkstore)
+    else:
+        catalog.add_chunks(depot_id, ((sha, dest + hexlify(sha).decode(), None, None) for sha in known_chunks if path.exists(dest + hexlify(sha).decode())))
+    catalog.close()
+    print()
+    for manifest, name in manifests:
+        print("Finished downloading", manifest.depot_id, "(%s)" % (name), "gid", manifest.gid, "from", datetime.fromtimestamp(manifest.creation_time))
     print("Downloaded %s %s and skipped %s" % (download_state.chunks_dled, "chunk" if download_state.chunks_dled == 1 else "chunks", download_state.chunks_skipped))
     return True
 
-def try_load_manifest(appid, depotid, manifestid):
+def load_bad_chunks(filename):
+    """Reads a list of bad chunks written by depot_validator or scrubber, one
+    "depot<TAB>sha<TAB>reason<TAB>location" line per chunk."""
+    bad_chunks = []
+    seen = set()
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f.read().split("\n"):
+            line = line.split("\t")
+            if len(line) < 4:
+                continue
+            chunk = (int(line[0]), unhexlify(line[1]), line[2], line[3])
+            if chunk not in seen:
+                seen.add(chunk)
+                bad_chunks.append(chunk)
+    return bad_chunks
+
+def chunkstore_of(location):
+    """Returns the csd a bad chunk location points into, or None for loose
+    chunks."""
+    if location.endswith(".csd") or location.endswith(".csm"):
+        return location
+    csdname = location.rsplit(":", 2)[0]
+    if location.count(":") >= 2 and csdname.endswith(".csd"):
+        return csdname
+    return None
+
+def repair_chunks(bad_chunks, c, server_override=None, connection_limit=10):
+    """Refetches bad chunks from the CDN and validates them again. Bad loose
+    chunks are renamed to <chunk>.bad first; in chunkstores, the new copy is
+    appended to the csd and the csm entry is pointed at it. Returns the chunks
+    that are still bad, in the same form as load_bad_chunks."""
+    targets = {}
+    for depot, sha, reason, location in bad_chunks:
+        targets.setdefault((depot, chunkstore_of(location)), {})[sha] = location
+    still_bad = []
+    catalog = Catalog()
+    for (depot, csdname), chunks in targets.items():
+        dest = "./depots/" + str(depot) + "/"
+        makedirs(dest, exist_ok=True)
+        chunkstore, csdfile = None, None
+        if csdname:
+            chunkstore = Chunkstore(csdname)
+            chunkstore.unpack()
+            if not chunkstore.is_encrypted:
+                print("\033[31merror: can't repair decrypted chunkstore\033[0m", chunkstore.csdname, "- repack it with pack_sis.py instead")
+                still_bad.extend((depot, sha, "not repaired", location) for sha, location in chunks.items())
+                continue
+            for sha in chunks.keys():
+                chunkstore.chunks.pop(sha, None)
+            csdfile = open(chunkstore.csdname, "ab")
+        else:
+            for sha, location in chunks.items():
+                if path.exists(location):
+                    replace(location, location + ".bad")
+                    catalog.remove_chunks(depot, [sha], location)
+        print("Refetching", len(chunks), "chunk" if len(chunks) == 1 else "chunks", "for depot", depot, "into", csdname if csdname else dest)
+        download_chunks(depot, list(chunks.keys()), c, server_override, chunkstore, csdfile, connection_limit)
+        print()
+        if chunkstore:
+            chunkstore.write_csm()
+            csdfile.close()
+            catalog.add_chunkstore(chunkstore)
+        else:
+            catalog.add_chunks(depot, ((sha, dest + hexlify(sha).decode(), None, None) for sha in chunks.keys() if path.exists(dest + hexlify(sha).decode())))
+        depotkey = find_depot_key(depot)
+        if not depotkey:
+            print("No key for depot", depot, "so refetched chunks weren't validated")
+        for sha in chunks.keys():
+            if chunkstore:
+                if sha not in chunkstore.chunks:
+                    still_bad.append((depot, sha, "refetch failed", chunkstore.csdname))
+                    continue
+                offset, length = chunkstore.chunks[sha]
+                location = "%s:%s:%s" % (chunkstore.csdname, offset, length)
+                data = chunkstore.get_chunk(sha)
+            else:
+                location = dest + hexlify(sha).decode()
+                if not path.exists(location):
+                    still_bad.append((depot, sha, "refetch failed", location))
+                    continue
+                with open(location, "rb") as f:
+                    data = f.read()
+            error = verify_chunk(data, True, depotkey, sha) if depotkey else None
+            if error:
+                still_bad.append((depot, sha, error, location))
+    catalog.close()
+    return still_bad
+
+def try_load_manifest(appid, depotid, manifestid, c):
     print(f"Getting a manifest for app {appid} depot {depotid} gid {manifestid}")
     dest = "./depots/%s/%s.zip" % (depotid, manifestid)
     makedirs("./depots/%s" % depotid, exist_ok=True)
@@ -176,7 +302,7 @@ def try_load_manifest(appid, depotid, manifestid):
             except SteamError as e:
                 if e.eresult == EResult.AccessDenied:
                     if not license_requested:
-                        result, granted_appids, granted_packageids = steam_client.request_free_license([appid])
+                        result, granted_appids, granted_packageids = c.steam.request_free_license([appid])
                         license_requested = True
                         continue
                     print(e.message)
@@ -191,6 +317,42 @@ def try_load_manifest(appid, depotid, manifestid):
             f.write(resp.content)
         return CDNDepotManifest(c, appid, resp.content)
 
+def get_workshop_details(steam_client, fileids, batch_size=WORKSHOP_BATCH_SIZE):
+    """Asks PublishedFile.GetDetails about workshop files, batch_size at a
+    time. Collections are replaced by the files in them (and collections in
+    them by theirs). Returns (details of every file, IDs that failed)."""
+    seen = set(fileids)
+    pending = list(dict.fromkeys(fileids))
+    details, failed = [], []
+    while pending:
+        batch, pending = pending[:batch_size], pending[batch_size:]
+        print("Getting info for %s workshop %s (%s more waiting)" % (len(batch), "item" if len(batch) == 1 else "items", len(pending)))
+        response = steam_client.send_um_and_wait("PublishedFile.GetDetails#1", {'publishedfileids': batch, 'includechildren': True}, timeout=30)
+        if response is None or response.header.eresult != EResult.OK:
+            print("\033[31merror: couldn't get workshop item info:\033[0m", response.header.error_message if response else "timed out")
+            failed += batch
+            continue
+        for file in response.body.publishedfiledetails:
+            if file.result != EResult.OK:
+                print("\033[31merror: steam returned error\033[0m", EResult(file.result), "for workshop item", file.publishedfileid)
+                failed.append(file.publishedfileid)
+            elif file.file_type == EWorkshopFileType.Collection:
+                children = [child.publishedfileid for child in file.children if child.publishedfileid not in seen]
+                seen.update(children)
+                pending += children
+                print("Workshop collection", file.title, "for app", file.consumer_appid, "has", len(file.children), "items")
+            else:
+                details.append(file)
+    return details, failed
+
+def workshop_archived(file, catalog):
+    """Whether a workshop file's manifest is already on disk, and if the
+    catalog knows it, all its chunks too."""
+    if not path.exists("./depots/%s/%s.zip" % (file.consumer_appid, file.hcontent_file)):
+        return False
+    stored = catalog.manifest(file.consumer_appid, file.hcontent_file)
+    return not stored or stored[1] == stored[2]
+
 def get_gid(manifest):
     if type(manifest) == str:
         return int(manifest)
@@ -204,35 +366,73 @@ if __name__ == "__main__":
     makedirs("./appinfo", exist_ok=True)
     makedirs("./depots", exist_ok=True)
 
-    steam_client = SteamClient()
-    print("Connecting to the Steam network...")
-    steam_client.connect()
-    print("Logging in...")
-    if args.interactive:
-        auto_login(steam_client, fallback_anonymous=False, relogin=False)
-    elif args.username:
-        auto_login(steam_client, args.username, args.password)
+    # share the broker's session if it's running, unless we were asked to
+    # log in as someone in particular
+    steam_client = None if args.interactive or args.username else connect_broker()
+    if steam_client:
+        print("Using the Steam session from the broker on", BROKER_SOCKET)
     else:
-        auto_login(steam_client)
+        steam_client = SteamClient()
+        print("Connecting to the Steam network...")
+        steam_client.connect()
+        print("Logging in...")
+        if args.interactive:
+            auto_login(steam_client, fallback_anonymous=False, relogin=False)
+        elif args.username:
+            auto_login(steam_client, args.username, args.password)
+        else:
+            auto_login(steam_client)
     c = CDNClient(steam_client)
-    if args.workshop_id:
-        response = steam_client.send_um_and_wait("PublishedFile.GetDetails#1", {'publishedfileids':[args.workshop_id]})
-        if response.header.eresult != EResult.OK:
-            print("\033[31merror: couldn't get workshop item info:\033[0m", response.header.error_message)
-            exit(1)
-        file = response.body.publishedfiledetails[0]
-        if file.result != EResult.OK:
-            print("\033[31merror: steam returned error\033[0m", EResult(file.result))
-            exit(1)
-        print("Retrieved data for workshop item", file.title, "for app", file.consumer_appid, "(%s)" % file.app_name)
-        if not file.hcontent_file:
-            print("\033[31merror: workshop item is not on SteamPipe\033[0m")
-            exit(1)
-        if file.file_url:
-            print("\033[31merror: workshop item is not on SteamPipe: its download URL is\033[0m", file.file_url)
-            exit(1)
-        archive_manifest(try_load_manifest(file.consumer_appid, file.consumer_appid, file.hcontent_file), c, file.title, args.dry_run, args.server, args.backup)
-        exit(0)
+    catalog = Catalog()
+    if args.repair:
+        bad_chunks = load_bad_chunks(args.repair)
+        still_bad = repair_chunks(bad_chunks, c, args.server, args.connection_limit)
+        if still_bad:
+            with open(args.repair, "w", encoding="utf-8", newline="\n") as f:
+                for depot, sha, reason, location in still_bad:
+                    f.write("%s\t%s\t%s\t%s\n" % (depot, hexlify(sha).decode(), reason, location))
+            print("\033[31m%s of %s %s still bad\033[0m, list written to %s" % (len(still_bad), len(bad_chunks), "chunk" if len(bad_chunks) == 1 else "chunks", args.repair))
+        else:
+            remove(args.repair)
+            print("Repaired all", len(bad_chunks), "chunk" if len(bad_chunks) == 1 else "chunks")
+        exit(min(len(still_bad), 255)) # exit codes wrap around past 255
+    if args.workshop_ids or args.workshop_file:
+        fileids = args.workshop_ids or []
+        if args.workshop_file:
+            with open(args.workshop_file, "r") as f:
+                fileids += [int(line) for line in f.read().split() if line.isdigit()]
+        details, failed = get_workshop_details(steam_client, fileids)
+        # the files of an app's workshop are all in the depot with the app's
+        # ID, so each app's manifests are downloaded in one run
+        by_app = {}
+        skipped = 0
+        for file in details:
+            print("Retrieved data for workshop item", file.title, "for app", file.consumer_appid, "(%s)" % file.app_name)
+            if not file.hcontent_file:
+                print("\033[31merror: workshop item is not on SteamPipe\033[0m")
+                failed.append(file.publishedfileid)
+            elif file.file_url:
+                print("\033[31merror: workshop item is not on SteamPipe: its download URL is\033[0m", file.file_url)
+                failed.append(file.publishedfileid)
+            elif workshop_archived(file, catalog):
+                skipped += 1
+            else:
+                by_app.setdefault(file.consumer_appid, {})[file.hcontent_file] = file
+        if skipped:
+            print("Skipping", skipped, "workshop", "item" if skipped == 1 else "items", "that are already archived")
+        for appid, files in by_app.items():
+            manifests = []
+            for file in files.values():
+                manifest = try_load_manifest(appid, appid, file.hcontent_file, c)
+                if manifest:
+                    manifests.append((manifest, file.title))
+                else:
+                    failed.append(file.publishedfileid)
+            if manifests and not archive_manifests(manifests, c, args.dry_run, args.server, args.backup, args.connection_limit):
+                failed += [file.publishedfileid for file in files.values()]
+        if failed:
+            print("\033[31mFailed to archive %s workshop %s\033[0m" % (len(failed), "item" if len(failed) == 1 else "items"))
+        exit(min(len(failed), 255)) # exit codes wrap around past 255
 
     # Iterate over all the downloads we want
     exit_status = 0
@@ -243,45 +443,32 @@ if __name__ == "__main__":
 
         # Fetch appinfo
         if args.local_appinfo:
-            highest_changenumber = 0
-            for file in listdir("./appinfo/"):
-                if not file.endswith(".vdf"): continue
-                if not file.startswith(str(appid) + "_"): continue
-                changenumber = int(file.split("_")[1].replace(".vdf", ""))
-                if changenumber > highest_changenumber:
-                    highest_changenumber = changenumber
-            if highest_changenumber == 0:
+            changenumber = catalog.latest_changenumber(appid)
+            if not changenumber:
                 print("\033[31merror: -l flag specified, but no local appinfo exists for app\033[0m", appid)
                 exit(1)
-            appinfo_path = "./appinfo/%s_%s.vdf" % (appid, highest_changenumber)
         else:
             print("Fetching appinfo for", appid)
-            tokens = steam_client.get_access_tokens(app_ids=[appid])
-            msg = MsgProto(EMsg.ClientPICSProductInfoRequest)
-            body_app = msg.body.apps.add()
-            body_app.appid = appid
-            if 'apps' in tokens.keys() and appid in tokens['apps'].keys():
-                body_app.access_token = tokens['apps'][appid]
-            appinfo_response = steam_client.wait_event(steam_client.send_job(msg))[0].body.apps[0]
+            apps = []
+            ProductInfoFetcher(steam_client, get_app_tokens(steam_client, [appid])).fetch([[appid]], apps.extend)
+            if not apps:
+                print("\033[31merror: couldn't get appinfo for app\033[0m", appid)
+                exit(1)
+            appinfo_response = apps[0]
             changenumber = appinfo_response.change_number
-            # Write vdf appinfo to disk
-            appinfo_path = "./appinfo/%s_%s.vdf" % (appid, changenumber)
         need_to_write_appinfo = True
-        if path.exists(appinfo_path):
-            with open(appinfo_path, "r", encoding="utf-8") as f:
-                appinfo = loads(f.read())['appinfo']
+        if has_appinfo(appid, changenumber, catalog):
+            appinfo = load_appinfo(appid, changenumber, catalog)
             if 'public_only' in appinfo.keys():
-                if appinfo['public_only'] == '1':
-                    print("Replacing public_only appinfo at:", appinfo_path)
-                    remove(appinfo_path)
+                if appinfo['public_only'] == '1' and not args.local_appinfo:
+                    print("Replacing public_only appinfo at:", appinfo_path(appid, changenumber))
             else:
                 need_to_write_appinfo = False
-        if need_to_write_appinfo:
-            with open(appinfo_path, "wb") as f:
-                f.write(appinfo_response.buffer[:-1])
+        if need_to_write_appinfo and not args.local_appinfo:
+            # Write vdf appinfo to disk
+            save_appinfo(appid, changenumber, appinfo_response.buffer[:-1], catalog)
             print("Saved appinfo for app", appid, "changenumber", changenumber)
-            # decode appinfo
-            appinfo = loads(appinfo_response.buffer[:-1].decode('utf-8', 'replace'))['appinfo']
+            appinfo = load_appinfo(appid, changenumber, catalog)
         if "public_only" in appinfo.keys():
             print("WARNING: this app has additional (private) info. The archive "
                     "may not work due to this info being missing. To get this "
@@ -292,16 +479,16 @@ if __name__ == "__main__":
             name = appinfo['depots'][str(depotid)]['name'] if 'name' in appinfo['depots'][str(depotid)] else 'unknown'
             if manifestid:
                 print("Archiving", appinfo['common']['name'], "depot", depotid, "manifest", manifestid)
-                exit_status += (0 if archive_manifest(try_load_manifest(appid, depotid, manifestid), c, name, args.dry_run, args.server, args.backup) else 1)
+                exit_status += (0 if archive_manifest(try_load_manifest(appid, depotid, manifestid, c), c, name, args.dry_run, args.server, args.backup, args.connection_limit) else 1)
             else:
                 manifest = get_gid(appinfo['depots'][str(depotid)]['manifests']['public'])
                 print("Archiving", appinfo['common']['name'], "depot", depotid, "manifest", manifest)
-                exit_status += (0 if archive_manifest(try_load_manifest(appid, depotid, manifest), c, name, args.dry_run, args.server, args.backup) else 1)
+                exit_status += (0 if archive_manifest(try_load_manifest(appid, depotid, manifest, c), c, name, args.dry_run, args.server, args.backup, args.connection_limit) else 1)
         else:
             print("Archiving all latest depots for", appinfo['common']['name'], "build", appinfo['depots']['branches']['public']['buildid'])
             for depot in appinfo["depots"]:
                 depotinfo = appinfo["depots"][depot]
                 if not "manifests" in depotinfo or not "public" in depotinfo["manifests"]:
                     continue
-                exit_status += (0 if archive_manifest(try_load_manifest(appid, depot, get_gid(depotinfo["manifests"]["public"])), c, depotinfo["name"] if "name" in depotinfo else "unknown", args.dry_run, args.server, args.backup) else 1)
+                exit_status += (0 if archive_manifest(try_load_manifest(appid, depot, get_gid(depotinfo["manifests"]["public"]), c), c, depotinfo["name"] if "name" in depotinfo else "unknown", args.dry_run, args.server, args.backup, args.connection_limit) else 1)
     exit(exit_status)
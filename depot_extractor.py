@@ -1,18 +1,20 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
 from binascii import hexlify
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from fnmatch import fnmatch
-from glob import glob
 from hashlib import sha1
-from io import BytesIO
-from os import makedirs, remove
-from os.path import dirname, exists
+from json import dump, load
+from os import cpu_count, fstat, makedirs, remove, replace, rmdir, sep, stat
+from os.path import dirname, exists, isdir
 from pathlib import Path
-from struct import unpack
-from sys import argv
-from zipfile import ZipFile
-import lzma
+from socket import create_connection
+from struct import pack
+from sys import argv, stderr, stdout
+from time import time
+import tarfile
 
 if __name__ == "__main__": # exit before we import our shit if the args are wrong
     parser = ArgumentParser(description='Extract downloaded depots.')
@@ -23,15 +25,203 @@ if __name__ == "__main__": # exit before we import our shit if the args are wron
     parser.add_argument('-f', dest="files", help="List files to extract (can be used multiple times); if ommitted, all files will be extracted. Glob matching supported.", action="append")
     parser.add_argument('-b', dest="backup", help="Path to a .csd backup file to extract (the manifest must also be present in the depots folder)", nargs='?')
     parser.add_argument('--dest', help="directory to place extracted files in", type=str, default="extract")
+    parser.add_argument('--resume', help="skip files that were already extracted correctly and only rewrite the missing or damaged chunks of partially extracted files", action="store_true")
+    parser.add_argument('--upgrade-from', help="manifest ID the files in --dest were previously extracted from; only the changes between the two manifests will be applied", type=int, dest="upgrade_from")
+    parser.add_argument('--tar', help="write the extracted files as a tar stream to this path instead of --dest (- for stdout, tcp://host:port to send it over a socket)", type=str)
+    parser.add_argument('-j', dest="threads", help="with --tar, number of chunks to decode in parallel (default: number of CPUs)", type=int, default=cpu_count())
+    parser.add_argument('--cache-size', help="maximum size in MB of the cache for chunks used by more than one file (default 256)", type=int, default=256, dest="cache_size")
     args = parser.parse_args()
+    if args.tar and (args.dry_run or args.resume or args.upgrade_from):
+        print("--tar can't be combined with -d, --resume or --upgrade-from")
+        parser.print_help()
+        exit(1)
 
 from steam.core.manifest import DepotManifest
-from steam.core.crypto import symmetric_decrypt
-from chunkstore import Chunkstore
+from chunkreader import ChunkCache, ChunkReader, archive_type, decompress_chunk
+from keystore import find_depot_key
+from diff_manifests import diff_files
+
+def make_parent_dirs(dest, filename):
+    target = dest + "/" + dirname(filename)
+    try:
+        makedirs(target, exist_ok=True)
+    except FileExistsError:
+        remove(target)
+        makedirs(target, exist_ok=True)
+    except NotADirectoryError:
+        # bruh
+        while True:
+            try:
+                remove(Path(target).parent)
+            except IsADirectoryError:
+                pass
+            try:
+                makedirs(target, exist_ok=True)
+            except NotADirectoryError or FileExistsError:
+                continue
+            break
+
+STATE_FILE = ".extract_state.json"
+
+def layout_digest(file):
+    digest = sha1()
+    for chunk in sorted(file.chunks, key = lambda chunk: chunk.offset):
+        digest.update(pack("<Q", chunk.offset) + chunk.sha)
+    return digest.hexdigest()
+
+class ExtractState():
+    """Sidecar file in an extraction folder recording the chunk layout, size
+    and mtime of every file known to be completely extracted, so that reruns
+    can skip them without reading them back."""
+    def __init__(self, dest, depot, manifest):
+        self.filename = dest + "/" + STATE_FILE
+        self.depot = depot
+        self.manifest = manifest
+        self.files = {}
+        self.last_save = time()
+        if exists(self.filename):
+            try:
+                with open(self.filename, "r", encoding="utf-8") as f:
+                    state = load(f)
+                if state["depot"] == depot:
+                    self.files = state["files"]
+            except (ValueError, KeyError):
+                pass
+    def is_complete(self, file, target):
+        entry = self.files.get(file.filename)
+        if not entry or entry[0] != layout_digest(file):
+            return False
+        try:
+            st = stat(target)
+        except OSError:
+            return False
+        return st.st_size == entry[1] == file.size and st.st_mtime_ns == entry[2]
+    def record(self, file, target):
+        st = stat(target)
+        self.files[file.filename] = [layout_digest(file), st.st_size, st.st_mtime_ns]
+        if time() - self.last_save > 10:
+            self.save()
+    def forget(self, filename):
+        self.files.pop(filename, None)
+    def save(self):
+        makedirs(dirname(self.filename), exist_ok=True)
+        with open(self.filename + ".tmp", "w", encoding="utf-8") as f:
+            dump({"depot": self.depot, "manifest": self.manifest, "files": self.files}, f)
+        replace(self.filename + ".tmp", self.filename)
+        self.last_save = time()
+
+def find_bad_chunks(target, file):
+    """Returns the chunks of file (in offset order) that aren't already
+    correctly written to target. Everything after the end of a partially
+    written file is returned without being read."""
+    chunks = sorted(file.chunks, key = lambda chunk: chunk.offset)
+    try:
+        f = open(target, "rb")
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return chunks
+    bad = []
+    with f:
+        size = fstat(f.fileno()).st_size
+        for index, chunk in enumerate(chunks):
+            if chunk.offset + chunk.cb_original > size:
+                return bad + chunks[index:]
+            f.seek(chunk.offset)
+            if sha1(f.read(chunk.cb_original)).digest() != chunk.sha:
+                bad.append(chunk)
+    return bad
+
+class TarMemberStream():
+    """File object handed to tarfile for one member, filled from decoded
+    chunks as they come back in order."""
+    def __init__(self, file, chunk_data):
+        self.file = file
+        self.chunk_data = chunk_data
+        self.position = 0
+        self.pending = b""
+    def read(self, size):
+        # tarfile expects full reads until the end of the member
+        while len(self.pending) < size and self.position + len(self.pending) < self.file.size:
+            chunk, data = next(self.chunk_data, (None, b""))
+            end = self.position + len(self.pending)
+            offset = chunk.offset if chunk else self.file.size
+            # zero fill gaps not covered by any chunk
+            self.pending += bytes(max(offset - end, 0)) + data
+        piece = self.pending[:min(size, self.file.size - self.position)]
+        self.pending = self.pending[len(piece):]
+        self.position += len(piece)
+        return piece
+
+def write_tar(out, files, reader, mtime, threads, max_inflight_bytes=256 * 1024 * 1024):
+    """Writes files (in the given order) as a tar stream to out. Chunks are
+    decoded ahead in a thread pool, bounded by max_inflight_bytes, but members
+    are written sequentially. Returns the number of chunks that couldn't be
+    read; their ranges are written as zeroes."""
+    def decode(chunk):
+        data = reader.decode(chunk.sha, chunk.cb_original)
+        if sha1(data).digest() != chunk.sha:
+            raise ValueError("sha1 checksum mismatch")
+        return data
+    order = ((file, chunk) for file in files for chunk in sorted(file.chunks, key = lambda chunk: chunk.offset))
+    window = deque()
+    inflight = {}
+    inflight_bytes = 0
+    failures = 0
+    with ThreadPoolExecutor(threads) as pool:
+        def fill():
+            nonlocal inflight_bytes
+            while inflight_bytes < max_inflight_bytes or not window:
+                file, chunk = next(order, (None, None))
+                if chunk is None:
+                    return
+                if chunk.sha not in inflight:
+                    inflight[chunk.sha] = [pool.submit(decode, chunk), 0]
+                inflight[chunk.sha][1] += 1
+                window.append(chunk)
+                inflight_bytes += chunk.cb_original
+        def chunk_data(file):
+            nonlocal inflight_bytes, failures
+            for _ in range(len(file.chunks)):
+                fill()
+                chunk = window.popleft()
+                inflight_bytes -= chunk.cb_original
+                future = inflight[chunk.sha][0]
+                inflight[chunk.sha][1] -= 1
+                if inflight[chunk.sha][1] == 0:
+                    del inflight[chunk.sha]
+                try:
+                    data = future.result()
+                except Exception as e:
+                    if type(e) == KeyError:
+                        print("missing chunk", hexlify(chunk.sha).decode(), "in", file.filename, file=stderr)
+                    else:
+                        print("bad chunk", hexlify(chunk.sha).decode(), "in", file.filename + ":", e, file=stderr)
+                    failures += 1
+                    data = bytes(chunk.cb_original)
+                yield chunk, data
+        with tarfile.open(fileobj=out, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            for file in files:
+                info = tarfile.TarInfo(file.filename.replace(sep, "/"))
+                info.mtime = mtime
+                if file.is_directory:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    tar.addfile(info)
+                elif file.is_symlink:
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = file.linktarget_raw.replace("\\", "/")
+                    info.mode = 0o777
+                    tar.addfile(info)
+                else:
+                    info.size = file.size
+                    info.mode = 0o755 if file.is_executable else 0o644
+                    stream = TarMemberStream(file, chunk_data(file))
+                    tar.addfile(info, stream)
+                    for _ in stream.chunk_data: pass # keep the window in step if the file ended early
+                    print("Wrote", file.filename, file=stderr)
+    return failures
 
 if __name__ == "__main__":
     path = "./depots/%s/" % args.depotid
-    keyfile = "./keys/%s.depotkey" % args.depotid
     manifest = None
     with open(path + "%s.zip" % args.manifestid, "rb") as f:
         manifest = DepotManifest(f.read())
@@ -40,130 +230,257 @@ if __name__ == "__main__":
         if manifest.filenames_encrypted:
             manifest.decrypt_filenames(args.depotkey)
     elif manifest.filenames_encrypted:
-            ## Using No-Intro's DepotKey format, which is
-            ## a 32-byte/256-bit binary file.
-            ## Examples require login to No-Intro to view.
-            if exists(keyfile):
-                with open(keyfile, "rb") as f:
-                    args.depotkey = f.read()
-                    manifest.decrypt_filenames(args.depotkey)
-            ## If depotkey is not found, locate depot_keys.txt
-            ## and check if key is located in there.
-            elif exists("./depot_keys.txt"):
-                with open("./depot_keys.txt", "r", encoding="utf-8") as f:
-                    for line in f.read().split("\n"):
-                        line = line.split("\t")
-                        try:
-                            if int(line[0]) == args.depotid:
-                                args.depotkey = bytes.fromhex(line[2])
-                                manifest.decrypt_filenames(args.depotkey)
-                                break
-                        except ValueError:
-                            pass
-                    if not args.depotkey:
-                        print("ERROR: manifest has encrypted filenames, but no depot key was specified and no key for this depot exists in depot_keys.txt")
-                        exit(1)
-            else:
-                print("ERROR: manifest has encrypted filenames, but no depot key was specified and no depot_keys.txt exists")
-                exit(1)
+        ## Using No-Intro's DepotKey format (keys/<depotid>.depotkey, a
+        ## 32-byte/256-bit binary file), or depot_keys.txt
+        args.depotkey = find_depot_key(args.depotid)
+        if not args.depotkey:
+            print("ERROR: manifest has encrypted filenames, but no depot key was specified and no key for this depot exists in depot_keys.txt or keys/%s.depotkey" % args.depotid)
+            exit(1)
+        manifest.decrypt_filenames(args.depotkey)
 
     def is_match(file):
         for pattern in args.files:
             if fnmatch(file.filename, pattern): return True
         return False
 
-    if args.backup:
-        chunkstores = {}
-        chunks_by_store = {}
-        for csm in glob(args.backup.replace("_1.csm","").replace("_1.csd","") + "_*.csm"):
-            chunkstore = Chunkstore(csm)
-            chunkstore.unpack()
-            for chunk, _ in chunkstore.chunks.items():
-                chunks_by_store[chunk] = csm
-            chunkstores[csm] = chunkstore
-
-    for file in manifest.iter_files():
-        if args.files and not is_match(file): continue
-        target = args.dest + "/" + dirname(file.filename)
-        if not args.dry_run:
-            try:
-                makedirs(target, exist_ok=True)
-            except FileExistsError:
-                remove(target)
-                makedirs(target, exist_ok=True)
-            except NotADirectoryError:
-                # bruh
-                while True:
-                    try:
-                        remove(Path(target).parent)
-                    except IsADirectoryError:
-                        pass
-                    try:
-                        makedirs(target, exist_ok=True)
-                    except NotADirectoryError or FileExistsError:
-                        continue
-                    break
+    reader = ChunkReader(args.depotid, args.depotkey, args.backup)
+    files = [file for file in manifest.iter_files() if not args.files or is_match(file)]
+    cache = ChunkCache.for_files(files, args.cache_size * 1024 * 1024)
+
+    def load_chunk(file, chunk):
+        chunkhex = hexlify(chunk.sha).decode()
         try:
-            for chunk in sorted(file.chunks, key = lambda chunk: chunk.offset):
-                chunkhex = hexlify(chunk.sha).decode()
-                if args.backup:
-                    chunk_data = None
-                    is_encrypted = False
-                    try:
-                        chunkstore = chunkstores[chunks_by_store[chunk.sha]]
-                        chunk_data = chunkstore.get_chunk(chunk.sha)
-                        is_encrypted = chunkstore.is_encrypted
-                    except:
-                        print("missing chunk " + hexlify(chunk.sha).decode())
-                        breakpoint()
-                        continue
-                    if is_encrypted:
-                        if args.depotkey:
-                            decrypted = symmetric_decrypt(chunk_data, args.depotkey)
-                        else:
-                            print("ERROR: chunk %s is encrypted, but no depot key was specified" % chunkhex)
-                            exit(1)
-                    else:
-                        decrypted = chunk_data
-                        chunk_data = None
+            decrypted = reader.decrypt(chunk.sha)
+        except ValueError as e:
+            print("ERROR:", e)
+            exit(1)
+        kind = archive_type(decrypted)
+        if not kind:
+            print("ERROR: unknown archive type", decrypted[:2].decode())
+            exit(1)
+        if args.dry_run:
+            print("Testing", file.filename, "(%s) from chunk" % kind, chunkhex)
+        else:
+            print("Extracting", file.filename, "(%s) from chunk" % kind, chunkhex)
+        decompressed = decompress_chunk(decrypted, chunk.cb_original)
+        sha = sha1(decompressed)
+        if sha.digest() != chunk.sha:
+            print("ERROR: sha1 checksum mismatch (expected %s, got %s)" % (chunkhex, sha.hexdigest()))
+        return decompressed
 
+    if args.tar:
+        if args.tar == "-":
+            out = stdout.buffer
+        elif args.tar.startswith("tcp://"):
+            host, _, port = args.tar[len("tcp://"):].rpartition(":")
+            out = create_connection((host, int(port))).makefile("wb")
+        else:
+            out = open(args.tar, "wb")
+        failures = write_tar(out, files, reader, manifest.creation_time, args.threads)
+        out.close()
+        print("Wrote", len(files), "file" if len(files) == 1 else "files", "with", failures, "missing chunk" if failures == 1 else "missing chunks", file=stderr)
+        exit(1 if failures else 0)
+
+    if args.upgrade_from:
+        with open(path + "%s.zip" % args.upgrade_from, "rb") as f:
+            old_manifest = DepotManifest(f.read())
+        if old_manifest.filenames_encrypted:
+            if not args.depotkey:
+                print("ERROR: manifest %s has encrypted filenames, but no depot key was found" % args.upgrade_from)
+                exit(1)
+            old_manifest.decrypt_filenames(args.depotkey)
+        print("Upgrading", args.dest, "from manifest", args.upgrade_from, "to manifest", args.manifestid)
+        chunk_layout = lambda file: (file.size, tuple(sorted((chunk.offset, chunk.sha) for chunk in file.chunks)))
+        on_disk = lambda file: exists(args.dest + "/" + file.filename)
+        deleted, modified, added, unchanged = [], [], [], []
+        for status, old_file, file in diff_files(old_manifest, manifest):
+            if args.files and not is_match(file or old_file): continue
+            if old_file and file and old_file.is_directory != file.is_directory:
+                deleted.append(old_file)
+                added.append(file)
+            elif status == "deleted":
+                deleted.append(old_file)
+            elif status == "added" or (file.is_file and not on_disk(file)):
+                added.append(file)
+            elif status == "modified" and file.is_file:
+                modified.append((old_file, file))
+            else:
+                unchanged.append(file)
+
+        # a deleted file with the same chunks as an added file was renamed
+        renames = []
+        deleted_by_layout = {}
+        for old_file in deleted:
+            if old_file.is_file and on_disk(old_file):
+                deleted_by_layout.setdefault(chunk_layout(old_file), []).append(old_file)
+        renamed = set()
+        for file in added:
+            candidates = deleted_by_layout.get(chunk_layout(file)) if file.is_file else None
+            if candidates:
+                old_file = candidates.pop()
+                renames.append((old_file, file))
+                renamed.add(old_file.filename)
+                renamed.add(file.filename)
+        deleted = [file for file in deleted if file.filename not in renamed]
+        added = [file for file in added if file.filename not in renamed]
+
+        # chunks that have to be written, and where unchanged copies of them already are
+        changed_chunks = {}
+        for old_file, file in modified:
+            old_layout = set((chunk.offset, chunk.sha) for chunk in old_file.chunks)
+            changed_chunks[file.filename] = [chunk for chunk in sorted(file.chunks, key = lambda chunk: chunk.offset) if (chunk.offset, chunk.sha) not in old_layout]
+        for file in added:
+            changed_chunks[file.filename] = sorted(file.chunks, key = lambda chunk: chunk.offset)
+        local_chunks = {}
+        for file in unchanged + [file for _, file in renames]:
+            for chunk in file.chunks:
+                local_chunks.setdefault(chunk.sha, (file.filename, chunk.offset, chunk.cb_original))
+        cache = ChunkCache.for_chunks((chunk for chunks in changed_chunks.values() for chunk in chunks), args.cache_size * 1024 * 1024)
+        print("%s renamed, %s deleted, %s modified, %s added, %s unchanged" % (len(renames), len(deleted), len(modified), len(added), len(unchanged)))
+        if args.dry_run:
+            for old_file, file in renames: print("rename", old_file.filename, "->", file.filename)
+            for file in deleted: print("delete", file.filename)
+            for _, file in modified: print("modify", file.filename, "(%s changed %s)" % (len(changed_chunks[file.filename]), "chunk" if len(changed_chunks[file.filename]) == 1 else "chunks"))
+            for file in added: print("add", file.filename)
+            exit(0)
+
+        def read_local(file, chunk):
+            filename, offset, length = local_chunks[chunk.sha]
+            try:
+                with open(args.dest + "/" + filename, "rb") as f:
+                    f.seek(offset)
+                    data = f.read(length)
+            except OSError:
+                return None
+            if sha1(data).digest() != chunk.sha:
+                return None
+            print("Copying", file.filename, "chunk", hexlify(chunk.sha).decode(), "from", filename)
+            return data
+
+        def write_chunks(f, file):
+            failures = 0
+            for chunk in changed_chunks[file.filename]:
+                if chunk.sha in cache:
+                    print("Extracting", file.filename, "(cached) from chunk", hexlify(chunk.sha).decode())
+                try:
+                    decompressed = cache.get(chunk.sha, lambda: (chunk.sha in local_chunks and read_local(file, chunk)) or load_chunk(file, chunk))
+                except KeyError:
+                    print("missing chunk " + hexlify(chunk.sha).decode())
+                    failures += 1
+                    continue
+                f.seek(chunk.offset)
+                f.write(decompressed)
+            return failures
+
+        state = ExtractState(args.dest, args.depotid, args.manifestid)
+        failures = 0
+        for old_file, file in renames:
+            print("Renaming", old_file.filename, "to", file.filename)
+            make_parent_dirs(args.dest, file.filename)
+            replace(args.dest + "/" + old_file.filename, args.dest + "/" + file.filename)
+            state.forget(old_file.filename)
+            state.record(file, args.dest + "/" + file.filename)
+        for file in sorted(deleted, key = lambda file: (file.is_directory, -len(file.filename))):
+            target = args.dest + "/" + file.filename
+            state.forget(file.filename)
+            try:
+                if isdir(target):
+                    rmdir(target)
                 else:
-                    if exists(path + chunkhex):
-                        with open(path + chunkhex, "rb") as chunkfile:
-                            if args.depotkey:
-                                decrypted = symmetric_decrypt(chunkfile.read(), args.depotkey)
-                            else:
-                                print("ERROR: chunk %s is encrypted, but no depot key was specified" % chunkhex)
-                                exit(1)
-                    elif exists(path + chunkhex + "_decrypted"):
-                        with open(path + chunkhex + "_decrypted", "rb") as chunkfile:
-                            decrypted = chunkfile.read()
-                    else:
-                        print("missing chunk " + chunkhex)
-                        continue
-                decompressed = None
-                if decrypted[:2] == b'VZ': # LZMA
-                    if args.dry_run:
-                        print("Testing", file.filename, "(LZMA) from chunk", chunkhex)
-                    else:
-                        print("Extracting", file.filename, "(LZMA) from chunk", chunkhex)
-                    decompressed = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[lzma._decode_filter_properties(lzma.FILTER_LZMA1, decrypted[7:12])]).decompress(decrypted[12:-9])[:chunk.cb_original]
-                elif decrypted[:2] == b'PK': # Zip
-                    if args.dry_run:
-                        print("Testing", file.filename, "(Zip) from chunk", chunkhex)
-                    else:
-                        print("Extracting", file.filename, "(Zip) from chunk", chunkhex)
-                    zipfile = ZipFile(BytesIO(decrypted))
-                    decompressed = zipfile.read(zipfile.filelist[0])
-                else:
-                    print("ERROR: unknown archive type", decrypted[:2].decode())
-                    exit(1)
-                sha = sha1(decompressed)
-                if sha.digest() != chunk.sha:
-                    print("ERROR: sha1 checksum mismatch (expected %s, got %s)" % (hexlify(chunk.sha).decode(), sha.hexdigest()))
+                    remove(target)
+                print("Deleted", file.filename)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print("Not deleting", file.filename + ":", e)
+        for old_file, file in modified:
+            state.forget(file.filename)
+            with open(args.dest + "/" + file.filename, "r+b") as f:
+                if file.size != old_file.size:
+                    print("Resizing", file.filename, "from", old_file.size, "to", file.size, "bytes")
+                    f.truncate(file.size)
+                missing = write_chunks(f, file)
+            if not missing:
+                state.record(file, args.dest + "/" + file.filename)
+            failures += missing
+        for file in added:
+            if file.is_directory:
+                makedirs(args.dest + "/" + file.filename, exist_ok=True)
+                continue
+            elif not file.is_file:
+                continue
+            make_parent_dirs(args.dest, file.filename)
+            with open(args.dest + "/" + file.filename, "wb") as f:
+                missing = write_chunks(f, file)
+                f.truncate(file.size)
+            if not missing:
+                state.record(file, args.dest + "/" + file.filename)
+            failures += missing
+        state.save()
+        print(cache)
+        print("Upgraded", args.dest, "to manifest", args.manifestid, "with", failures, "missing chunk" if failures == 1 else "missing chunks")
+        exit(1 if failures else 0)
+
+    state = ExtractState(args.dest, args.depotid, args.manifestid)
+    pending = []
+    skipped = 0
+    for file in files:
+        target = args.dest + "/" + file.filename
+        chunks = sorted(file.chunks, key = lambda chunk: chunk.offset)
+        if args.resume and file.is_file:
+            if state.is_complete(file, target):
+                skipped += 1
+                continue
+            chunks = find_bad_chunks(target, file)
+            if exists(target) and stat(target).st_size == file.size and not chunks:
+                print("Already extracted", file.filename)
                 if not args.dry_run:
-                    with open(args.dest + "/" + file.filename, "ab") as f:
-                        f.seek(chunk.offset)
-                        f.write(decompressed)
-        except IsADirectoryError:
-            pass
+                    state.record(file, target)
+                skipped += 1
+                continue
+            elif exists(target) and len(chunks) < len(file.chunks):
+                print("Resuming", file.filename, "(%s of %s chunks to write)" % (len(chunks), len(file.chunks)))
+        pending.append((file, chunks))
+    cache = ChunkCache.for_chunks((chunk for _, chunks in pending for chunk in chunks), args.cache_size * 1024 * 1024)
+
+    try:
+        for file, chunks in pending:
+            target = args.dest + "/" + file.filename
+            if file.is_directory:
+                if not args.dry_run:
+                    make_parent_dirs(args.dest, file.filename)
+                    makedirs(target, exist_ok=True)
+                continue
+            elif not file.is_file:
+                continue
+            f = None
+            if not args.dry_run:
+                make_parent_dirs(args.dest, file.filename)
+                try:
+                    f = open(target, "r+b" if args.resume and exists(target) else "wb")
+                except IsADirectoryError:
+                    continue
+            missing = 0
+            for chunk in chunks:
+                if chunk.sha in cache:
+                    print("Testing" if args.dry_run else "Extracting", file.filename, "(cached) from chunk", hexlify(chunk.sha).decode())
+                try:
+                    decompressed = cache.get(chunk.sha, lambda: load_chunk(file, chunk))
+                except KeyError:
+                    print("missing chunk " + hexlify(chunk.sha).decode())
+                    missing += 1
+                    continue
+                if f:
+                    f.seek(chunk.offset)
+                    f.write(decompressed)
+            if f:
+                f.truncate(file.size)
+                f.close()
+                if not missing:
+                    state.record(file, target)
+    finally:
+        if not args.dry_run:
+            state.save()
+    print(cache)
+    if args.resume:
+        print("Skipped", skipped, "already extracted", "file" if skipped == 1 else "files")
@@ -1,152 +1,301 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
 from binascii import hexlify, unhexlify
-from datetime import datetime
-from fnmatch import fnmatch
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from glob import glob
-from hashlib import sha1
-from io import BytesIO
-from os import scandir, makedirs, remove
-from os.path import dirname, exists
-from pathlib import Path
-from struct import unpack
-from sys import argv
-from zipfile import ZipFile
-import lzma
+from random import random
+from mmap import mmap, ACCESS_READ
+from os import cpu_count, fstat, remove, scandir, stat
+from os.path import exists
+from sys import stderr, stdout
+from time import time
+from chunkledger import ChunkLedger, LEDGER_FILE
 
 if __name__ == "__main__": # exit before we import our shit if the args are wrong
-    parser = ArgumentParser(description='Extract downloaded depots.')
+    parser = ArgumentParser(description='Validate downloaded depot chunks (decrypt, decompress and check the sha1 of every chunk). Exit code is 0 if every chunk is good, 1 otherwise.')
     parser.add_argument('depotid', type=int)
     parser.add_argument('depotkey', type=str, nargs='?')
-    parser.add_argument('-b', dest="backup", help="Path to a .csd backup file to extract (the manifest must also be present in the depots folder)", nargs='?')
+    parser.add_argument('-b', dest="backup", help="Path to a .csd backup file to validate instead of the loose chunks in the depots folder", nargs='?')
+    parser.add_argument('-j', dest="processes", help="number of processes to validate chunks with (default: number of CPUs)", type=int, default=cpu_count())
+    parser.add_argument('-m', dest="max_inflight", help="maximum MB of chunks queued for validation at once (default 512)", type=int, default=512)
+    parser.add_argument('-f', dest="force", help="validate every chunk, even ones the ledger says are good", action="store_true")
+    parser.add_argument('--reverify', help="days after which chunks are validated again even if they haven't changed (default 30)", type=float, default=30)
+    parser.add_argument('--ledger', help="path to the ledger of validated chunks (default %s)" % LEDGER_FILE, default=LEDGER_FILE)
+    parser.add_argument('--no-ledger', help="don't read or update the ledger of validated chunks", action="store_true", dest="no_ledger")
+    parser.add_argument('-q', dest="quick", help="quick check: make sure every chunk listed by the depot's manifests is present, has the right length, and decrypts to an archive of the right size, then fully validate only the chunks that fail and a sample of the rest", action="store_true")
+    parser.add_argument('--manifest', help="with -q, manifest to check (can be used multiple times; default: every manifest downloaded for the depot)", type=int, action="append", dest="manifests")
+    parser.add_argument('--sample', help="with -q, percentage of chunks passing the quick check to fully validate anyway (default 1)", type=float, default=1)
+    parser.add_argument('-o', dest="output", help="file to write the list of bad chunks to, - for stdout (default bad_chunks_<depotid>.txt). depot_archiver.py -r can repair the chunks in it", type=str)
     args = parser.parse_args()
 
 from steam.core.manifest import DepotManifest
-from steam.core.crypto import symmetric_decrypt
+from chunkreader import quick_check_chunk, verify_chunk
 from chunkstore import Chunkstore
+from keystore import find_depot_key
+
+BATCH_BYTES = 64 * 1024 * 1024
+BATCH_CHUNKS = 1024
+
+def read_batch(batch, csdname=None, is_encrypted=True, quick=False):
+    """Reads the chunks of a batch in a worker process. batch items start with
+    (sha, location), where location is a loose chunk path, or an (offset,
+    length) tuple in csdname. Yields (item, location, data, is_encrypted,
+    error), where data is the whole chunk, or (first 48 bytes, last 48 bytes,
+    length) if quick."""
+    csd, csdmap = None, None
+    if csdname:
+        csd = open(csdname, "rb")
+        csdmap = mmap(csd.fileno(), 0, access=ACCESS_READ)
+    try:
+        for item in batch:
+            sha, location = item[:2]
+            if csdmap is not None:
+                offset, length = location
+                location = "%s:%s:%s" % (csdname, offset, length)
+                if offset + length > len(csdmap):
+                    yield item, location, None, is_encrypted, "truncated"
+                elif quick:
+                    yield item, location, (csdmap[offset:offset + min(48, length)], csdmap[offset + length - min(48, length):offset + length], length), is_encrypted, None
+                else:
+                    yield item, location, csdmap[offset:offset + length], is_encrypted, None
+                continue
+            try:
+                with open(location, "rb") as chunkfile:
+                    if quick:
+                        length = fstat(chunkfile.fileno()).st_size
+                        head = chunkfile.read(48)
+                        chunkfile.seek(max(length - 48, 0))
+                        data = (head, chunkfile.read(48), length)
+                    else:
+                        data = chunkfile.read()
+            except OSError as e:
+                yield item, location, None, False, "unreadable: %s" % e
+                continue
+            yield item, location, data, not location.endswith("_decrypted"), None
+    finally:
+        if csdmap is not None:
+            csdmap.close()
+            csd.close()
+
+def validate_batch(batch, depotkey, csdname=None, is_encrypted=True):
+    """Fully validates a batch of (sha, location) chunks. Returns (chunks
+    checked, bytes read, bad chunks) with bad chunks as (sha, reason, location)
+    tuples."""
+    bad = []
+    read = 0
+    for (sha, _), location, data, encrypted, error in read_batch(batch, csdname, is_encrypted):
+        if not error:
+            read += len(data)
+            error = verify_chunk(data, encrypted, depotkey, sha)
+        if error:
+            bad.append((sha, error, location))
+    return len(batch), read, bad
+
+def quick_check_batch(batch, depotkey, csdname=None, is_encrypted=True):
+    """Structurally checks a batch of (sha, location, cb_compressed,
+    cb_original) chunks, returning the same as validate_batch."""
+    bad = []
+    read = 0
+    for (sha, _, cb_compressed, cb_original), location, data, encrypted, error in read_batch(batch, csdname, is_encrypted, quick=True):
+        if not error:
+            head, tail, length = data
+            read += len(head) + len(tail)
+            error = quick_check_chunk(head, tail, length, encrypted, depotkey, cb_compressed, cb_original)
+        if error:
+            bad.append((sha, error, location))
+    return len(batch), read, bad
+
+def is_hex(s):
+    try:
+        unhexlify(s)
+        return True
+    except:
+        return False
+
+# every chunk is (sha, location to read it from, location in the ledger, size,
+# mtime_ns, inode), and a store is (chunks, extra arguments for the workers)
+def list_loose_chunks(path, depotkey):
+    items = []
+    for entry in scandir(path):
+        name = entry.name.replace("_decrypted", "")
+        if entry.is_file() and not entry.name.endswith(".zip") and len(name) == 40 and is_hex(name):
+            st = entry.stat()
+            items.append((unhexlify(name), path + entry.name, path + entry.name, st.st_size, st.st_mtime_ns, st.st_ino))
+    return items, (depotkey,)
+
+def list_chunkstore_chunks(csm, depotkey):
+    chunkstore = Chunkstore(csm)
+    chunkstore.unpack()
+    inode = stat(chunkstore.csdname).st_ino
+    items = []
+    # read each csd front to back
+    for sha, (offset, length) in sorted(chunkstore.chunks.items(), key = lambda item: item[1][0]):
+        items.append((sha, (offset, length), "%s:%s:%s" % (chunkstore.csdname, offset, length), length, 0, inode))
+    return items, (depotkey, chunkstore.csdname, chunkstore.is_encrypted)
+
+def make_batches(items, max_bytes=BATCH_BYTES, max_chunks=BATCH_CHUNKS):
+    """Groups chunks into batches of about max_bytes, yielding (batch bytes,
+    batch)."""
+    batch, batch_bytes = [], 0
+    for item in items:
+        batch.append(item)
+        batch_bytes += item[3]
+        if batch_bytes >= max_bytes or len(batch) >= max_chunks:
+            yield batch_bytes, batch
+            batch, batch_bytes = [], 0
+    if batch:
+        yield batch_bytes, batch
+
+def run_batches(processes, stores, worker, max_inflight, on_result, project=lambda item: item[:2]):
+    """Runs worker over the batched chunks of every store in a process pool,
+    with at most max_inflight bytes of chunks queued at once. stores is a list
+    of (items, extra worker arguments). on_result(batch, result) is called as
+    each batch completes."""
+    with ProcessPoolExecutor(processes) as pool:
+        pending = {}
+        inflight = 0
+        def collect(done):
+            nonlocal inflight
+            for future in done:
+                batch_bytes, batch = pending.pop(future)
+                inflight -= batch_bytes
+                on_result(batch, future.result())
+        for items, extra in stores:
+            for batch_bytes, batch in make_batches(items):
+                while pending and inflight + batch_bytes > max_inflight:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                pending[pool.submit(worker, [project(item) for item in batch], *extra)] = (batch_bytes, batch)
+                inflight += batch_bytes
+        while pending:
+            collect(wait(pending, return_when=FIRST_COMPLETED).done)
+
+def format_bytes(num_bytes):
+    return f"{round(num_bytes / 1000000, 2)}MB"
+
+def print_progress(checked, total, read, start, end="\r", verb="Validated", file=stdout):
+    elapsed = max(time() - start, 0.001)
+    print(f"\r{verb} {checked}/{total} chunks, {format_bytes(read)} at {round(read / elapsed / 1000000, 2)}MB/s", end=end, file=file)
+    file.flush()
 
 if __name__ == "__main__":
+    # with -o -, stdout is the list of bad chunks, so everything else goes to stderr
+    log = stderr if args.output == "-" else stdout
     path = "./depots/%s/" % args.depotid
-    keyfile = "./keys/%s.depotkey" % args.depotid
     if args.depotkey:
         args.depotkey = bytes.fromhex(args.depotkey)
-    elif exists(keyfile):
-        with open(keyfile, "rb") as f:
-            args.depotkey = f.read()
-    elif exists("./depot_keys.txt"):
-        with open("./depot_keys.txt", "r", encoding="utf-8") as f:
-            for line in f.read().split("\n"):
-                line = line.split("\t")
-                try:
-                    if int(line[0]) == args.depotid:
-                        args.depotkey = bytes.fromhex(line[2])
-                        break
-                except ValueError:
-                    pass
-            if not args.depotkey:
-                print("\033[31mERROR: files are encrypted, but no depot key was specified and no key for this depot exists in depot_keys.txt\033[0m")
-                exit(1)
     else:
-        print("\033[31mERROR: files are encrypted, but no depot key was specified and no depot_keys.txt or depotkey file exists\033[0m")
+        args.depotkey = find_depot_key(args.depotid)
+    if not args.depotkey:
+        if exists("./depot_keys.txt"):
+            print("\033[31mERROR: files are encrypted, but no depot key was specified and no key for this depot exists in depot_keys.txt\033[0m", file=log)
+        else:
+            print("\033[31mERROR: files are encrypted, but no depot key was specified and no depot_keys.txt or depotkey file exists\033[0m", file=log)
         exit(1)
 
-    chunks = {}
+    stores = []
     if args.backup:
-        chunkstores = {}
-        chunks_by_store = {}
-        for csm in glob(args.backup.replace("_1.csm","").replace("_1.csd","") + "_*.csm"):
-            chunkstore = Chunkstore(csm)
-            chunkstore.unpack()
-            for chunk, _ in chunkstore.chunks.items():
-                chunks[chunk] = _
-                chunks_by_store[chunk] = csm
-            chunkstores[csm] = chunkstore
+        for csm in sorted(glob(args.backup.replace("_1.csm","").replace("_1.csd","") + "_*.csm")):
+            stores.append(list_chunkstore_chunks(csm, args.depotkey))
     else:
-        chunkFiles = [data.name for data in scandir(path) if data.is_file()
-        and not data.name.endswith(".zip")]
-        for name in chunkFiles: chunks[name] = 0
-
-    # print(f"{len(chunks)}")
-
-    def is_hex(s):
-        try:
-            unhexlify(s)
-            return True
-        except:
-            return False
-
-    badfiles = []
- 
-    for file, value in chunks.items():
-        try:
-                if args.backup:
-                    chunkhex = hexlify(file).decode()
-                    chunk_data = None
-                    is_encrypted = False
-                    try:
-                        chunkstore = chunkstores[chunks_by_store[file]]
-                        chunk_data = chunkstore.get_chunk(file)
-                        is_encrypted = chunkstore.is_encrypted
-                    except Exception as e:
-                        print(f"\033[31mError retrieving chunk\033[0m {chunkhex}: {e}")
-                        ##breakpoint()
-                        continue
-                    if is_encrypted:
-                        if args.depotkey:
-                            decrypted = symmetric_decrypt(chunk_data, args.depotkey)
-                        else:
-                            print("\033[31mERROR: chunk %s is encrypted, but no depot key was specified\033[0m" % chunkhex)
-                            exit(1)
-                    else:
-                        decrypted = chunk_data
-                        chunk_data = None
+        stores.append(list_loose_chunks(path, args.depotkey))
 
-                else:
-                    chunkhex = hexlify(unhexlify(file.replace("_decrypted", ""))).decode()
-                    if exists(path + chunkhex):
-                        with open(path + chunkhex, "rb") as chunkfile:
-                            if args.depotkey:
-                                try:
-                                    decrypted = symmetric_decrypt(chunkfile.read(), args.depotkey)
-                                except ValueError as e:
-                                    print(f"{e}")
-                                    print(f"\033[31mError, unable to decrypt file:\033[0m {chunkhex}")
-                                    badfiles.append(chunkhex)
-                                    continue
-                            else:
-                                print("\033[31mERROR: chunk %s is encrypted, but no depot key was specified\033[0m" % chunkhex)
-                                exit(1)
-                    elif exists(path + chunkhex + "_decrypted"):
-                        with open(path + chunkhex + "_decrypted", "rb") as chunkfile:
-                            decrypted = chunkfile.read()
-                    else:
-                        print("missing chunk " + chunkhex)
-                        continue
-                decompressed = None
-                if decrypted[:2] == b'VZ': # LZMA
-                    decompressedSize = unpack('<i', decrypted[-6:-2])[0]
-                    print("Testing (LZMA) from chunk", chunkhex, "Size:", decompressedSize)
-                    try:
-                        decompressed = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[lzma._decode_filter_properties(lzma.FILTER_LZMA1, decrypted[7:12])]).decompress(decrypted[12:-10])[:decompressedSize]
-                    except lzma.LZMAError as e:
-                        print(f"\033[31mFailed to decompress:\033[0m {chunkhex}")
-                        print(f"\033[31mError:\033[0m {e}")
-                        badfiles.append(chunkhex)
-                        continue
-                elif decrypted[:2] == b'PK': # Zip
-                    print("Testing (Zip) from chunk", chunkhex)
-                    zipfile = ZipFile(BytesIO(decrypted))
-                    decompressed = zipfile.read(zipfile.filelist[0])
-                else:
-                    print("\033[31mERROR: unknown archive type\033[0m", decrypted[:2].decode())
-                    badfiles.append(chunkhex)
-                    continue
-                    #exit(1)
-                sha = sha1(decompressed)
-                if sha.digest() != unhexlify(chunkhex):
-                    print("\033[31mERROR: sha1 checksum mismatch\033[0m (expected %s, got %s)" % (chunkhex, sha.hexdigest()))
-                    badfiles.append(chunkhex)
-        except IsADirectoryError:
-            pass
-    for bad in badfiles:
-        print(f"{bad}")
\ No newline at end of file
+    bad_chunks = []
+    if args.quick:
+        manifests = args.manifests or [int(name.name[:-4]) for name in scandir(path) if name.name.endswith(".zip")]
+        manifest_chunks = {}
+        for manifestid in manifests:
+            with open(path + "%s.zip" % manifestid, "rb") as f:
+                manifest = DepotManifest(f.read())
+            for file in manifest.payload.mappings:
+                for chunk in file.chunks:
+                    manifest_chunks[chunk.sha] = (chunk.cb_compressed, chunk.cb_original)
+        present = set()
+        for index, (items, extra) in enumerate(stores):
+            stores[index] = ([item for item in items if item[0] in manifest_chunks], extra)
+            present.update(item[0] for item in stores[index][0])
+        for sha in manifest_chunks.keys() - present:
+            bad_chunks.append((sha, "missing", args.backup if args.backup else path + hexlify(sha).decode()))
+        print("Checking", len(manifest_chunks), "chunk" if len(manifest_chunks) == 1 else "chunks", "from", len(manifests), "manifest" if len(manifests) == 1 else "manifests", "(%s missing)" % len(bad_chunks), file=log)
+
+    ledger = None if args.no_ledger else ChunkLedger(args.ledger)
+    known = ledger.load(args.depotid) if ledger and not args.force else {}
+    max_age = args.reverify * 86400
+    total, skipped = 0, 0
+    for index, (items, extra) in enumerate(stores):
+        stale = [item for item in items if not ChunkLedger.is_fresh(known.get((item[0], item[2])), item[3], item[4], item[5], max_age)]
+        skipped += len(items) - len(stale)
+        total += len(stale)
+        stores[index] = (stale, extra)
+    if skipped:
+        print("Skipping", skipped, "chunk" if skipped == 1 else "chunks", "validated in the last", args.reverify, "day" if args.reverify == 1 else "days", file=log)
+    max_inflight = args.max_inflight * 1024 * 1024
+
+    if args.quick:
+        start = time()
+        checked, read, last_print = 0, 0, 0
+        suspect = set()
+        def quick_result(batch, result):
+            global checked, read, last_print
+            batch_checked, batch_read, batch_bad = result
+            checked += batch_checked
+            read += batch_read
+            suspect.update(sha for sha, _, _ in batch_bad)
+            if time() - last_print >= 1:
+                print_progress(checked, total, read, start, verb="Checked", file=log)
+                last_print = time()
+        run_batches(args.processes, stores, quick_check_batch, max_inflight, quick_result, lambda item: item[:2] + manifest_chunks[item[0]])
+        print_progress(checked, total, read, start, end="\n", verb="Checked", file=log)
+        quick_checked = checked + len(bad_chunks)
+        # only the suspect chunks and a sample of the rest get the full check
+        sampled = 0
+        for index, (items, extra) in enumerate(stores):
+            full = []
+            for item in items:
+                if item[0] in suspect:
+                    full.append(item)
+                elif random() * 100 < args.sample:
+                    full.append(item)
+                    sampled += 1
+            stores[index] = (full, extra)
+        total = len(suspect) + sampled
+        print(len(suspect), "chunk" if len(suspect) == 1 else "chunks", "failed the quick check; fully validating them and", sampled, "sampled", "chunk" if sampled == 1 else "chunks", file=log)
+
+    print("Validating", total, "chunk" if total == 1 else "chunks", "in depot", args.depotid, "using", args.processes, "process" if args.processes == 1 else "processes", file=log)
+    start = time()
+    checked, read, last_print = 0, 0, 0
+    def full_result(batch, result):
+        global checked, read, last_print
+        batch_checked, batch_read, batch_bad = result
+        checked += batch_checked
+        read += batch_read
+        bad_chunks.extend(batch_bad)
+        if ledger:
+            bad = set((sha, location) for sha, _, location in batch_bad)
+            ledger.record(args.depotid, ((sha, location, size, mtime_ns, inode, (sha, location) not in bad) for sha, _, location, size, mtime_ns, inode in batch))
+        if time() - last_print >= 1:
+            print_progress(checked, total, read, start, file=log)
+            last_print = time()
+    run_batches(args.processes, stores, validate_batch, max_inflight, full_result)
+    print_progress(checked, total, read, start, end="\n", file=log)
+    if args.quick:
+        false_alarms = len(suspect - set(sha for sha, _, _ in bad_chunks))
+        if false_alarms:
+            print(false_alarms, "chunk" if false_alarms == 1 else "chunks", "failed the quick check but passed full validation", file=log)
+        checked = quick_checked
+
+    bad_chunks.sort()
+    output = args.output if args.output else "bad_chunks_%s.txt" % args.depotid
+    if output == "-":
+        for sha, reason, location in bad_chunks:
+            print("%s\t%s\t%s\t%s" % (args.depotid, hexlify(sha).decode(), reason, location))
+    elif bad_chunks:
+        with open(output, "w", encoding="utf-8", newline="\n") as f:
+            for sha, reason, location in bad_chunks:
+                f.write("%s\t%s\t%s\t%s\n" % (args.depotid, hexlify(sha).decode(), reason, location))
+    elif exists(output):
+        remove(output) # don't leave a stale list from a previous run around
+    if bad_chunks:
+        print("\033[31m%s bad %s\033[0m out of %s" % (len(bad_chunks), "chunk" if len(bad_chunks) == 1 else "chunks", checked) + ("" if output == "-" else ", list written to " + output), file=log)
+    else:
+        print("All", checked, "chunk" if checked == 1 else "chunks", "OK" + (" (%s skipped)" % skipped if skipped else ""), file=log)
+    exit(1 if bad_chunks else 0)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from binascii import hexlify
+from bisect import bisect_right
+from hashlib import sha1
+from io import RawIOBase, SEEK_CUR, SEEK_END, SEEK_SET
+from os import stat_result
+from stat import S_IFDIR, S_IFLNK, S_IFREG
+from sys import stdout
+
+if __name__ == "__main__": # exit before we import our shit if the args are wrong
+    parser = ArgumentParser(description='List or read files from an archived depot version without extracting it.')
+    parser.add_argument('depotid', type=int)
+    parser.add_argument('manifestid', type=int)
+    parser.add_argument('path', type=str, nargs='?', default="", help="directory to list, or file to print with -c")
+    parser.add_argument('-k', dest="depotkey", help="depot key in hex (default: the key from depot_keys.txt or keys/<depotid>.depotkey)", type=str)
+    parser.add_argument('-b', dest="backup", help="Path to a .csd backup file to read chunks from", nargs='?')
+    parser.add_argument('-c', dest="cat", help="write the contents of the file at path to stdout", action="store_true")
+    parser.add_argument('--offset', help="with -c, offset to start reading from", type=int, default=0)
+    parser.add_argument('--length', help="with -c, number of bytes to read (default: until the end of the file)", type=int, default=-1)
+    args = parser.parse_intermixed_args() # so the path can come after -c
+
+from steam.core.manifest import DepotManifest
+from chunkreader import ChunkCache, ChunkReader
+from keystore import find_depot_key
+
+def normpath(path):
+    return "/".join(part for part in path.replace("\\", "/").split("/") if part and part != ".")
+
+class DepotFS():
+    """Read-only filesystem view of an archived depot version. Files are read
+    lazily from the depot's chunks (loose or in a .csd backup), decoding only
+    the chunks that cover each read. Without a depot key, the key store's
+    key for the depot is used, if it has one."""
+    def __init__(self, depotid, manifestid, depotkey=None, backup=None, cache_size=32 * 1024 * 1024):
+        if type(depotkey) == str:
+            depotkey = bytes.fromhex(depotkey)
+        if not depotkey:
+            depotkey = find_depot_key(depotid)
+        with open("./depots/%s/%s.zip" % (depotid, manifestid), "rb") as f:
+            self.manifest = DepotManifest(f.read())
+        if self.manifest.filenames_encrypted:
+            if not depotkey:
+                raise ValueError("manifest %s has encrypted filenames, but no depot key was specified and no key for depot %s exists in depot_keys.txt or keys/%s.depotkey" % (manifestid, depotid, depotid))
+            self.manifest.decrypt_filenames(depotkey)
+        self.reader = ChunkReader(depotid, depotkey, backup)
+        self.cache = ChunkCache(cache_size)
+        self.files = {}
+        self.dirs = {"": set()}
+        for file in self.manifest.iter_files():
+            path = normpath(file.filename)
+            self.files[path] = file
+            if file.is_directory:
+                self.dirs.setdefault(path, set())
+            # manifests don't always list parent directories
+            while path:
+                parent = path.rpartition("/")[0]
+                self.dirs.setdefault(parent, set()).add(path.rpartition("/")[2])
+                path = parent
+    def __repr__(self):
+        return f"DepotFS of depot {self.manifest.depot_id} gid {self.manifest.gid} ({len(self.files)} files)"
+    def exists(self, path):
+        path = normpath(path)
+        return path in self.files or path in self.dirs
+    def isdir(self, path):
+        return normpath(path) in self.dirs
+    def isfile(self, path):
+        path = normpath(path)
+        return path in self.files and self.files[path].is_file
+    def listdir(self, path=""):
+        path = normpath(path)
+        if path not in self.dirs:
+            if path in self.files:
+                raise NotADirectoryError(path)
+            raise FileNotFoundError(path)
+        return sorted(self.dirs[path])
+    def walk(self, path=""):
+        path = normpath(path)
+        names = self.listdir(path)
+        dirs = [name for name in names if (path + "/" + name if path else name) in self.dirs]
+        files = [name for name in names if name not in dirs]
+        yield path, dirs, files
+        for name in dirs:
+            yield from self.walk(path + "/" + name if path else name)
+    def stat(self, path):
+        """Returns an os.stat_result for path. Every file gets the manifest's
+        creation time as its timestamps."""
+        path = normpath(path)
+        mtime = self.manifest.creation_time
+        if path in self.dirs and (path not in self.files or self.files[path].is_directory):
+            return stat_result((S_IFDIR | 0o755, 0, 0, 1, 0, 0, 0, mtime, mtime, mtime))
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        file = self.files[path]
+        if file.is_symlink:
+            return stat_result((S_IFLNK | 0o777, 0, 0, 1, 0, 0, len(file.linktarget_raw), mtime, mtime, mtime))
+        mode = S_IFREG | (0o755 if file.is_executable else 0o644)
+        return stat_result((mode, 0, 0, 1, 0, 0, file.size, mtime, mtime, mtime))
+    def readlink(self, path):
+        path = normpath(path)
+        if path not in self.files or not self.files[path].is_symlink:
+            raise OSError("not a symlink: " + path)
+        return self.files[path].linktarget
+    def open(self, path):
+        path = normpath(path)
+        if path in self.dirs and (path not in self.files or self.files[path].is_directory):
+            raise IsADirectoryError(path)
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        return DepotFileReader(self, self.files[path])
+    def read_chunk(self, chunk):
+        def load():
+            try:
+                data = self.reader.decode(chunk.sha, chunk.cb_original)
+            except KeyError:
+                raise OSError("missing chunk " + hexlify(chunk.sha).decode())
+            except ValueError as e: # no depot key, or a chunk that won't decode
+                raise OSError("can't decode chunk %s: %s" % (hexlify(chunk.sha).decode(), e))
+            if sha1(data).digest() != chunk.sha:
+                raise OSError("sha1 checksum mismatch in chunk " + hexlify(chunk.sha).decode())
+            return data
+        return self.cache.get(chunk.sha, load)
+
+class DepotFileReader(RawIOBase):
+    """Seekable read-only file object for one file of a DepotFS."""
+    def __init__(self, fs, file):
+        self.fs = fs
+        self.file = file
+        self.name = file.filename
+        self.size = file.size
+        self.chunks = sorted(file.chunks, key = lambda chunk: chunk.offset)
+        self.offsets = [chunk.offset for chunk in self.chunks]
+        self.position = 0
+    def readable(self):
+        return True
+    def seekable(self):
+        return True
+    def tell(self):
+        return self.position
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_SET:
+            position = offset
+        elif whence == SEEK_CUR:
+            position = self.position + offset
+        elif whence == SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("invalid whence " + str(whence))
+        if position < 0:
+            raise ValueError("negative seek position " + str(position))
+        self.position = position
+        return position
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        written = 0
+        while written < len(view) and self.position < self.size:
+            index = bisect_right(self.offsets, self.position) - 1
+            chunk = self.chunks[index] if index >= 0 else None
+            if chunk and self.position < chunk.offset + chunk.cb_original:
+                data = self.fs.read_chunk(chunk)
+                start = self.position - chunk.offset
+                piece = data[start:start + len(view) - written]
+            else:
+                # gap not covered by any chunk, reads as zeroes
+                end = self.offsets[index + 1] if index + 1 < len(self.offsets) else self.size
+                piece = bytes(min(end - self.position, len(view) - written))
+            view[written:written + len(piece)] = piece
+            written += len(piece)
+            self.position += len(piece)
+        return written
+
+if __name__ == "__main__":
+    fs = DepotFS(args.depotid, args.manifestid, args.depotkey, args.backup)
+    if args.cat:
+        with fs.open(args.path) as f:
+            f.seek(args.offset)
+            remaining = args.length
+            while remaining != 0:
+                data = f.read(1024 * 1024 if remaining < 0 else min(remaining, 1024 * 1024))
+                if not data:
+                    break
+                stdout.buffer.write(data)
+                remaining -= len(data) if remaining > 0 else 0
+    else:
+        for name in fs.listdir(args.path):
+            st = fs.stat(args.path + "/" + name)
+            print("%s\t%s%s" % (st.st_size, name, "/" if fs.isdir(args.path + "/" + name) else ""))
@@ -1,10 +1,29 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
-from binascii import unhexlify, hexlify
+from binascii import hexlify
 from datetime import datetime
 from os.path import exists
 from steam.core.manifest import DepotManifest
 from sys import stderr
+from keystore import find_depot_key
+
+def diff_files(old, new):
+    """Compares the files of two manifests. Yields (status, old_file, new_file)
+    tuples with status "added", "modified" or "unchanged" in the order of the
+    new manifest, followed by "deleted" for files only in the old manifest."""
+    old_files = {}
+    for file in old.iter_files():
+        old_files[file.filename] = file
+    for file in new.iter_files():
+        old_file = old_files.pop(file.filename, None)
+        if old_file is None:
+            yield "added", None, file
+        elif old_file.chunks != file.chunks:
+            yield "modified", old_file, file
+        else:
+            yield "unchanged", old_file, file
+    for old_file in old_files.values():
+        yield "deleted", old_file, None
 
 if __name__ == "__main__":
     parser = ArgumentParser(description='Generates a diff (comparison of changes) of two versions (manifests) of a Steam depot.')
@@ -27,24 +46,18 @@ if __name__ == "__main__":
     with open(newpath, "rb") as f:
         new = DepotManifest(f.read())
     if (old.filenames_encrypted or new.filenames_encrypted):
-        if exists("./depot_keys.txt"):
-            with open("./depot_keys.txt", "r", encoding="utf-8") as f:
-                for line in f.read().split("\n"):
-                    line = line.split("\t")
-                    if line[0] == str(args.depotid):
-                        key = unhexlify(line[2])
-                        old.decrypt_filenames(key)
-                        new.decrypt_filenames(key)
+        key = find_depot_key(args.depotid)
+        if key:
+            old.decrypt_filenames(key)
+            new.decrypt_filenames(key)
         if (old.filenames_encrypted or new.filenames_encrypted):
             print("unable to decrypt filenames, missing depot key", file=stderr)
             exit(1)
 
     format_bytes = lambda num_bytes: f"{num_bytes:,} {'byte' if num_bytes == 1 else 'bytes'}"
-    old_files = {}
     old_chunks = {}
     old_size_original, old_size_compressed = 0, 0
     for file in old.iter_files():
-        old_files[file.filename] = file
         for chunk in file.chunks:
             if not chunk.sha in old_chunks.keys():
                 old_chunks[chunk.sha] = chunk
@@ -57,43 +70,44 @@ if __name__ == "__main__":
     num_reused_chunks, size_reused_chunks = 0, 0
     num_deleted_chunks, size_deleted_chunks = 0, 0
     new_size_original, new_size_compressed = 0, 0
-    chunks_found = []
-    for file in new.iter_files():
+    chunks_found = set()
+    deleted_files = []
+    for status, old_file, file in diff_files(old, new):
+        if status == "deleted":
+            deleted_files.append(old_file.filename)
+            continue
         for chunk in file.chunks:
             if not chunk.sha in old_chunks.keys():
                 if not chunk.sha in chunks_found:
                     num_new_chunks += 1
                     size_new_chunks += chunk.cb_original
-                    chunks_found.append(chunk.sha)
+                    chunks_found.add(chunk.sha)
                     if args.detailed: print("added chunk", hexlify(chunk.sha).decode())
                     new_size_original += chunk.cb_original
                     new_size_compressed += chunk.cb_compressed
             else:
                 del old_chunks[chunk.sha]
                 if not chunk.sha in chunks_found:
-                    chunks_found.append(chunk.sha)
+                    chunks_found.add(chunk.sha)
                     num_reused_chunks += 1
                     size_reused_chunks += chunk.cb_original
                     new_size_original += chunk.cb_original
                     new_size_compressed += chunk.cb_compressed
-        if not file.filename in old_files.keys():
+        if status == "added":
             if args.quiet:
                 print(file.filename)
             else:
                 print(f"added file {file.filename} ({format_bytes(file.size)} in {len(file.chunks)} {'chunk' if len(file.chunks) == 1 else 'chunks'})")
-        else:
-            old_file = old_files[file.filename]
-            del old_files[file.filename]
-            if old_file.chunks != file.chunks:
-                if args.quiet:
-                    print(file.filename)
-                else:
-                    print(f"modified file {file.filename}")
-                    print(f"\told: {format_bytes(old_file.size)} in {len(old_file.chunks)} {'chunk' if len(old_file.chunks) == 1 else 'chunks'}")
-                    size_diff = file.size - old_file.size
-                    print(f"\tnew: {format_bytes(file.size)} ({'+' if size_diff > 0 else '+-' if size_diff == 0 else ''}{size_diff} {'byte' if size_diff == 1 else 'bytes'}) in {len(file.chunks)} {'chunk' if len(file.chunks) == 1 else 'chunks'}")
+        elif status == "modified":
+            if args.quiet:
+                print(file.filename)
+            else:
+                print(f"modified file {file.filename}")
+                print(f"\told: {format_bytes(old_file.size)} in {len(old_file.chunks)} {'chunk' if len(old_file.chunks) == 1 else 'chunks'}")
+                size_diff = file.size - old_file.size
+                print(f"\tnew: {format_bytes(file.size)} ({'+' if size_diff > 0 else '+-' if size_diff == 0 else ''}{size_diff} {'byte' if size_diff == 1 else 'bytes'}) in {len(file.chunks)} {'chunk' if len(file.chunks) == 1 else 'chunks'}")
     if not args.quiet:
-        for filename, file in old_files.items():
+        for filename in deleted_files:
             print(f"deleted file {filename}")
         print("End list of changed files.")
         for _, chunk in old_chunks.items():
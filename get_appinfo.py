@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
-from os import makedirs, path
+from json import dump, load
+from os import makedirs, path, remove, replace
 from sys import argv
+from time import time
+
+FAILED_FILE = "./failed_appinfo.txt"
+CRAWL_FILE = "./appinfo_crawl.json"
 
 if __name__ == "__main__": # exit before we import our shit if the args are wrong
     parser = ArgumentParser(description='Download appinfo from Steam for one or '
@@ -14,82 +19,163 @@ if __name__ == "__main__": # exit before we import our shit if the args are wron
     parser.add_argument('appids', metavar='appid', type=int, nargs='*', help='Apps '
             'to get appinfo for. If empty, will download appinfo for all '
             'publicly visible apps on Steam (this will take a while)!')
+    parser.add_argument("-f", type=str, help="Also get appinfo for the apps listed in a file, one appid per line (e.g. the %s written by a previous run)" % FAILED_FILE, dest="appid_file")
+    parser.add_argument("-w", type=int, help="Maximum number of PICS requests to have in flight at once (default 16)", dest="window", default=16)
+    parser.add_argument("-r", type=int, help="Number of times to retry a group of apps that times out before giving up on it (default 3)", dest="retries", default=3)
+    parser.add_argument("--restart", help="When getting all apps, start a new crawl instead of resuming the one saved in %s" % CRAWL_FILE, action="store_true")
+    parser.add_argument("--refetch", help="When getting all apps, also refetch apps whose appinfo hasn't changed since the last complete crawl", action="store_true")
     args = parser.parse_args()
 
 from steam.client import SteamClient
-from steam.core.msg import MsgProto
 from steam.enums import EResult
-from steam.enums.emsg import EMsg
 from steam.webapi import WebAPI
 from login import auto_login
+from broker import BROKER_SOCKET, connect_broker
+from pics import ProductInfoFetcher, app_groups, changes_since, get_app_tokens
+from appinfo import save_appinfo
+from catalog import Catalog
+
+def save_crawl(crawl):
+    with open(CRAWL_FILE + ".tmp", "w") as f:
+        dump(crawl, f)
+    replace(CRAWL_FILE + ".tmp", CRAWL_FILE)
+
+def start_crawl():
+    """Snapshots the list of apps to fetch and the current changenumber.
+    Apps that haven't changed since the last complete crawl, going by a
+    changes query, are left out unless --refetch is given."""
+    since = 0
+    if path.exists("./last_change.txt") and not args.refetch:
+        with open("./last_change.txt", "r") as f:
+            since = int(f.read())
+    for attempt in range(args.retries + 1):
+        response = changes_since(steam_client, since, app_changes=since != 0)
+        if response:
+            break
+        print("Timeout reached asking for changes" + (", retrying..." if attempt < args.retries else ""))
+    else:
+        print("\033[31merror: couldn't get the current changenumber from Steam PICS\033[0m")
+        exit(1)
+    print("Latest change:", response.current_change_number)
+    print("Fetching list of apps from WebAPI...")
+    appids = [app['appid'] for app in WebAPI(None).ISteamApps.GetAppList_v2()['applist']['apps']]
+    if since and not response.force_full_app_update:
+        # every app was current as of the last complete crawl, so an app we
+        # have is current unless it's changed since, past the changenumber we
+        # have for it
+        have = catalog.latest_changenumbers()
+        changed = {change.appid: change.change_number for change in response.app_changes}
+        current = set(appid for appid in appids if appid in have and changed.get(appid, 0) <= have[appid])
+        print("Skipping %s apps that haven't changed since change %s" % (len(current), since))
+        appids = [appid for appid in appids if appid not in current]
+    elif since:
+        print("Too many changes since change %s to tell which apps are current, fetching everything" % since)
+    return {"change_number": response.current_change_number, "appids": appids, "done": []}
 
 if __name__ == "__main__":
     # Create directories
     makedirs("./appinfo", exist_ok=True)
     makedirs("./depots", exist_ok=True)
+    catalog = Catalog()
 
-    steam_client = SteamClient()
-    print("Connecting to the Steam network...")
-    steam_client.connect()
-    print("Logging in...")
-    if args.interactive:
-        auto_login(steam_client, fallback_anonymous=False, relogin=False)
-    elif args.username:
-        auto_login(steam_client, args.username, args.password)
+    # share the broker's session if it's running, unless we were asked to
+    # log in as someone in particular
+    steam_client = None if args.interactive or args.username else connect_broker()
+    if steam_client:
+        print("Using the Steam session from the broker on", BROKER_SOCKET)
     else:
-        auto_login(steam_client)
+        steam_client = SteamClient()
+        print("Connecting to the Steam network...")
+        steam_client.connect()
+        print("Logging in...")
+        if args.interactive:
+            auto_login(steam_client, fallback_anonymous=False, relogin=False)
+        elif args.username:
+            auto_login(steam_client, args.username, args.password)
+        else:
+            auto_login(steam_client)
 
     # Parse arguments
     appids = []
-    if len(args.appids) > 0:
+    crawl = None
+    if len(args.appids) > 0 or args.appid_file:
         appids = args.appids
+        if args.appid_file:
+            with open(args.appid_file, "r") as f:
+                appids += [int(line) for line in f.read().split() if line.isdigit()]
     else:
-        print("Fetching list of apps from WebAPI...")
-        for app in WebAPI(None).ISteamApps.GetAppList_v2()['applist']['apps']:
-            appids.append(app['appid'])
-        # Write the current changenumber, for use later with update_appinfo
-        with open("./last_change.txt", "w") as f:
-            msg = MsgProto(EMsg.ClientPICSChangesSinceRequest)
-            msg.body.since_change_number = 0
-            response = steam_client.wait_event(steam_client.send_job(msg))[0].body
-            print("Latest change:", response.current_change_number)
-            f.write(str(response.current_change_number))
+        if path.exists(CRAWL_FILE) and not args.restart:
+            with open(CRAWL_FILE, "r") as f:
+                crawl = load(f)
+            print("Resuming crawl from change %s: %s of %s groups done" % (crawl["change_number"],
+                len(crawl["done"]), len(app_groups(crawl["appids"]))))
+        else:
+            crawl = start_crawl()
+            save_crawl(crawl)
+        done = set(crawl["done"])
+        # groups are recorded by their index in the crawl's app list
+        group_index = {}
+        for index, group in enumerate(app_groups(crawl["appids"])):
+            if index not in done:
+                group_index[tuple(group)] = index
+        appids = [appid for group in group_index.keys() for appid in group]
 
     # Get app access tokens
     print("Getting app access tokens...")
-    tokens = steam_client.get_access_tokens(app_ids=appids)
-    token_count = 0
-    if tokens and 'apps' in tokens.items():
-        for app, token in tokens['apps'].items():
-            if token != 0:
-                token_count += 1
-    single = (token_count == 1)
-    print("Got", "token" if single else "tokens", "for", token_count, "app" if single else "apps")
+    tokens = get_app_tokens(steam_client, appids)
+    single = (len(tokens) == 1)
+    print("Got", "token" if single else "tokens", "for", len(tokens), "app" if single else "apps")
 
     # Fetch appinfo in groups of 30 (the maximum number of apps PICS will give
-    # us in one message)
-    for group in [appids[i:i + 30] for i in range(0, len(appids), 30)]:
-        msg = MsgProto(EMsg.ClientPICSProductInfoRequest)
-        for app in group:
-            msg_app = msg.body.apps.add()
-            msg_app.appid = app
-            if app in tokens['apps']:
-                msg_app.access_token = tokens['apps'][app]
-        print("Asking Steam PICS for appinfo for %s %s..." % (len(msg.body.apps),
-            "app" if len(msg.body.apps) == 1 else "apps"))
-        while True:
-            try:
-                response = steam_client.wait_event(steam_client.send_job(msg), 15)[0].body
-                break
-            except TypeError:
-                print("Timeout reached, retrying...")
-        print("Received response from Steam PICS containing info for %s %s." %
-            (len(response.apps), "app" if len(response.apps) == 1 else "apps"))
-        for appinfo_response in response.apps:
+    # us in one message), with several groups in flight at once
+    fetcher = ProductInfoFetcher(steam_client, tokens,
+            window=min(4, args.window), max_window=args.window, retries=args.retries)
+    groups = [list(group) for group in group_index.keys()] if crawl else app_groups(appids)
+    groups_done = 0
+    last_save = time()
+    def on_apps(apps):
+        for appinfo_response in apps:
             # Write vdf appinfo to disk
-            appinfo_path = "./appinfo/%s_%s.vdf" % (appinfo_response.appid,
-                    appinfo_response.change_number)
-            with open(appinfo_path, "wb") as f:
-                f.write(appinfo_response.buffer[:-1])
-                print("Saved appinfo for app", appinfo_response.appid,
-                        "changenumber", appinfo_response.change_number)
+            save_appinfo(appinfo_response.appid, appinfo_response.change_number,
+                    appinfo_response.buffer[:-1], catalog)
+            print("Saved appinfo for app", appinfo_response.appid,
+                    "changenumber", appinfo_response.change_number)
+    def on_group(group):
+        global groups_done, last_save
+        groups_done += 1
+        print("Finished %s of %s groups (%s requests in flight)" % (groups_done,
+            len(groups), int(fetcher.window)))
+        if crawl:
+            crawl["done"].append(group_index[tuple(group)])
+            if time() - last_save > 10:
+                save_crawl(crawl)
+                last_save = time()
+    print("Asking Steam PICS for appinfo for %s %s..." % (len(appids),
+        "app" if len(appids) == 1 else "apps"))
+    try:
+        failed = fetcher.fetch(groups, on_apps, on_group)
+    except KeyboardInterrupt:
+        if crawl:
+            save_crawl(crawl)
+            print("Saved crawl progress to", CRAWL_FILE)
+        raise
+    print(fetcher)
+    if crawl:
+        save_crawl(crawl)
+    if failed:
+        with open(FAILED_FILE, "w") as f:
+            for group in failed:
+                for appid in group:
+                    f.write(str(appid) + "\n")
+        print("\033[31mFailed to get appinfo for %s apps\033[0m, wrote them to %s "
+            "(retry them with -f %s)" % (sum(len(group) for group in failed),
+            FAILED_FILE, FAILED_FILE))
+        if crawl:
+            print("The crawl isn't complete; run again to retry the failed groups.")
+        exit(1)
+    if crawl:
+        # Only a complete crawl is a baseline for update_appinfo
+        with open("./last_change.txt", "w") as f:
+            f.write(str(crawl["change_number"]))
+        remove(CRAWL_FILE)
+        print("Crawl complete as of change", crawl["change_number"])
@@ -3,14 +3,81 @@ import requests as r
 from argparse import ArgumentParser
 from vdf import loads
 from sys import argv
-from os import makedirs, listdir, symlink
-from os.path import exists, basename
+from concurrent.futures import ThreadPoolExecutor
+from json import dump, load
+from os import makedirs, listdir, remove, replace, stat, symlink
+from os.path import exists, basename, islink
 from hashlib import sha256
 from re import compile
 from shutil import copy
+from time import sleep
 
 # TODO: code to load cachedupdatehosts.vdf
 CDN_ROOT = "https://steamcdn-a.akamaihd.net/client/"
+HASH_CACHE = "./clientpackages_sha256.json"
+
+def hash_file(f):
+    hasher = sha256()
+    while True:
+        data = f.read(1024 * 1024)
+        if not data:
+            return hasher.hexdigest()
+        hasher.update(data)
+
+class HashCache():
+    """SHA-256 of the files in ./clientpackages, saved between runs so
+    unchanged files don't have to be hashed again.
+
+    Entries are keyed by path and only trusted while the file's size, mtime
+    and inode are the same as when it was hashed."""
+    def __init__(self, filename=HASH_CACHE):
+        self.filename = filename
+        self.entries = {} # path -> [size, mtime_ns, inode, sha256]
+        if exists(filename):
+            with open(filename, "r", encoding="utf-8") as f:
+                self.entries = load(f)
+        self.hashed = 0
+    def __repr__(self):
+        return f"Hash cache {self.filename} ({len(self.entries)} files, {self.hashed} hashed this run)"
+    def lookup(self, path):
+        """Returns the cached hash of a file if it hasn't changed, else None."""
+        entry = self.entries.get(path)
+        if not entry:
+            return None
+        try:
+            st = stat(path)
+        except FileNotFoundError:
+            return None
+        if entry[:3] != [st.st_size, st.st_mtime_ns, st.st_ino]:
+            return None
+        return entry[3]
+    def sha256(self, path):
+        sha = self.lookup(path)
+        if sha is None:
+            with open(path, "rb") as f:
+                sha = hash_file(f)
+            self.hashed += 1
+            self.record(path, sha)
+        return sha
+    def record(self, path, sha):
+        st = stat(path)
+        self.entries[path] = [st.st_size, st.st_mtime_ns, st.st_ino, sha]
+    def by_sha2(self, directory="./clientpackages/"):
+        """Returns {sha256: filename} for the unchanged regular files in
+        directory, the same as download_packages' packages_by_sha2."""
+        found = {}
+        for path in sorted(self.entries.keys()):
+            if path.startswith(directory) and not islink(path):
+                sha = self.lookup(path)
+                if sha and sha not in found:
+                    found[sha] = path[len(directory):]
+        return found
+    def save(self):
+        # forget files that are gone
+        self.entries = {path: entry for path, entry in self.entries.items() if exists(path)}
+        with open(self.filename + ".tmp", "w", encoding="utf-8") as f:
+            dump(self.entries, f)
+        replace(self.filename + ".tmp", self.filename)
 
 def save_client_manifest(name):
     platform = name.split("_")
@@ -30,26 +97,77 @@ def save_client_manifest(name):
             print("Saved client manifest", manifest_name)
     return keyvalues, platform, previously_existed
 
-def download_packages(client_manifest, platform, download_zip=True, download_vz=False):
-    makedirs("./clientpackages", exist_ok=True)
-    print("Downloading packages for client version %s" % client_manifest[platform]['version'])
-    del client_manifest[platform]['version']
+def load_local_manifest(clientname):
+    """Loads a client manifest we already downloaded, given its path, its
+    filename in ./clientmanifests, or a client name to find the newest
+    version of. Returns (client manifest, platform), or None if there's no
+    such manifest."""
+    pattern = compile("_\\d+$")
+    if exists(clientname):
+        filename = clientname
+    elif exists("./clientmanifests/" + clientname):
+        filename = "./clientmanifests/" + clientname
+    else:
+        # try to find the newest manifest we downloaded
+        highest = 0
+        for file in listdir("./clientmanifests/"):
+            if pattern.sub("", file) == clientname:
+                match = pattern.search(file)
+                version = int(file[match.start() + 1:match.end()])
+                if version > highest:
+                    highest = version
+        if highest == 0:
+            return None
+        filename = "./clientmanifests/%s_%s" % (clientname, highest)
+    platform = pattern.sub("", basename(filename)).split("_")
+    platform = platform[len(platform) - 1]
+    with open(filename, "r") as f:
+        return loads(f.read()), platform
+
+def client_packages(client_manifest, platform, download_zip=True, download_vz=False):
+    """Returns (package name, filename, sha2) for every package file of a
+    client manifest in the formats we want."""
     packages = {}
     for package_name, package in client_manifest[platform].items():
+        if package_name == "version":
+            continue
         packages[package_name] = package
         for key, value in package.items():
             if type(value) == dict and value["file"]:
                 packages[package_name + "_" + key] = value
-    packages_by_sha2 = {}
+    wanted = []
+    for package_name, package in packages.items():
+        # ZIP
+        if (download_zip or "zipvz" not in package) and "file" in package:
+            wanted.append((package_name, package['file'], package['sha2']))
+        # VZ
+        if (download_vz or "file" not in package) and "zipvz" in package:
+            wanted.append((package_name, package['zipvz'], package['sha2vz']))
+    return wanted
+
+def download_packages(client_manifests, download_zip=True, download_vz=False, workers=8, retries=3):
+    """Downloads the packages of one or more client manifests, given as a list
+    of (client manifest, platform). Each distinct package is downloaded once,
+    and every other filename it's listed under is linked to it."""
+    makedirs("./clientpackages", exist_ok=True)
+    wanted = []
+    for client_manifest, platform in client_manifests:
+        print("Downloading packages for %s client version %s" % (platform, client_manifest[platform]['version']))
+        wanted.extend(client_packages(client_manifest, platform, download_zip, download_vz))
+    hashes = HashCache()
+    # packages we already have, from this or any other client version
+    packages_by_sha2 = hashes.by_sha2()
+    # one connection per worker, reused between packages
+    session = r.Session()
+    session.mount("https://", r.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers))
 
     # Check if a package is already on disk with the expected checksum
-    def test_existing_file(file, expected_sha):
-        with open(file, "rb") as f:
-            if (sha256(f.read()).hexdigest()) == expected_sha:
-                print("Package", package_name, "already up-to-date (" + file + ")")
-                return True
-            else:
-                return False
+    def test_existing_file(file, expected_sha, package_name):
+        if hashes.sha256(file) == expected_sha:
+            print("Package", package_name, "already up-to-date (" + file + ")")
+            return True
+        else:
+            return False
 
     # Symlink or copy an existing package
     def handle_existing_package(package_file, existing_file):
@@ -60,50 +178,82 @@ def download_packages(client_manifest, platform, download_zip=True, download_vz=
             if type(e) != FileExistsError:
                 copy("./clientpackages/" + existing_file, "./clientpackages/" + package_file)
 
-    # Download a package file
-    def download_file(file, package_name):
-        response = r.get(CDN_ROOT + file)
-        if response.ok:
-            with open("./clientpackages/" + file, "wb") as f:
-                f.write(response.content)
-            print("Saved package", package_name, "(" + file + ")")
-            return True
-        else:
-            print(f"Unable to download package {package_name}: {response.status_code}")
-            return False
+    # Download a package file to a temporary file, hashing it as it's written,
+    # and only move it into place if the hash matches. This runs in several
+    # threads at once, so each line is printed in a single write
+    def download_file(file, package_name, expected_sha):
+        target = "./clientpackages/" + file
+        for attempt in range(retries + 1):
+            if attempt:
+                sleep(2 ** attempt)
+            try:
+                with session.get(CDN_ROOT + file, stream=True, timeout=60) as response:
+                    if not response.ok:
+                        print(f"Unable to download package {package_name}: {response.status_code}\n", end="")
+                        if 400 <= response.status_code < 500:
+                            return False
+                        continue
+                    hasher = sha256()
+                    with open(target + ".tmp", "wb") as f:
+                        for data in response.iter_content(1024 * 1024):
+                            hasher.update(data)
+                            f.write(data)
+                if hasher.hexdigest() != expected_sha:
+                    print(f"Package {package_name} ({file}) doesn't match its checksum\n", end="")
+                    continue
+                replace(target + ".tmp", target)
+                print(f"Saved package {package_name} ({file})\n", end="")
+                return True
+            except r.RequestException as e:
+                print(f"Error downloading package {package_name}: {e}\n", end="")
+        if exists(target + ".tmp"):
+            remove(target + ".tmp")
+        print(f"\033[31mGiving up on package {package_name} ({file}) after {retries} retries\033[0m\n", end="")
+        return False
 
-    # Perform all the above steps for a specific package (check if it exists on-disk, if not download it)
-    def check_package(package_name, filename, sha2, packages_by_sha2):
-        if sha2 in packages_by_sha2:
-            handle_existing_package(filename, packages_by_sha2[sha2])
-            return True
+    # Work out which files are needed and whether they're already on disk.
+    # Packages with the same checksum are only downloaded once and linked to
+    # each other afterwards
+    to_download = {}
+    duplicates = []
+    for package_name, filename, sha2 in wanted:
+        if packages_by_sha2.get(sha2) == filename:
+            print("Package", package_name, "already up-to-date (./clientpackages/" + filename + ")")
+        elif sha2 in packages_by_sha2 or sha2 in to_download:
+            duplicates.append((filename, sha2))
+        elif exists("./clientpackages/" + filename) and test_existing_file("./clientpackages/" + filename, sha2, package_name):
+            packages_by_sha2[sha2] = filename
         else:
-            if exists("./clientpackages/" + filename) and test_existing_file("./clientpackages/" + filename, sha2):
-                packages_by_sha2[sha2] = filename
-                return True
-            else:
-                if download_file(filename, package_name):
-                    packages_by_sha2[sha2] = filename
-                    return True
-                else:
-                    return False
+            to_download[sha2] = (filename, package_name)
 
-    # Run check_package for each package and the format we want
-    for package_name, package in packages.items():
-        # ZIP
-        if (download_zip or "zipvz" not in package) and "file" in package:
-            if not check_package(package_name, package['file'], package['sha2'], packages_by_sha2): return False
-        # VZ
-        if (download_vz or "file" not in package) and "zipvz" in package:
-            if not check_package(package_name, package['zipvz'], package['sha2vz'], packages_by_sha2): return False
-    return True
+    failed = 0
+    with ThreadPoolExecutor(workers) as executor:
+        results = executor.map(lambda item: (item[0], download_file(item[1][0], item[1][1], item[0])), to_download.items())
+        for sha2, ok in results:
+            if ok:
+                packages_by_sha2[sha2] = to_download[sha2][0]
+                hashes.record("./clientpackages/" + to_download[sha2][0], sha2)
+            else:
+                failed += 1
+    session.close()
+    for filename, sha2 in duplicates:
+        if sha2 in packages_by_sha2 and packages_by_sha2[sha2] != filename:
+            handle_existing_package(filename, packages_by_sha2[sha2])
+    hashes.save()
+    print(hashes)
+    if failed:
+        print(f"\033[31m{failed} {'package' if failed == 1 else 'packages'} failed to download\033[0m")
+    return not failed
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="Downloads a version of the Steam client from CDN")
-    parser.add_argument("clientname", nargs="?", help="name of the client to download (e.g. \"steam_client_win32\")", default="steam_client_win32")
+    parser.add_argument("clientnames", metavar="clientname", nargs="*", help="name of the client to download (e.g. \"steam_client_win32\"). If more than one is given, their manifests are fetched at once and packages they share are only downloaded once")
+    parser.add_argument("-f", dest="clientname_file", help="file to read more client names from, one per line")
     parser.add_argument("-l", dest="local", help="don't download a new manifest, just try to download packages for manifests that have already been downloaded (cannot be used with -s or -d)", action="store_true")
     parser.add_argument("-s", dest="skip_previous_manifests", help="dry run (skip package download) if the latest manifest was previously downloaded", action="store_true")
     parser.add_argument("-d", dest="dry_run", help="force dry run (unconditionally skip downloading packages)", action="store_true")
+    parser.add_argument("-j", dest="workers", type=int, help="number of packages to download at once (default 8)", default=8)
+    parser.add_argument("-r", dest="retries", type=int, help="number of times to retry a package that fails to download or doesn't match its checksum (default 3)", default=3)
     parser.add_argument("-t", dest="archive_type", help="type of package archive to download (zip will always be downloaded if a particular file is not available as vz)", choices=["zip", "vz", "both"], default="zip")
     args = parser.parse_args()
     if args.archive_type == "zip":
@@ -115,43 +265,38 @@ if __name__ == "__main__":
     else:
         download_zip = True
         download_vz = True
+    clientnames = args.clientnames
+    if args.clientname_file:
+        with open(args.clientname_file, "r") as f:
+            clientnames += [line.strip() for line in f.read().split("\n") if line.strip() and not line.startswith("#")]
+    if not clientnames:
+        clientnames = ["steam_client_win32"]
     if (args.local) and (args.skip_previous_manifests or args.dry_run):
         print("invalid combination of arguments")
         parser.print_help()
         exit(1)
     elif args.local:
-        pattern = compile("_\d+$")
-        if exists(args.clientname):
-            platform = pattern.sub("", basename(args.clientname)).split("_")
-            platform = platform[len(platform) - 1]
-            with open(args.clientname, "r") as f:
-                exit(0 if download_packages(loads(f.read()), platform, download_zip, download_vz) else 1)
-        elif exists("./clientmanifests/" + args.clientname):
-            platform = pattern.sub("", basename("./clientmanifests/" + args.clientname)).split("_")
-            platform = platform[len(platform) - 1]
-            with open("./clientmanifests/" + args.clientname, "r") as f:
-                exit(0 if download_packages(loads(f.read()), platform, download_zip, download_vz) else 1)
-        else:
-            # try to find the newest manifest we downloaded
-            highest = 0
-            for file in listdir("./clientmanifests/"):
-                if pattern.sub("", file) == args.clientname:
-                    match = pattern.search(file)
-                    version = int(file[match.start() + 1:match.end()])
-                    if version > highest:
-                        highest = version
-            if highest == 0:
-                print("can't find manifest " + args.clientname)
+        client_manifests = []
+        for clientname in clientnames:
+            loaded = load_local_manifest(clientname)
+            if not loaded:
+                print("can't find manifest " + clientname)
                 exit(1)
-            platform = basename("./clientmanifests/" + args.clientname).split("_")
-            platform = platform[len(platform) - 1]
-            with open("./clientmanifests/%s_%s" % (args.clientname, highest), "r") as f:
-                exit(not download_packages(loads(f.read()), platform, download_zip, download_vz))
-    elif args.dry_run:
-        save_client_manifest(args.clientname)
+            client_manifests.append(loaded)
+        exit(0 if download_packages(client_manifests, download_zip, download_vz, args.workers, args.retries) else 1)
     else:
-        keyvalues, platform, previously_existed = save_client_manifest(args.clientname)
-        if args.skip_previous_manifests and previously_existed:
-            exit(0)
-        else:
-            exit(not download_packages(keyvalues, platform, download_zip, download_vz))
+        def try_save_client_manifest(clientname):
+            try:
+                return save_client_manifest(clientname)
+            except Exception as e:
+                print(f"\033[31mUnable to get client manifest {clientname}: {e}\033[0m")
+                return None
+        with ThreadPoolExecutor(min(len(clientnames), args.workers)) as executor:
+            saved = list(executor.map(try_save_client_manifest, clientnames))
+        failed = saved.count(None)
+        if args.dry_run:
+            exit(failed)
+        client_manifests = [(keyvalues, platform) for keyvalues, platform, previously_existed in filter(None, saved) if not (args.skip_previous_manifests and previously_existed)]
+        if client_manifests and not download_packages(client_manifests, download_zip, download_vz, args.workers, args.retries):
+            failed += 1
+        exit(failed)
@@ -4,10 +4,94 @@ from binascii import hexlify
 from steam.client import SteamClient
 from steam.core.msg import MsgProto
 from steam.enums.emsg import EMsg
-from os.path import exists
+from os import O_APPEND, O_CREAT, O_WRONLY, close, fsync, open as open_fd, write
+from time import time
+from gevent.queue import Empty, Queue
+from steam.enums import EResult
+from steam.exceptions import SteamError
 from sys import argv
 from vdf import loads
 from login import auto_login
+from broker import BROKER_SOCKET, connect_broker
+from appinfo import has_appinfo, save_appinfo
+from catalog import Catalog
+from keystore import KeyStore
+from pics import ProductInfoFetcher, app_groups, get_app_tokens
+
+def fetch_depot_keys(steam_client, wanted, on_key, window=16, retries=3, timeout=10):
+    """Requests the keys for a list of (app, depot, name), keeping up to
+    window requests in flight. on_key(app, depot, name, key) is called for
+    each key as it arrives. When Steam says we're going too fast, the window
+    is halved and nothing new is sent for a pause (the requests in flight are
+    still collected), then the throttled requests are sent again; it grows
+    back by one for every key received. Returns the requests that failed.
+
+    Through the broker, keys are asked for in batches of a few windows' worth,
+    which the broker sends window at a time; it caches them, so only the ones
+    it doesn't have yet go to Steam."""
+    if getattr(steam_client, "brokered", False):
+        failed = []
+        for start in range(0, len(wanted), window * 4):
+            batch = wanted[start:start + window * 4]
+            try:
+                responses = steam_client.get_depot_keys(batch)
+            except (SteamError, OSError):
+                responses = [None] * len(batch)
+            for request, response in zip(batch, responses):
+                if response is None:
+                    failed.append(request)
+                elif response.eresult == EResult.OK:
+                    on_key(*request, response.depot_encryption_key)
+                else:
+                    print("error getting key for depot %s: %r" % (request[1], EResult(response.eresult)))
+        return failed
+    responses = Queue()
+    pending = [(request, 0) for request in reversed(wanted)]
+    inflight = {} # job -> [request, attempt, deadline]
+    limit = window
+    paused_until = 0 # no new requests until then, after being rate limited
+    failed = []
+    while pending or inflight:
+        while pending and len(inflight) < int(limit) and time() >= paused_until:
+            request, attempt = pending.pop()
+            msg = MsgProto(EMsg.ClientGetDepotDecryptionKey)
+            msg.body.app_id, msg.body.depot_id = request[0], request[1]
+            job = steam_client.send_job(msg)
+            steam_client.on(job, lambda msg, job=job: responses.put((job, msg)))
+            inflight[job] = [request, attempt, time() + timeout]
+        wakeups = [entry[2] for entry in inflight.values()]
+        if pending and paused_until > time():
+            wakeups.append(paused_until)
+        try:
+            job, msg = responses.get(timeout=max(min(wakeups) - time(), 0))
+        except Empty:
+            job, msg = None, None
+        if job in inflight:
+            request, attempt, _ = inflight.pop(job)
+            steam_client.remove_all_listeners(job)
+            if msg.body.eresult == EResult.RateLimitExceeded:
+                pending.append((request, attempt))
+                if time() >= paused_until: # the other answers to the same burst don't count
+                    limit = max(limit / 2, 1)
+                    paused_until = time() + timeout
+                    print("Rate limited, slowing down to %s requests at once" % int(limit))
+            elif msg.body.eresult == EResult.OK:
+                limit = min(limit + 1, window)
+                on_key(*request, msg.body.depot_encryption_key)
+            else:
+                print("error getting key for depot %s: %r" % (request[1], EResult(msg.body.eresult)))
+        # answers that have already arrived aren't timeouts
+        expired = [job for job, entry in inflight.items() if entry[2] <= time()] if responses.empty() else []
+        if expired:
+            limit = max(limit / 2, 1)
+        for job in expired:
+            request, attempt, _ = inflight.pop(job)
+            steam_client.remove_all_listeners(job)
+            if attempt < retries:
+                pending.append((request, attempt + 1))
+            else:
+                failed.append(request)
+    return failed
 
 if __name__ == "__main__":
     parser = ArgumentParser(description='Request and save depot keys.')
@@ -16,17 +100,26 @@ if __name__ == "__main__":
     parser.add_argument("-i", help="Log into a Steam account interactively.", dest="interactive", action="store_true")
     parser.add_argument("-u", type=str, help="Username for non-interactive login", dest="username", nargs="?")
     parser.add_argument("-p", type=str, help="Password for non-interactive login", dest="password", nargs="?")
+    parser.add_argument("-w", type=int, help="Maximum number of key requests to have in flight at once (default 16)", dest="window", default=16)
+    parser.add_argument("-r", type=int, help="Number of times to retry a key request that times out (default 3)", dest="retries", default=3)
     args = parser.parse_args()
-    steam_client = SteamClient()
-    print("Connecting to the Steam network...")
-    steam_client.connect()
-    print("Logging in...")
-    if args.interactive:
-        auto_login(steam_client, fallback_anonymous=False, relogin=False)
-    elif args.username:
-        auto_login(steam_client, args.username, args.password)
+    catalog = Catalog()
+    # share the broker's session if it's running, unless we were asked to
+    # log in as someone in particular
+    steam_client = None if args.interactive or args.username else connect_broker()
+    if steam_client:
+        print("Using the Steam session from the broker on", BROKER_SOCKET)
     else:
-        auto_login(steam_client)
+        steam_client = SteamClient()
+        print("Connecting to the Steam network...")
+        steam_client.connect()
+        print("Logging in...")
+        if args.interactive:
+            auto_login(steam_client, fallback_anonymous=False, relogin=False)
+        elif args.username:
+            auto_login(steam_client, args.username, args.password)
+        else:
+            auto_login(steam_client)
     licensed_packages = []
     licensed_apps = []
     licensed_depots = []
@@ -71,78 +164,64 @@ if __name__ == "__main__":
                             print("Found license for depot %s" % depot)
                             licensed_depots.append(depot)
 
-    msg = MsgProto(EMsg.ClientPICSProductInfoRequest)
-    tokens = steam_client.get_access_tokens(app_ids=licensed_apps)
-    for app in licensed_apps:
-        body_app = msg.body.apps.add()
-        body_app.appid = app
-        if 'apps' in tokens.keys() and app in tokens['apps'].keys():
-            body_app.access_token = tokens['apps'][app]
-    job = steam_client.send_job(msg)
     appinfo_response = []
-    response = steam_client.wait_event(job)[0].body
-    for app in response.apps:
-        appinfo_response.append(app)
-    while response.response_pending:
-        response = steam_client.wait_event(job)[0].body
-        for app in response.apps:
-            appinfo_response.append(app)
+    fetcher = ProductInfoFetcher(steam_client, get_app_tokens(steam_client, licensed_apps),
+            window=min(4, args.window), max_window=args.window, retries=args.retries)
+    fetcher.fetch(app_groups(licensed_apps), appinfo_response.extend)
     app_dict = {}
     for app in appinfo_response:
-        appinfo_path = "./appinfo/%s_%s.vdf" % (app.appid, app.change_number)
         app_dict[app.appid] = loads(app.buffer[:-1].decode('utf-8', 'replace'))['appinfo']
-        if not exists(appinfo_path):
-            with open(appinfo_path, "wb") as f:
-                f.write(app.buffer[:-1])
+        if not has_appinfo(app.appid, app.change_number, catalog):
+            save_appinfo(app.appid, app.change_number, app.buffer[:-1], catalog)
             try:
                 print("Saved appinfo for app", app.appid, "changenumber", app.change_number, app_dict[app.appid]['common']['name'])
             except KeyError:
                 print("Saved appinfo for app", app.appid, "changenumber", app.change_number)
 
-    keys_saved = []
-    if exists("./depot_keys.txt"):
-        with open("./depot_keys.txt", "r", encoding="utf-8") as f:
-            for line in f.read().split("\n"):
-                try:
-                    keys_saved.append(int((line.split("\t")[0])))
-                except ValueError:
-                    continue
+    keys_saved = KeyStore(keys_dir=None)
+    if len(keys_saved):
         print("%s keys already saved in depot_keys.txt" % len(keys_saved))
-    with open("./depot_keys.txt", "a", encoding="utf-8", newline="\n") as f:
-        for app, app_info in app_dict.items():
-            if not app in licensed_apps:
+    requested = set()
+    wanted = []
+    for app, app_info in app_dict.items():
+        if not app in licensed_apps:
+            continue
+        if args.apps:
+            if app not in args.apps:
                 continue
-            if args.apps:
-                if app not in args.apps:
-                    continue
-            if not 'depots' in app_info:
+        if not 'depots' in app_info:
+            continue
+        if not app in app_info['depots']:
+            app_info['depots'][app] = {'name': app_info['common']['name']}
+        for depot, info in app_info['depots'].items():
+            try:
+                depot = int(depot)
+            except ValueError:
                 continue
-            if not app in app_info['depots']:
-                app_info['depots'][app] = {'name': app_info['common']['name']}
-            for depot, info in app_info['depots'].items():
-                try:
-                    depot = int(depot)
-                except ValueError:
-                    continue
-                if args.depots:
-                    if depot not in args.depots:
-                        continue
-                if depot in keys_saved:
-                    print("skipping previously saved key for depot", depot)
+            if args.depots:
+                if depot not in args.depots:
                     continue
-                if (depot in licensed_depots) or (depot in licensed_apps):
-                    try:
-                        key = steam_client.get_depot_key(app, depot).depot_encryption_key
-                    except AttributeError:
-                        print("error getting key for depot", depot)
-                        continue
-                    else:
-                        keys_saved.append(depot)
-                        if key != b'':
-                            key_hex = hexlify(key).decode()
-                            if 'name' in info.keys():
-                                f.write("%s\t\t%s\t%s" % (depot, key_hex, info['name']) + "\n")
-                                print("%s\t\t%s\t%s" % (depot, key_hex, info['name']))
-                            else:
-                                f.write("%s\t\t%s" % (depot, key_hex) + "\n")
-                                print("%s\t\t%s" % (depot, key_hex))
+            if depot in keys_saved or depot in requested:
+                print("skipping previously saved key for depot", depot)
+                continue
+            if (depot in licensed_depots) or (depot in licensed_apps):
+                requested.add(depot)
+                wanted.append((app, depot, info['name'] if 'name' in info.keys() else None))
+
+    # each key is written with a single append and synced, so a crash can't
+    # leave a partial line behind
+    keyfile = open_fd("./depot_keys.txt", O_WRONLY | O_APPEND | O_CREAT, 0o644)
+    def on_key(app, depot, name, key):
+        if key != b'':
+            key_hex = hexlify(key).decode()
+            if name:
+                line = "%s\t\t%s\t%s" % (depot, key_hex, name)
+            else:
+                line = "%s\t\t%s" % (depot, key_hex)
+            write(keyfile, (line + "\n").encode("utf-8"))
+            fsync(keyfile)
+            print(line)
+    failed = fetch_depot_keys(steam_client, wanted, on_key, args.window, args.retries)
+    close(keyfile)
+    for app, depot, name in failed:
+        print("error getting key for depot", depot)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from binascii import hexlify
+from glob import glob
+from os import replace, stat
+from os.path import basename, exists
+from struct import Struct
+
+KEYS_FILE = "./depot_keys.txt"
+KEYS_DIR = "./keys/"
+INDEX_FILE = "./depot_keys.idx"
+
+# index header: magic, then the size and mtime_ns of the depot_keys.txt it
+# was built from; then one record per depot, sorted by depot
+INDEX_HEADER = Struct("<8sQQ")
+INDEX_RECORD = Struct("<I32s")
+INDEX_MAGIC = b"DKIDX\x00\x00\x01"
+
+class KeyStore():
+    """Every depot key we have, loaded once into a dict.
+
+    Keys come from depot_keys.txt ("depot<TAB><TAB>key hex[<TAB>name]" lines,
+    as written by get_depot_keys.py) and from keys/<depot>.depotkey files (the
+    raw 32 byte key). A depotkey file wins over depot_keys.txt, and the first
+    line for a depot wins over later ones. Depots with more than one distinct
+    key are listed in conflicts.
+
+    If an index file is given and it was built from the current
+    depot_keys.txt, keys are read from it instead of parsing the text."""
+    def __init__(self, filename=KEYS_FILE, keys_dir=KEYS_DIR, index=None):
+        self.filename = filename
+        self.keys_dir = keys_dir
+        self.index = index
+        self.keys = {} # depot -> key
+        self.names = {} # depot -> name, only when loaded from the text file
+        self.conflicts = {} # depot -> set of keys
+        self.source = None
+        self.load()
+    def __repr__(self):
+        return f"Key store {self.filename} ({len(self.keys)} keys from {self.source}, {len(self.conflicts)} conflicting)"
+    def __len__(self):
+        return len(self.keys)
+    def __contains__(self, depot):
+        return int(depot) in self.keys
+    def __getitem__(self, depot):
+        return self.keys[int(depot)]
+    def get(self, depot, default=None):
+        return self.keys.get(int(depot), default)
+    def stamp(self):
+        """(size, mtime_ns) of depot_keys.txt, or None if it doesn't exist."""
+        if not exists(self.filename):
+            return None
+        st = stat(self.filename)
+        return st.st_size, st.st_mtime_ns
+    def add(self, depot, key, name=None):
+        if depot in self.keys and self.keys[depot] != key:
+            self.conflicts.setdefault(depot, set([self.keys[depot]])).add(key)
+            return
+        self.keys[depot] = key
+        if name:
+            self.names[depot] = name
+    def load(self):
+        self.keys, self.names, self.conflicts = {}, {}, {}
+        self.loaded = self.stamp()
+        if not (self.index and self.load_index()):
+            self.load_text()
+        for keyfile in glob(self.keys_dir + "*.depotkey") if self.keys_dir else []:
+            depot = basename(keyfile)[:-len(".depotkey")]
+            if not depot.isdigit():
+                continue
+            with open(keyfile, "rb") as f:
+                key = f.read()
+            depot = int(depot)
+            if depot in self.keys and self.keys[depot] != key:
+                self.conflicts.setdefault(depot, set([self.keys[depot]])).add(key)
+            self.keys[depot] = key
+    def load_text(self):
+        self.source = self.filename
+        if not self.loaded:
+            return
+        with open(self.filename, "r", encoding="utf-8") as f:
+            for line in f.read().split("\n"):
+                line = line.split("\t")
+                if len(line) < 3 or not line[0].isdigit():
+                    continue
+                try:
+                    key = bytes.fromhex(line[2])
+                except ValueError:
+                    continue
+                if len(key) != 32:
+                    continue # a line cut short
+                self.add(int(line[0]), key, line[3] if len(line) > 3 else None)
+    def load_index(self):
+        """Loads the keys from the index. Returns False if there's no index,
+        or it's out of date."""
+        if not self.loaded or not exists(self.index):
+            return False
+        with open(self.index, "rb") as f:
+            data = f.read()
+        if len(data) < INDEX_HEADER.size:
+            return False
+        magic, size, mtime_ns = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or (size, mtime_ns) != self.loaded:
+            return False
+        self.keys = dict(INDEX_RECORD.iter_unpack(memoryview(data)[INDEX_HEADER.size:]))
+        self.source = self.index
+        return True
+    def write_index(self, index=None):
+        """Writes the keys from depot_keys.txt (not the depotkey files) to an
+        index, atomically. Conflicting depots keep the key that won."""
+        index = index or self.index or INDEX_FILE
+        text = KeyStore(self.filename, keys_dir=None)
+        with open(index + ".tmp", "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, *(text.loaded or (0, 0))))
+            for depot in sorted(text.keys.keys()):
+                f.write(INDEX_RECORD.pack(depot, text.keys[depot]))
+        replace(index + ".tmp", index)
+        return len(text.keys)
+    def refresh(self):
+        """Reloads the keys if depot_keys.txt has changed since they were
+        loaded."""
+        if self.stamp() != self.loaded:
+            self.load()
+
+default_keystore = None
+
+def find_depot_key(depotid):
+    """Looks up a depot's key in ./keys/<depotid>.depotkey, then in
+    ./depot_keys.txt. Returns None if neither has it. The keys are loaded
+    once per process, and again if depot_keys.txt changes."""
+    global default_keystore
+    if default_keystore is None:
+        default_keystore = KeyStore(index=INDEX_FILE)
+    else:
+        default_keystore.refresh()
+    return default_keystore.get(depotid)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Check the depot keys in %s and %s*.depotkey, or look some up.' % (KEYS_FILE, KEYS_DIR))
+    parser.add_argument('depotids', metavar='depotid', type=int, nargs='*', help='depots to print the key of')
+    parser.add_argument('--index', help="write a binary index of %s to %s, which is read instead of the text file while it's up to date" % (KEYS_FILE, INDEX_FILE), action="store_true")
+    args = parser.parse_args()
+    keystore = KeyStore()
+    print(keystore)
+    for depot, keys in sorted(keystore.conflicts.items()):
+        print("\033[31mdepot %s has %s different keys:\033[0m %s (using %s)" % (depot, len(keys), ", ".join(sorted(hexlify(key).decode() for key in keys)), hexlify(keystore[depot]).decode()))
+    for depot in args.depotids:
+        key = keystore.get(depot)
+        print("%s\t\t%s" % (depot, hexlify(key).decode() if key else "no key"))
+    if args.index:
+        print("Wrote", keystore.write_index(INDEX_FILE), "keys to", INDEX_FILE)
@@ -7,6 +7,7 @@ from struct import pack, unpack, iter_unpack
 from vdf import dumps
 from sys import stderr
 from chunkstore import Chunkstore
+from catalog import Catalog
 
 def pack_backup(depot, destdir, decrypted=False, no_update=False):
     csd_target = destdir + "/" + str(depot) + "_depotcache_1.csd"
@@ -69,6 +70,9 @@ def pack_backup(depot, destdir, decrypted=False, no_update=False):
             print(f"depot {depot}: added chunk {chunk} ({chunks_added}/{len(chunks)})")
         print("writing index...")
         chunkstore.write_csm()
+        catalog = Catalog()
+        catalog.add_chunkstore(chunkstore)
+        catalog.close()
         print("packed", len(chunks), "chunk" if len(chunks) == 1 else "chunks")
         csd.seek(0, 2)
         return csd.tell()
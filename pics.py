@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+from time import time
+
+from gevent.queue import Empty, Queue
+from steam.core.msg import MsgProto
+from steam.enums import EResult
+from steam.enums.emsg import EMsg
+from steam.exceptions import SteamError
+
+# the maximum number of apps PICS will give us in one message
+GROUP_SIZE = 30
+# apps to ask for access tokens for in one message
+TOKEN_BATCH_SIZE = 1000
+# results Steam sends when we're asking too fast
+THROTTLED = (EResult.Busy, EResult.ServiceUnavailable, EResult.LimitExceeded, EResult.RateLimitExceeded, EResult.TryAnotherCM)
+
+def app_groups(appids, size=GROUP_SIZE):
+    return [appids[i:i + size] for i in range(0, len(appids), size)]
+
+def get_app_tokens(steam_client, appids, batch_size=TOKEN_BATCH_SIZE):
+    """Returns {appid: access token} for the apps we got a token for, asking
+    for them in batches so a big list doesn't time out."""
+    tokens = {}
+    for batch in [appids[i:i + batch_size] for i in range(0, len(appids), batch_size)]:
+        response = steam_client.get_access_tokens(app_ids=batch)
+        if not response:
+            print("Timeout reached getting tokens for %s %s" % (len(batch), "app" if len(batch) == 1 else "apps"))
+            continue
+        tokens.update({appid: token for appid, token in response['apps'].items() if token != 0})
+    return tokens
+
+def changes_since(steam_client, since, app_changes=True, timeout=60):
+    """Asks PICS what has changed since a changenumber. Returns the
+    ClientPICSChangesSinceResponse body, or None if it timed out."""
+    if getattr(steam_client, "brokered", False):
+        return steam_client.pics_changes(since, app_changes)
+    msg = MsgProto(EMsg.ClientPICSChangesSinceRequest)
+    msg.body.since_change_number = since
+    msg.body.send_app_info_changes = app_changes
+    response = steam_client.wait_event(steam_client.send_job(msg), timeout)
+    return response[0].body if response else None
+
+class ProductInfoFetcher():
+    """Sends ClientPICSProductInfoRequests for groups of apps, keeping several
+    of them in flight on the connection at once.
+
+    The window of requests in flight grows by one whenever a request completes
+    in less than twice the best latency seen so far, and is halved when
+    requests time out or Steam says we're going too fast; in the latter case
+    nothing new is sent for a while, but answers to the requests in flight
+    are still collected. A request that
+    doesn't complete is retried up to `retries` times, then given up on.
+
+    With a broker client (see broker.py) the broker does all of this, and the
+    groups are just handed to it a few at a time."""
+    def __init__(self, steam_client, tokens={}, window=4, max_window=16, timeout=15, retries=3):
+        self.steam_client = steam_client
+        self.tokens = tokens # appid -> access token
+        self.window = window
+        self.max_window = max_window
+        self.timeout = timeout
+        self.retries = retries
+        self.best_latency = None
+        self.requests = 0
+        self.timeouts = 0
+        self.throttled = 0
+    def __repr__(self):
+        return f"PICS product info fetcher: window {int(self.window)}/{self.max_window}, {self.requests} requests, {self.timeouts} timeouts, {self.throttled} throttled"
+    def send(self, group):
+        msg = MsgProto(EMsg.ClientPICSProductInfoRequest)
+        for appid in group:
+            msg_app = msg.body.apps.add()
+            msg_app.appid = appid
+            if self.tokens.get(appid):
+                msg_app.access_token = self.tokens[appid]
+        self.requests += 1
+        return self.steam_client.send_job(msg)
+    def grow(self, latency):
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        if latency < self.best_latency * 2:
+            self.window = min(self.window + 1, self.max_window)
+    def shrink(self):
+        self.window = max(self.window / 2, 1)
+    def fetch(self, groups, on_apps, on_group=None):
+        """Requests product info for every group of appids. on_apps(apps) is
+        called with the apps in each message as it arrives (a response can be
+        split over several messages if response_pending is set), and
+        on_group(group) once all of a group's messages have arrived. Returns
+        the groups that failed every retry."""
+        if getattr(self.steam_client, "brokered", False):
+            return self.fetch_brokered(groups, on_apps, on_group)
+        responses = Queue()
+        pending = [(group, 0) for group in reversed(groups)]
+        inflight = {} # job -> [group, attempt, sent, deadline]
+        paused_until = 0 # no new requests until then, after being throttled
+        failed = []
+        while pending or inflight:
+            while pending and len(inflight) < int(self.window) and time() >= paused_until:
+                group, attempt = pending.pop()
+                job = self.send(group)
+                # the listener has to be there before gevent gets a chance to
+                # deliver the response
+                self.steam_client.on(job, lambda msg, job=job: responses.put((job, msg)))
+                inflight[job] = [group, attempt, time(), time() + self.timeout]
+            wakeups = [entry[3] for entry in inflight.values()]
+            if pending and paused_until > time():
+                wakeups.append(paused_until)
+            wait = max(min(wakeups) - time(), 0)
+            try:
+                job, msg = responses.get(timeout=wait)
+            except Empty:
+                job, msg = None, None
+            if job in inflight:
+                group, attempt, sent, _ = inflight[job]
+                if msg.header.HasField("eresult") and msg.header.eresult in THROTTLED:
+                    self.throttled += 1
+                    del inflight[job]
+                    self.steam_client.remove_all_listeners(job)
+                    pending.append((group, attempt)) # not the group's fault
+                    if time() >= paused_until: # the other answers to the same burst don't count
+                        print("Steam PICS is busy (%r), backing off" % EResult(msg.header.eresult))
+                        self.shrink()
+                        paused_until = time() + self.timeout / 3
+                else:
+                    on_apps(msg.body.apps)
+                    if msg.body.response_pending:
+                        inflight[job][3] = time() + self.timeout
+                    else:
+                        del inflight[job]
+                        self.steam_client.remove_all_listeners(job)
+                        self.grow(time() - sent)
+                        if on_group:
+                            on_group(group)
+            # give up on every request that's past its deadline, unless its
+            # answer has already arrived
+            expired = [job for job, entry in inflight.items() if entry[3] <= time()] if responses.empty() else []
+            if expired:
+                self.shrink()
+            for job in expired:
+                group, attempt, _, _ = inflight.pop(job)
+                self.steam_client.remove_all_listeners(job)
+                self.timeouts += 1
+                if attempt < self.retries:
+                    print("Timeout reached for %s %s, retrying..." % (len(group), "app" if len(group) == 1 else "apps"))
+                    pending.append((group, attempt + 1))
+                else:
+                    print("\033[31mGiving up on %s %s after %s retries\033[0m" % (len(group), "app" if len(group) == 1 else "apps", self.retries))
+                    failed.append(group)
+        return failed
+    def fetch_brokered(self, groups, on_apps, on_group=None):
+        failed = []
+        for batch in [groups[i:i + self.max_window] for i in range(0, len(groups), self.max_window)]:
+            self.requests += 1
+            try:
+                apps, unanswered = self.steam_client.pics_product_info([appid for group in batch for appid in group], self.tokens)
+            except (SteamError, OSError) as e:
+                print("\033[31mGiving up on %s groups of apps:\033[0m %s" % (len(batch), e))
+                failed += batch
+                continue
+            on_apps(apps)
+            unanswered = set(unanswered)
+            for group in batch:
+                if unanswered.intersection(group):
+                    self.timeouts += 1
+                    print("\033[31mThe broker couldn't get %s %s\033[0m" % (len(group), "app" if len(group) == 1 else "apps"))
+                    failed.append(group)
+                elif on_group:
+                    on_group(group)
+        return failed
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from binascii import hexlify
+from glob import glob
+from json import dump, load
+from os import getpid, nice, replace, scandir
+from os.path import exists
+from time import sleep, time
+from chunkledger import ChunkLedger, LEDGER_FILE
+
+STATE_FILE = "./scrub_state.json"
+METRICS_FILE = "./scrub_metrics.json"
+
+if __name__ == "__main__": # exit before we import our shit if the args are wrong
+    parser = ArgumentParser(description='Slowly validate every depot in ./depots and every chunkstore in rotation, forever. The position in the archive is saved, so the scrubber picks up where it left off when restarted.')
+    parser.add_argument('-r', dest="rate", help="maximum MB/s of chunks to read (default 20, 0 for unlimited)", type=float, default=20)
+    parser.add_argument('-n', dest="niceness", help="CPU niceness to add to the process (default 10)", type=int, default=10)
+    parser.add_argument('-c', dest="chunkstores", help="directory to scrub .csd/.csm chunkstores in (can be used multiple times; default .)", action="append")
+    parser.add_argument('--interval', help="hours to wait between passes over the archive (default 1)", type=float, default=1)
+    parser.add_argument('--once', help="exit after one pass over the archive instead of starting over", action="store_true")
+    parser.add_argument('--reverify', help="days after which chunks are validated again even if they haven't changed (default 30)", type=float, default=30)
+    parser.add_argument('--ledger', help="path to the ledger of validated chunks (default %s)" % LEDGER_FILE, default=LEDGER_FILE)
+    parser.add_argument('--state', help="path to save the scrubber's position to (default %s)" % STATE_FILE, default=STATE_FILE)
+    parser.add_argument('--metrics', help="path to publish progress and corruption metrics to as JSON (default %s)" % METRICS_FILE, default=METRICS_FILE)
+    parser.add_argument('-o', dest="output", help="file to append bad chunks to, in the same format as depot_validator (default bad_chunks.txt)", default="bad_chunks.txt")
+    args = parser.parse_args()
+
+from depot_validator import list_chunkstore_chunks, list_loose_chunks, make_batches, validate_batch
+from keystore import find_depot_key
+
+def save_json(filename, data):
+    with open(filename + ".tmp", "w", encoding="utf-8") as f:
+        dump(data, f, indent=1)
+    replace(filename + ".tmp", filename)
+
+class Throttle():
+    """Keeps the average rate of consume() calls under rate bytes per second
+    by sleeping before reads that would go over it."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.next = time()
+    def consume(self, num_bytes):
+        if not self.rate:
+            return
+        wait = self.next - time()
+        if wait > 0:
+            sleep(wait)
+        self.next = max(self.next, time()) + num_bytes / self.rate
+
+class Scrubber():
+    """Validates every loose depot and chunkstore in the archive in a fixed
+    order, resuming from the cursor saved in the state file.
+
+    Targets are named by their path: ./depots/<depotid>/ for loose chunks, or
+    the .csm file of a chunkstore. Chunks the ledger says are good are skipped,
+    and chunks that are checked are recorded to the ledger."""
+    def __init__(self, chunkstore_dirs=["."], rate=0, reverify=30, ledger=LEDGER_FILE, state=STATE_FILE, metrics=METRICS_FILE, output="bad_chunks.txt"):
+        self.chunkstore_dirs = chunkstore_dirs
+        self.throttle = Throttle(rate)
+        # batches small enough that the throttle sleeps often instead of
+        # reading in long bursts
+        self.batch_bytes = max(int(rate / 4), 1024 * 1024) if rate else 16 * 1024 * 1024
+        self.max_age = reverify * 86400
+        self.ledger = ChunkLedger(ledger)
+        self.state_file = state
+        self.metrics_file = metrics
+        self.output = output
+        self.keys = {}
+        self.state = {"pass": 1, "pass_started": time(), "target": None, "position": None}
+        if exists(state):
+            with open(state, "r", encoding="utf-8") as f:
+                self.state = load(f)
+        self.metrics = {
+            "pid": getpid(),
+            "pass": self.state["pass"],
+            "pass_started": self.state["pass_started"],
+            "target": None,
+            "targets_done": 0,
+            "targets_total": 0,
+            "targets_skipped": 0,
+            "chunks_checked": 0,
+            "chunks_skipped": 0,
+            "bytes_read": 0,
+            "bytes_per_second": 0,
+            "bad_chunks": 0,
+            "bad_chunks_by_depot": {},
+            "last_pass_completed": None,
+            "last_pass_bad_chunks": None,
+            "updated": time(),
+        }
+        if exists(metrics):
+            with open(metrics, "r", encoding="utf-8") as f:
+                previous = load(f)
+            # keep counting where the last run left off if it was on this pass
+            if previous.get("pass") == self.state["pass"]:
+                self.metrics.update({key: previous[key] for key in self.metrics.keys() if key in previous and key != "pid"})
+            else:
+                self.metrics["last_pass_completed"] = previous.get("last_pass_completed")
+                self.metrics["last_pass_bad_chunks"] = previous.get("last_pass_bad_chunks")
+        self.last_save = 0
+        self.started = time()
+        self.read_since_start = 0
+    def __repr__(self):
+        return f"Scrubber on pass {self.state['pass']}, at {self.state['target']}"
+    def targets(self):
+        targets = []
+        if exists("./depots"):
+            for entry in scandir("./depots"):
+                if entry.is_dir() and entry.name.isdigit():
+                    targets.append("./depots/%s/" % entry.name)
+        for directory in self.chunkstore_dirs:
+            targets.extend(glob(directory.rstrip("/") + "/*.csm"))
+        return sorted(targets)
+    def depot_key(self, depotid):
+        if depotid not in self.keys:
+            self.keys[depotid] = find_depot_key(depotid)
+        return self.keys[depotid]
+    def list_target(self, target):
+        """Returns (depot, chunks, extra worker arguments) for a target, or
+        None if its chunks can't be validated."""
+        if target.endswith(".csm"):
+            items, extra = list_chunkstore_chunks(target, None)
+            with open(target, "rb") as f:
+                depotid = int.from_bytes(f.read(0x10)[0xc:0x10], byteorder='little', signed=False)
+            key = self.depot_key(depotid)
+            if extra[2] and not key:
+                return None
+            return depotid, items, (key,) + extra[1:]
+        depotid = int(target.rstrip("/").rpartition("/")[2])
+        items, extra = list_loose_chunks(target, None)
+        key = self.depot_key(depotid)
+        if not key and any(not item[1].endswith("_decrypted") for item in items):
+            return None
+        return depotid, items, (key,)
+    def save(self, force=False):
+        if not force and time() - self.last_save < 10:
+            return
+        elapsed = max(time() - self.started, 0.001)
+        self.metrics["bytes_per_second"] = round(self.read_since_start / elapsed)
+        self.metrics["updated"] = time()
+        save_json(self.state_file, self.state)
+        save_json(self.metrics_file, self.metrics)
+        self.last_save = time()
+    def scrub_target(self, target):
+        listed = self.list_target(target)
+        if not listed:
+            print("Skipping %s: encrypted, but no depot key available" % target)
+            self.metrics["targets_skipped"] += 1
+            return
+        depotid, items, extra = listed
+        position = self.state["position"] if self.state["target"] == target else None
+        if type(position) == list: # csd offsets come back from json as lists
+            position = tuple(position)
+        if items and position is not None and type(position) != type(items[0][1]):
+            position = None # a cursor saved with the wrong target by an older scrubber
+        if target != self.state["target"]:
+            # the cursor belongs to the previous target
+            self.state["position"] = None
+        self.state["target"] = target
+        self.metrics["target"] = target
+        known = self.ledger.load(depotid)
+        stale = []
+        for item in sorted(items, key = lambda item: item[1]):
+            if position is not None and item[1] <= position:
+                continue
+            if ChunkLedger.is_fresh(known.get((item[0], item[2])), item[3], item[4], item[5], self.max_age):
+                self.metrics["chunks_skipped"] += 1
+            else:
+                stale.append(item)
+        bad_in_target = 0
+        for batch_bytes, batch in make_batches(stale, self.batch_bytes):
+            self.throttle.consume(batch_bytes)
+            checked, read, bad = validate_batch([item[:2] for item in batch], *extra)
+            bad_locations = set((sha, location) for sha, _, location in bad)
+            self.ledger.record(depotid, ((sha, location, size, mtime_ns, inode, (sha, location) not in bad_locations) for sha, _, location, size, mtime_ns, inode in batch))
+            if bad:
+                with open(self.output, "a", encoding="utf-8", newline="\n") as f:
+                    for sha, reason, location in bad:
+                        f.write("%s\t%s\t%s\t%s\n" % (depotid, hexlify(sha).decode(), reason, location))
+                bad_in_target += len(bad)
+                self.metrics["bad_chunks"] += len(bad)
+                by_depot = self.metrics["bad_chunks_by_depot"]
+                by_depot[str(depotid)] = by_depot.get(str(depotid), 0) + len(bad)
+            self.metrics["chunks_checked"] += checked
+            self.metrics["bytes_read"] += read
+            self.read_since_start += read
+            self.state["position"] = batch[-1][1]
+            self.save()
+        if bad_in_target:
+            print("\033[31m%s bad %s\033[0m in %s, appended to %s" % (bad_in_target, "chunk" if bad_in_target == 1 else "chunks", target, self.output))
+    def scrub_pass(self):
+        """Scrubs every target once, starting from the saved cursor. Returns
+        when the pass is complete."""
+        targets = self.targets()
+        self.metrics["targets_total"] = len(targets)
+        start = 0
+        if self.state["target"] in targets:
+            start = targets.index(self.state["target"])
+        elif self.state["target"]:
+            # the target we stopped in is gone, carry on with the next one
+            start = len([target for target in targets if target < self.state["target"]])
+        self.metrics["targets_done"] = start
+        for target in targets[start:]:
+            print("Scrubbing", target)
+            self.scrub_target(target)
+            self.metrics["targets_done"] += 1
+            self.save(force=True)
+        print("Finished pass %s: %s chunks checked, %s skipped, %s bad" % (self.state["pass"], self.metrics["chunks_checked"], self.metrics["chunks_skipped"], self.metrics["bad_chunks"]))
+        self.metrics.update({
+            "last_pass_completed": time(),
+            "last_pass_bad_chunks": self.metrics["bad_chunks"],
+            "pass": self.state["pass"] + 1,
+            "pass_started": time(),
+            "target": None,
+            "targets_done": 0,
+            "chunks_checked": 0,
+            "chunks_skipped": 0,
+            "bytes_read": 0,
+            "bad_chunks": 0,
+            "bad_chunks_by_depot": {},
+        })
+        self.state = {"pass": self.state["pass"] + 1, "pass_started": time(), "target": None, "position": None}
+        self.save(force=True)
+
+if __name__ == "__main__":
+    if args.niceness:
+        nice(args.niceness)
+    scrubber = Scrubber(args.chunkstores or ["."], args.rate * 1000000, args.reverify, args.ledger, args.state, args.metrics, args.output)
+    try:
+        while True:
+            scrubber.scrub_pass()
+            if args.once:
+                break
+            sleep(args.interval * 3600)
+    except KeyboardInterrupt:
+        scrubber.save(force=True)
+        print("Stopped at", scrubber.state["target"])
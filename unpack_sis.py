@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
-from binascii import hexlify, unhexlify
+from binascii import hexlify
 from io import BytesIO
 from os import path, makedirs
 from re import sub
@@ -9,11 +9,13 @@ from struct import iter_unpack, pack
 from sys import argv
 from vdf import loads
 from chunkstore import Chunkstore
+from catalog import Catalog
+from keystore import find_depot_key
 
 def unpack_chunkstore(target, key=None, key_hex=None):
-        if key == True:
-            key, key_hex = find_key(depot)
         chunkstore = Chunkstore(target)
+        if key == True:
+            key, key_hex = find_key(chunkstore.depot)
         with open(chunkstore.csdname, "rb") as csdfile:
             def unpacker(chunkstore, sha, offset, length):
                 print("extracting chunk %s from offset %s in file %s" % (hexlify(sha).decode(), offset, target + ".csd"))
@@ -32,17 +34,19 @@ def unpack_chunkstore(target, key=None, key_hex=None):
                         f.write(csdfile.read(length))
             makedirs("./depots/%s" % chunkstore.depot, exist_ok=True)
             chunkstore.unpack(unpacker)
+        catalog = Catalog()
+        dest = "./depots/%s/" % chunkstore.depot
+        catalog.add_chunks(chunkstore.depot, ((sha, dest + hexlify(sha).decode() + ("" if key or chunkstore.is_encrypted else "_decrypted"), None, None) for sha in chunkstore.chunks.keys()))
+        catalog.close()
 
 def find_key(depot):
-    if path.exists("./depot_keys.txt"):
-        with open("./depot_keys.txt", "r", encoding="utf-8") as f:
-            for line in f.read().split("\n"):
-                line = line.split("\t")
-                if line[0] == depot:
-                    key_hex = line[2]
-                    return unhexlify(key_hex), key_hex
+    """Returns (key, key hex) for a depot, or (None, None) if we don't have
+    its key."""
+    key = find_depot_key(depot)
     if not key:
         print("couldn't find key for depot", depot)
+        return None, None
+    return key, hexlify(key).decode()
 
 def unpack_sis(sku, chunkstore_path, use_key = False):
     need_manifests = {}
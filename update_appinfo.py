@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
-from os import makedirs, listdir, path
+from os import makedirs, path
 from time import sleep
+from archive_queue import ArchiveQueue, ArchiveRules, QUEUE_FILE, manifest_changes
 
 if __name__ == "__main__": # exit before we import our shit if the args are wrong
     parser = ArgumentParser(description='Download appinfo changes since the last time we downloaded any appinfo.')
@@ -11,30 +12,110 @@ if __name__ == "__main__": # exit before we import our shit if the args are wron
     parser.add_argument("-t", type=int, help="Number of seconds to sleep between requests in daemon mode (default 5)", dest="time", default=5)
     parser.add_argument("-u", type=str, help="Username for non-interactive login", dest="username", nargs="?")
     parser.add_argument("-p", type=str, help="Password for non-interactive login", dest="password", nargs="?")
+    parser.add_argument("-w", type=int, help="Maximum number of PICS requests to have in flight at once (default 16)", dest="window", default=16)
+    parser.add_argument("-r", type=int, help="Number of times to retry a group of apps that times out before giving up on it (default 3)", dest="retries", default=3)
+    parser.add_argument("--archive", type=str, help="Archive new manifests of changed apps as they come in, for the apps in this rules file (see archive_queue.py)", metavar="RULES")
+    parser.add_argument("--archive-workers", type=int, help="Number of manifests to archive at once (default 2)", default=2)
+    parser.add_argument("--archive-connections", type=int, help="Number of concurrent chunk downloads per manifest being archived (default 10)", default=10)
+    parser.add_argument("--queue", type=str, help="Path to the queue of manifests to archive (default %s)" % QUEUE_FILE, default=QUEUE_FILE)
     args = parser.parse_args()
 
 from steam.client import SteamClient
-from steam.core.msg import MsgProto
 from steam.enums import EResult
-from steam.enums.emsg import EMsg
 from steam.webapi import WebAPI
 from login import auto_login
+from broker import BROKER_SOCKET, connect_broker
+from pics import ProductInfoFetcher, app_groups, changes_since, get_app_tokens
+from steam.client.cdn import CDNClient
+from concurrent.futures import ThreadPoolExecutor
+from appinfo import has_appinfo, load_appinfo, parse_appinfo, save_appinfo, summarize_appinfo
+from catalog import Catalog
+from depot_archiver import archive_manifest, try_load_manifest
+
+def queue_new_manifests(appid, changenumber, data):
+    """Queues the manifests an app's new appinfo has that its previous
+    changenumber didn't, if the archive rules include the app. Has to be
+    called before the new appinfo is saved."""
+    rule = rules.match(appid)
+    if not rule:
+        return
+    priority, branches = rule
+    previous = catalog.latest_changenumber(appid)
+    try:
+        old = load_appinfo(appid, previous, catalog) if previous and previous < changenumber else {}
+        new = summarize_appinfo(parse_appinfo(data))
+    except Exception as e:
+        print("Couldn't compare appinfo for app", appid, "changenumber", changenumber, e)
+        return
+    for depot, manifest, name in manifest_changes(old, new, branches):
+        stored = catalog.manifest(depot, manifest)
+        if stored and stored[1] and stored[1] == stored[2]:
+            continue # already archived
+        if queue.add(appid, depot, manifest, name, priority):
+            print("Queued app", appid, "depot", depot, "(%s)" % name, "gid", manifest, "for archiving")
+
+def run_archive_jobs():
+    """Collects finished archive jobs and starts pending ones, up to
+    --archive-workers at a time. Manifests are fetched here, since that
+    needs the Steam connection, and chunks are downloaded in the workers."""
+    for future in [future for future in running if future.done()]:
+        depot, manifest = running.pop(future)
+        try:
+            error = None if future.result() else "archiving failed"
+        except Exception as e:
+            error = e
+        if error:
+            retrying = queue.failed(depot, manifest, error)
+            print("\033[31mFailed to archive depot %s gid %s: %s\033[0m%s" % (depot, manifest, error, ", will retry" if retrying else ""))
+        else:
+            queue.done(depot, manifest)
+    while len(running) < args.archive_workers:
+        job = queue.claim()
+        if not job:
+            break
+        appid, depot, manifest, name = job
+        try:
+            loaded = try_load_manifest(appid, depot, manifest, c)
+        except Exception as e:
+            loaded, error = None, e
+        else:
+            error = "couldn't get manifest"
+        if not loaded:
+            retrying = queue.failed(depot, manifest, error)
+            print("\033[31mFailed to archive depot %s gid %s: %s\033[0m%s" % (depot, manifest, error, ", will retry" if retrying else ""))
+            continue
+        running[archiver.submit(archive_manifest, loaded, c, name, connection_limit=args.archive_connections)] = (depot, manifest)
 
 if __name__ == "__main__":
     # Create directories
     makedirs("./appinfo", exist_ok=True)
     makedirs("./depots", exist_ok=True)
+    catalog = Catalog()
 
-    steam_client = SteamClient()
-    print("Connecting to the Steam network...")
-    steam_client.connect()
-    print("Logging in...")
-    if args.interactive:
-        auto_login(steam_client, fallback_anonymous=False)
-    elif args.username:
-        auto_login(steam_client, args.username, args.password)
+    # share the broker's session if it's running, unless we were asked to
+    # log in as someone in particular
+    steam_client = None if args.interactive or args.username else connect_broker()
+    if steam_client:
+        print("Using the Steam session from the broker on", BROKER_SOCKET)
     else:
-        auto_login(steam_client)
+        steam_client = SteamClient()
+        print("Connecting to the Steam network...")
+        steam_client.connect()
+        print("Logging in...")
+        if args.interactive:
+            auto_login(steam_client, fallback_anonymous=False)
+        elif args.username:
+            auto_login(steam_client, args.username, args.password)
+        else:
+            auto_login(steam_client)
+
+    if args.archive:
+        rules = ArchiveRules(args.archive)
+        queue = ArchiveQueue(args.queue)
+        print(queue)
+        c = CDNClient(steam_client)
+        archiver = ThreadPoolExecutor(args.archive_workers)
+        running = {} # future -> (depot, manifest)
 
     highest_changenumber = 0
     if path.exists("./last_change.txt"):
@@ -42,65 +123,83 @@ if __name__ == "__main__":
             highest_changenumber = int(f.read())
     else:
         # if we haven't run get_appinfo yet, just find the last changenumber we downloaded
-        for file in listdir("./appinfo"):
-            if not file.endswith(".vdf"): continue
-            changenumber = int(file.split("_")[1].replace(".vdf", ""))
-            if changenumber > highest_changenumber:
-                highest_changenumber = changenumber
+        highest_changenumber = catalog.max_changenumber()
     while True:
-        msg = MsgProto(EMsg.ClientPICSChangesSinceRequest)
-        msg.body.since_change_number = highest_changenumber
-        msg.body.send_app_info_changes = True
         print("Asking Steam PICS for changes since %s..." % (highest_changenumber))
-        response = steam_client.wait_event(steam_client.send_job(msg))[0].body
+        response = changes_since(steam_client, highest_changenumber)
+        if not response:
+            print("Timeout reached asking for changes")
+            if not args.daemon:
+                exit(1)
+            sleep(args.time)
+            continue
         if response.force_full_app_update:
             print("Your appinfo is too old to get changes. Please redownload by "
                 "running get_appinfo.py.")
             exit(1)
-        msg = MsgProto(EMsg.ClientPICSProductInfoRequest)
         print("Latest change:", response.current_change_number)
+        failed = []
         if response.current_change_number != highest_changenumber:
             needed_tokens = []
             for change in response.app_changes:
                 if change.needs_token:
                     needed_tokens.append(change.appid)
-            tokens = steam_client.get_access_tokens(app_ids=needed_tokens)
-            token_count = 0
-            if tokens and 'apps' in tokens.items():
-                for app, token in tokens['apps'].items():
-                    if token != 0:
-                        token_count += 1
-            single = (token_count == 1)
-            print("Got", "token" if single else "tokens", "for", token_count, "app" if single else "apps")
+            tokens = get_app_tokens(steam_client, needed_tokens)
+            single = (len(tokens) == 1)
+            print("Got", "token" if single else "tokens", "for", len(tokens), "app" if single else "apps")
+            appids = []
             for change in response.app_changes:
+                if has_appinfo(change.appid, change.change_number, catalog):
+                    continue
                 if change.needs_token:
-                    if change.appid in tokens['apps'].keys() and tokens['apps'][change.appid] != 0:
+                    if change.appid in tokens:
                         print("using token for app", change.appid)
-                        app = msg.body.apps.add()
-                        app.appid = change.appid
-                        app.access_token = tokens['apps'][change.appid]
+                        appids.append(change.appid)
                     elif args.no_skip:
                         print("trying to download public_only appinfo for app", change.appid)
-                        app = msg.body.apps.add()
-                        app.appid = change.appid
+                        appids.append(change.appid)
                     else:
                         print("skipping app", change.appid, "(missing token)")
                 else:
-                    msg.body.apps.add().appid = change.appid
-            for appinfo_response in steam_client.wait_event(steam_client.send_job(msg),
-                    15)[0].body.apps:
-                # Write vdf appinfo to disk
-                appinfo_path = "./appinfo/%s_%s.vdf" % (appinfo_response.appid,
-                        appinfo_response.change_number)
-                if not path.exists(appinfo_path):
-                    with open(appinfo_path, "wb") as f:
-                        f.write(appinfo_response.buffer[:-1])
+                    appids.append(change.appid)
+            def on_apps(apps):
+                for appinfo_response in apps:
+                    # Write vdf appinfo to disk
+                    if not has_appinfo(appinfo_response.appid, appinfo_response.change_number, catalog):
+                        if args.archive:
+                            queue_new_manifests(appinfo_response.appid, appinfo_response.change_number,
+                                    appinfo_response.buffer[:-1])
+                        save_appinfo(appinfo_response.appid, appinfo_response.change_number,
+                                appinfo_response.buffer[:-1], catalog)
                         print("Saved appinfo for app", appinfo_response.appid,
                                 "changenumber", appinfo_response.change_number)
-        highest_changenumber = response.current_change_number
-        with open("./last_change.txt", "w") as f:
-            f.write(str(highest_changenumber))
+            if appids:
+                print("Asking Steam PICS for appinfo for %s %s..." % (len(appids),
+                    "app" if len(appids) == 1 else "apps"))
+                fetcher = ProductInfoFetcher(steam_client, tokens, window=min(4, args.window),
+                        max_window=args.window, retries=args.retries)
+                failed = fetcher.fetch(app_groups(appids), on_apps)
+        if failed:
+            # keep asking for changes since the last changenumber we have
+            # everything for, so the apps that failed are asked for again
+            print("\033[31mFailed to get appinfo for %s apps\033[0m, not advancing past change %s" %
+                (sum(len(group) for group in failed), highest_changenumber))
+            if not args.daemon:
+                exit(1)
+        else:
+            highest_changenumber = response.current_change_number
+            with open("./last_change.txt", "w") as f:
+                f.write(str(highest_changenumber))
+        if args.archive:
+            run_archive_jobs()
         if args.daemon:
             sleep(args.time)
         else:
             break
+    if args.archive:
+        # without -d, finish archiving what's queued before exiting
+        while running or queue.pending():
+            sleep(1)
+            run_archive_jobs()
+        archiver.shutdown()
+        print(queue)